@@ -15,6 +15,7 @@
 
 import os
 import os.path
+import collections
 
 import yaml
 import numpy as np
@@ -28,6 +29,7 @@ import mdtraj
 import simtk.unit as units
 
 from . import utils
+from .repex import open_trajectory_file
 
 import logging
 logger = logging.getLogger(__name__)
@@ -38,6 +40,12 @@ logger = logging.getLogger(__name__)
 
 kB = units.BOLTZMANN_CONSTANT_kB * units.AVOGADRO_CONSTANT_NA
 
+# Default maximum memory (bytes) used to hold the energies read from a store file at once.
+MAX_ANALYSIS_MEMORY = 256 * 2**20
+
+# Suffix replacing the '.nc' extension of a store file in the name of its analysis cache.
+ANALYSIS_CACHE_SUFFIX = '_analysis.json'
+
 # =============================================================================================
 # SUBROUTINES
 # =============================================================================================
@@ -111,10 +119,37 @@ def show_mixing_statistics(ncfile, cutoff=0.05, nequil=0):
     return
 
 
-def extract_ncfile_energies(ncfile, ndiscard=0, nuse=None, g=None):
+def _compute_chunk_iterations(ncfile, max_memory=None):
+    """Return the number of iterations of energies that can be read at once within max_memory bytes."""
+    if max_memory is None:
+        max_memory = MAX_ANALYSIS_MEMORY
+    nreplicas, nstates = ncfile.variables['energies'].shape[1:]
+    return max(1, int(max_memory // (nreplicas * nstates * np.dtype(np.float64).itemsize)))
+
+
+def _extract_u_n_range(ncfile, start, stop, chunk_iterations):
+    """Compute u_n for the iterations in [start, stop) reading chunk_iterations iterations at a time."""
+    nreplicas = ncfile.variables['energies'].shape[1]
+    replica_indices = np.arange(nreplicas)
+    u_n = np.zeros([stop - start], np.float64)
+    for chunk_start in range(start, stop, chunk_iterations):
+        chunk_stop = min(chunk_start + chunk_iterations, stop)
+        energies = np.array(ncfile.variables['energies'][chunk_start:chunk_stop,:,:], np.float64)
+        state_indices = np.array(ncfile.variables['states'][chunk_start:chunk_stop,:])
+        # Each replica contributes its energy in the state it is at.
+        chunk_indices = np.arange(chunk_stop - chunk_start)[:,np.newaxis]
+        u_n[chunk_start-start:chunk_stop-start] = energies[chunk_indices, replica_indices, state_indices].sum(axis=1)
+    return u_n
+
+
+def extract_ncfile_energies(ncfile, ndiscard=0, nuse=None, g=None, max_memory=None):
     """
     Extract and decorelate energies from the ncfile to gather common data for other functions
 
+    Energies are read in chunks in two passes. The first pass computes the timeseries u_n used to
+    determine the uncorrelated samples, and the second one deconvolutes only those samples, so
+    that the memory used to read the energies never exceeds max_memory.
+
     Parameters
     ----------
     ncfile : NetCDF
@@ -125,6 +160,8 @@ def extract_ncfile_energies(ncfile, ndiscard=0, nuse=None, g=None):
        Maximum number of iterations to use (after discarding)
     g : int, optional, default=None
        Statistical inefficiency to use if desired; if None, will be computed.
+    max_memory : int, optional, default=None
+       Maximum number of bytes of energies to read at once (default: MAX_ANALYSIS_MEMORY).
 
     TODO
     ----
@@ -134,68 +171,75 @@ def extract_ncfile_energies(ncfile, ndiscard=0, nuse=None, g=None):
     # Get current dimensions.
     niterations = ncfile.variables['energies'].shape[0]
     nstates = ncfile.variables['energies'].shape[1]
-    natoms = ncfile.variables['energies'].shape[2]
+    chunk_iterations = _compute_chunk_iterations(ncfile, max_memory)
 
-    # Extract energies.
-    logger.info("Reading energies...")
-    energies = ncfile.variables['energies']
-    u_kln_replica = np.zeros([nstates, nstates, niterations], np.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
-    logger.info("Done.")
+    # Determine the iterations to use after discarding equilibration and truncating
+    # to the number of specified conformations to use.
+    start = min(ndiscard, niterations)
+    stop = niterations
+    if (nuse):
+        stop = min(start + nuse, niterations)
 
-    # Deconvolute replicas
-    logger.info("Deconvoluting replicas...")
-    u_kln = np.zeros([nstates, nstates, niterations], np.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
+    # Compute total negative log probability over the used iterations.
+    logger.info("Reading energies...")
+    u_n = _extract_u_n_range(ncfile, start, stop, chunk_iterations)
     logger.info("Done.")
 
-    # Compute total negative log probability over all iterations.
-    u_n = np.zeros([niterations], np.float64)
-    for iteration in range(niterations):
-        u_n[iteration] = np.sum(np.diagonal(u_kln[:,:,iteration]))
-
-    # Discard initial data to equilibration.
-    u_kln_replica = u_kln_replica[:,:,ndiscard:]
-    u_kln = u_kln[:,:,ndiscard:]
-    u_n = u_n[ndiscard:]
-
-    # Truncate to number of specified conforamtions to use
-    if (nuse):
-        u_kln_replica = u_kln_replica[:,:,0:nuse]
-        u_kln = u_kln[:,:,0:nuse]
-        u_n = u_n[0:nuse]
+    # Check for the expanded cutoff states. When they are evaluated only every few
+    # iterations (see expanded_cutoff_stride), the skipped iterations are stored as fill values.
+    has_expanded_cutoff = 'fully_interacting_expanded_cutoff_energies' in ncfile.variables
+    if has_expanded_cutoff:
+        u_ln_full_raw = np.ma.filled(ncfile.variables['fully_interacting_expanded_cutoff_energies'][start:stop,:], np.nan).T # Its stored as nl, need in ln
+        u_ln_non_raw = np.ma.filled(ncfile.variables['noninteracting_expanded_cutoff_energies'][start:stop,:], np.nan).T
+        evaluated = ~(np.isnan(u_ln_full_raw).any(axis=0) | np.isnan(u_ln_non_raw).any(axis=0))
+        if not evaluated.any():
+            logger.info("Expanded cutoff energies have not been evaluated on any iteration; ignoring them.")
+            has_expanded_cutoff = False
 
     # Subsample data to obtain uncorrelated samples
     N_k = np.zeros(nstates, np.int32)
-    indices = timeseries.subsampleCorrelatedData(u_n, g=g) # indices of uncorrelated samples
-    #print(u_n) # DEBUG
-    #indices = range(0,u_n.size) # DEBUG - assume samples are uncorrelated
+    if has_expanded_cutoff and not evaluated.all():
+        # Subsample among the iterations with expanded cutoff energies, rescaling the
+        # statistical inefficiency to the average spacing between evaluated iterations.
+        if g is None:
+            g = timeseries.statisticalInefficiency(u_n)
+        evaluated_indices = np.where(evaluated)[0]
+        spacing = float(len(u_n)) / len(evaluated_indices)
+        g_evaluated = max(1.0, g / spacing)
+        indices = evaluated_indices[timeseries.subsampleCorrelatedData(u_n[evaluated_indices], g=g_evaluated)]
+    else:
+        indices = timeseries.subsampleCorrelatedData(u_n, g=g) # indices of uncorrelated samples
+    indices = np.array(indices, dtype=np.int64)
     N = len(indices) # number of uncorrelated samples
     N_k[:] = N
-    u_kln = u_kln[:,:,indices]
     logger.info("number of uncorrelated samples:")
     logger.info(N_k)
     logger.info("")
 
-    # Check for the expanded cutoff states, and subsamble as needed
-    try:
-        u_ln_full_raw = ncfile.variables['fully_interacting_expanded_cutoff_energies'][:].T #Its stored as nl, need in ln
-        u_ln_non_raw = ncfile.variables['noninteracting_expanded_cutoff_energies'][:].T 
-        fully_interacting_u_ln = np.zeros(u_ln_full_raw.shape)
-        noninteracting_u_ln = np.zeros(u_ln_non_raw.shape)
-        # Deconvolute the fully interacting state
-        for iteration in range(niterations):
-            state_indices = ncfile.variables['states'][iteration,:]
-            fully_interacting_u_ln[state_indices,iteration] = u_ln_full_raw[:,iteration]
-            noninteracting_u_ln[state_indices,iteration] = u_ln_non_raw[:,iteration]
-        # Discard non-equilibrated samples
-        fully_interacting_u_ln = fully_interacting_u_ln[:,ndiscard:]
-        fully_interacting_u_ln = fully_interacting_u_ln[:,indices]
-        noninteracting_u_ln = noninteracting_u_ln[:,ndiscard:]
-        noninteracting_u_ln = noninteracting_u_ln[:,indices]
+    # Deconvolute replicas reading only the chunks of iterations that contain uncorrelated samples.
+    logger.info("Deconvoluting replicas...")
+    u_kln = np.zeros([nstates, nstates, N], np.float64)
+    if has_expanded_cutoff:
+        fully_interacting_u_ln = np.zeros([nstates, N], np.float64)
+        noninteracting_u_ln = np.zeros([nstates, N], np.float64)
+    sample_start = 0
+    while sample_start < N:
+        chunk_start = start + indices[sample_start]
+        chunk_stop = min(chunk_start + chunk_iterations, stop)
+        sample_stop = sample_start + np.searchsorted(indices[sample_start:], chunk_stop - start)
+        energies = np.array(ncfile.variables['energies'][chunk_start:chunk_stop,:,:], np.float64)
+        state_indices = np.array(ncfile.variables['states'][chunk_start:chunk_stop,:])
+        for sample_index in range(sample_start, sample_stop):
+            offset = start + indices[sample_index] - chunk_start
+            u_kln[state_indices[offset],:,sample_index] = energies[offset,:,:]
+            if has_expanded_cutoff:
+                fully_interacting_u_ln[state_indices[offset],sample_index] = u_ln_full_raw[:,indices[sample_index]]
+                noninteracting_u_ln[state_indices[offset],sample_index] = u_ln_non_raw[:,indices[sample_index]]
+        sample_start = sample_stop
+    logger.info("Done.")
+
+    # Augment with the expanded cutoff states
+    if has_expanded_cutoff:
         # Augment u_kln to accept the new state
         u_kln_new = np.zeros([nstates + 2, nstates + 2, N], np.float64)
         N_k_new = np.zeros(nstates + 2, np.int32)
@@ -203,21 +247,18 @@ def extract_ncfile_energies(ncfile, ndiscard=0, nuse=None, g=None):
         u_kln_new[1:-1,0,:] = fully_interacting_u_ln
         u_kln_new[1:-1,-1,:] = noninteracting_u_ln
         # Fill in other energies
-        u_kln_new[1:-1,1:-1,:] = u_kln 
+        u_kln_new[1:-1,1:-1,:] = u_kln
         N_k_new[1:-1] = N_k
         # Notify users
         logger.info("Found expanded cutoff states in the energies!")
         logger.info("Free energies will be reported relative to them instead!")
-        # Reset values, last step in case something went wrong so we dont overwrite u_kln on accident
         u_kln = u_kln_new
         N_k = N_k_new
-    except:
-        pass
 
     return u_kln, N_k, u_n
 
 
-def initialize_MBAR(ncfile, u_kln=None, N_k=None):
+def initialize_MBAR(ncfile, u_kln=None, N_k=None, initial_f_k=None):
     """
     Initialize MBAR for Free Energy and Enthalpy estimates, this may take a while.
 
@@ -227,6 +268,9 @@ def initialize_MBAR(ncfile, u_kln=None, N_k=None):
        Reduced potential energies of the replicas; if None, will be extracted from the ncfile
     N_k : array of ints, optional, default=None
        Number of samples drawn from each kth replica; if None, will be extracted from the ncfile
+    initial_f_k : array of numpy.float64, optional, default=None
+       Initial guess of the dimensionless free energies (e.g. from a previous analysis) used to
+       warm-start the MBAR solver; if None, MBAR uses its default initialization
 
     TODO
     ----
@@ -239,7 +283,12 @@ def initialize_MBAR(ncfile, u_kln=None, N_k=None):
 
     # Initialize MBAR (computing free energy estimates, which may take a while)
     logger.info("Computing free energy differences...")
-    mbar = MBAR(u_kln, N_k)
+    if initial_f_k is not None:
+        initial_f_k = np.array(initial_f_k, np.float64)
+        if initial_f_k.shape != (len(N_k),):
+            logger.debug("Ignoring initial free energies of %d states for %d states." % (initial_f_k.size, len(N_k)))
+            initial_f_k = None
+    mbar = MBAR(u_kln, N_k, initial_f_k=initial_f_k)
     
     return mbar
     
@@ -322,7 +371,7 @@ def estimate_enthalpies(ncfile, mbar=None):
     return H_k, dH_k
 
 
-def extract_u_n(ncfile):
+def extract_u_n(ncfile, max_memory=None):
     """
     Extract timeseries of u_n = - log q(X_n) from store file
 
@@ -336,6 +385,8 @@ def extract_u_n(ncfile):
     ----------
     ncfile : str
        The filename of the repex NetCDF file.
+    max_memory : int, optional, default=None
+       Maximum number of bytes of energies to read at once (default: MAX_ANALYSIS_MEMORY).
 
     Returns
     -------
@@ -347,33 +398,12 @@ def extract_u_n(ncfile):
     Move this to repex.
 
     """
-
     # Get current dimensions.
     niterations = ncfile.variables['energies'].shape[0]
-    nstates = ncfile.variables['energies'].shape[1]
-    natoms = ncfile.variables['energies'].shape[2]
-
-    # Extract energies.
+    chunk_iterations = _compute_chunk_iterations(ncfile, max_memory)
     logger.info("Reading energies...")
-    energies = ncfile.variables['energies']
-    u_kln_replica = np.zeros([nstates, nstates, niterations], np.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
-    logger.info("Done.")
-
-    # Deconvolute replicas
-    logger.info("Deconvoluting replicas...")
-    u_kln = np.zeros([nstates, nstates, niterations], np.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
+    u_n = _extract_u_n_range(ncfile, 0, niterations, chunk_iterations)
     logger.info("Done.")
-
-    # Compute total negative log probability over all iterations.
-    u_n = np.zeros([niterations], np.float64)
-    for iteration in range(niterations):
-        u_n[iteration] = np.sum(np.diagonal(u_kln[:,:,iteration]))
-
     return u_n
 
 # =============================================================================================
@@ -414,9 +444,9 @@ def print_status(store_directory):
         ncfile = netcdf.Dataset(fullpath, 'r')
 
         # Read dimensions.
-        niterations = ncfile.variables['positions'].shape[0]
-        nstates = ncfile.variables['positions'].shape[1]
-        natoms = ncfile.variables['positions'].shape[2]
+        niterations = ncfile.variables['states'].shape[0]
+        nstates = ncfile.variables['states'].shape[1]
+        natoms = len(ncfile.dimensions['atom'])
 
         # Print summary.
         logger.info("%s" % phase)
@@ -431,102 +461,403 @@ def print_status(store_directory):
 
     return True
 
+# =============================================================================================
+# PERFORMANCE REPORT
+# =============================================================================================
+
+
+def compute_performance_statistics(ncfile):
+    """
+    Summarize the time spent by each MPI process in each activity of the simulation.
+
+    Parameters
+    ----------
+    ncfile : netCDF4.Dataset
+       The store file of the phase.
+
+    Returns
+    -------
+    statistics : dict or None
+       None if the file does not contain the timings of each process (e.g. it was created by a
+       previous version). Otherwise, a dictionary with the following keys:
+       'niterations': the number of iterations with recorded timings;
+       'wall_time': the total wall clock time of these iterations in seconds;
+       'activities': the names of the timed activities;
+       'rank_timings': rank_timings[rank][activity] is the total time spent by process rank in activity;
+       'parallel_efficiency': the fraction of the time of all processes spent propagating replicas
+       and computing energies;
+       'load_imbalance': the ratio between the maximum and the mean of this time among processes;
+       'slowest_rank': the process that spent the most time propagating and computing energies;
+       'state_propagation_times': the mean time to propagate a replica in each state (NaN if unknown);
+       'slowest_state': the state with the largest mean propagation time, or None if unknown.
+
+    """
+    ncgrp_timings = ncfile.groups['timings']
+    if 'rank_timings' not in ncgrp_timings.variables:
+        return None
+    ncvar_rank_timings = ncgrp_timings.variables['rank_timings']
+    activities = ncvar_rank_timings.getncattr('activities').split()
+
+    # Iteration 0, written when the simulation is created, and iterations run with a different
+    # number of MPI processes than the file have no timings and are excluded.
+    rank_timings = ncvar_rank_timings[:]
+    recorded = ~np.ma.getmaskarray(rank_timings).any(axis=(1, 2))
+    rank_timings = np.ma.filled(rank_timings[recorded], 0.0)
+    if len(rank_timings) == 0:
+        return None
+
+    # The iteration lasts until its slowest process is done.
+    wall_time = rank_timings.sum(axis=2).max(axis=1).sum()
+    total_rank_timings = rank_timings.sum(axis=0)
+    busy_times = total_rank_timings[:, activities.index('propagate')] + total_rank_timings[:, activities.index('energy')]
+
+    # Mean propagation time of the replicas in each state.
+    nstates = ncfile.variables['states'].shape[1]
+    states = np.ma.filled(ncfile.variables['states'][:], 0)
+    propagation_times = ncgrp_timings.variables['propagate'][:]
+    recorded = ~np.ma.getmaskarray(propagation_times)
+    state_total_times = np.bincount(states[recorded], weights=np.ma.filled(propagation_times, 0.0)[recorded], minlength=nstates)
+    state_counts = np.bincount(states[recorded], minlength=nstates)
+    state_propagation_times = np.zeros([nstates], np.float64) + np.nan
+    state_propagation_times[state_counts > 0] = state_total_times[state_counts > 0] / state_counts[state_counts > 0]
+    slowest_state = None
+    if np.any(state_counts > 0):
+        slowest_state = int(np.nanargmax(state_propagation_times))
+
+    return {'niterations': len(rank_timings),
+            'wall_time': wall_time,
+            'activities': activities,
+            'rank_timings': total_rank_timings,
+            'parallel_efficiency': busy_times.sum() / (len(busy_times) * wall_time) if wall_time > 0 else np.nan,
+            'load_imbalance': busy_times.max() / busy_times.mean() if busy_times.mean() > 0 else np.nan,
+            'slowest_rank': int(np.argmax(busy_times)),
+            'state_propagation_times': state_propagation_times,
+            'slowest_state': slowest_state}
+
+
+def print_performance_report(store_directory):
+    """
+    Print the parallel efficiency and the time spent by each MPI process in each activity.
+
+    Parameters
+    ----------
+    store_directory : string
+       The location of the NetCDF simulation output files.
+
+    Returns
+    -------
+    success : bool
+       True is returned on success; False if some files could not be read.
+
+    """
+    phases = utils.find_phases_in_store_directory(store_directory)
+
+    for phase, fullpath in phases.items():
+        if not os.path.exists(fullpath):
+            logger.info("File %s not found." % fullpath)
+            return False
+
+        ncfile = netcdf.Dataset(fullpath, 'r')
+        try:
+            statistics = compute_performance_statistics(ncfile)
+        finally:
+            ncfile.close()
+
+        logger.info("%s" % phase)
+        if statistics is None:
+            logger.info("  no timings of the MPI processes were recorded")
+            continue
+
+        rank_timings = statistics['rank_timings']
+        logger.info("  %8d iterations in %.1f s with %d MPI processes" % (statistics['niterations'],
+                    statistics['wall_time'], len(rank_timings)))
+        logger.info("  parallel efficiency %.1f%%, load imbalance %.2f (slowest process: %d)" %
+                    (100.0 * statistics['parallel_efficiency'], statistics['load_imbalance'], statistics['slowest_rank']))
+        logger.info("  %8s" % "rank" + "".join("%14s" % activity for activity in statistics['activities']))
+        for rank, timings in enumerate(rank_timings):
+            logger.info("  %8d" % rank + "".join("%12.1f s" % timing for timing in timings))
+        if statistics['slowest_state'] is not None:
+            state_propagation_times = statistics['state_propagation_times']
+            logger.info("  slowest state %d: %.3f s per propagation (mean over states %.3f s)" %
+                        (statistics['slowest_state'], state_propagation_times[statistics['slowest_state']],
+                         np.nanmean(state_propagation_times)))
+
+    return True
+
 # =============================================================================================
 # ANALYZE STORE FILES
 # =============================================================================================
 
 
-def analyze(source_directory):
+def get_analysis_cache_path(ncfile_path):
+    """Return the path of the analysis cache of a store file."""
+    return os.path.splitext(ncfile_path)[0] + ANALYSIS_CACHE_SUFFIX
+
+
+def _get_store_identifier(ncfile):
     """
-    Analyze contents of store files to compute free energy differences.
+    Return a string identifying the simulation in a store file.
+
+    This is the UUID of the file, or the hash of its title, which includes the creation
+    time, for files created by previous versions.
+
+    """
+    if 'UUID' in ncfile.ncattrs():
+        return str(ncfile.UUID)
+    import hashlib
+    return hashlib.sha1(str(getattr(ncfile, 'title', '')).encode('utf-8')).hexdigest()
+
+
+def _load_analysis_cache(cache_path, store_identifier):
+    """Return the analysis cache of the store file, or None if it is missing, unreadable or stale."""
+    import json
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.warning('Ignoring unreadable analysis cache {}: {}'.format(cache_path, e))
+        return None
+    if cache.get('store_identifier') != store_identifier:
+        logger.info('Ignoring analysis cache {} of a different simulation.'.format(cache_path))
+        return None
+    return cache
+
+
+def _save_analysis_cache(cache_path, cache):
+    """Write the analysis cache, logging a warning if the directory is not writable."""
+    import json
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write analysis cache {}: {}'.format(cache_path, e))
+
+
+def analyze_phase(ncfile_path, max_memory=None, use_cache=True):
+    """
+    Analyze the store file of a single phase.
+
+    The results are cached in a JSON file next to the store file (see get_analysis_cache_path())
+    together with the number of analyzed iterations. If the simulation has not progressed since,
+    the cached results are returned. Otherwise, the cached free energies warm-start MBAR.
 
     Parameters
     ----------
-    source_directory : string
-       The location of the NetCDF simulation storage files.
+    ncfile_path : str
+       The path of the NetCDF store file of the phase.
+    max_memory : int, optional, default=None
+       Maximum number of bytes of energies to read at once (default: MAX_ANALYSIS_MEMORY).
+    use_cache : bool, optional, default=True
+       If False, the analysis cache is neither read nor written.
+
+    Returns
+    -------
+    entry : dict
+       The free energy and enthalpy of the phase in kT ('DeltaF', 'dDeltaF', 'DeltaH', 'dDeltaH'),
+       the free energy of releasing the restraints in kT ('DeltaF_restraints') and the thermal
+       energy of the phase in kcal/mol ('kT').
 
     """
+    # Open NetCDF file for reading.
+    logger.info("Opening NetCDF trajectory file %(ncfile_path)s for reading..." % vars())
+    ncfile = netcdf.Dataset(ncfile_path, 'r')
+    try:
+        logger.debug("dimensions:")
+        for dimension_name in ncfile.dimensions.keys():
+            logger.debug("%16s %8d" % (dimension_name, len(ncfile.dimensions[dimension_name])))
+
+        # Read dimensions.
+        niterations = ncfile.variables['states'].shape[0]
+        nstates = ncfile.variables['states'].shape[1]
+        logger.info("Read %(niterations)d iterations, %(nstates)d states" % vars())
+
+        # Use the cached results if no iteration was added since the last analysis.
+        cache_path = get_analysis_cache_path(ncfile_path)
+        store_identifier = _get_store_identifier(ncfile)
+        cache = _load_analysis_cache(cache_path, store_identifier) if use_cache else None
+        if cache is not None and cache['niterations'] == niterations:
+            logger.info("Using analysis of %d iterations cached in %s" % (niterations, cache_path))
+            return cache['entry']
+
+        DeltaF_restraints = 0.0
+        if 'metadata' in ncfile.groups:
+            # Read phase direction and standard state correction free energy.
+            # Yank sets correction to 0 if there are no restraints
+            DeltaF_restraints = ncfile.groups['metadata'].variables['standard_state_correction'][0]
+
+        # Choose number of samples to discard to equilibration
+        MIN_ITERATIONS = 10 # minimum number of iterations to use automatic detection
+        if niterations > MIN_ITERATIONS:
+            u_n = extract_u_n(ncfile, max_memory=max_memory)
+            u_n = u_n[1:] # discard initial frame of zero energies TODO: Get rid of initial frame of zero energies
+            [nequil, g_t, Neff_max] = timeseries.detectEquilibration(u_n)
+            nequil += 1 # account for initial frame of zero energies
+            logger.info([nequil, Neff_max])
+        else:
+            nequil = 1  # discard first frame
+            g_t = 1
+            Neff_max = niterations
+
+        # Examine acceptance probabilities.
+        show_mixing_statistics(ncfile, cutoff=0.05, nequil=nequil)
+
+        # Extract equilibrated, decorrelated energies, check for fully interacting state
+        (u_kln, N_k, u_n) = extract_ncfile_energies(ncfile, ndiscard=nequil, g=g_t, max_memory=max_memory)
+
+        # Create MBAR object to use for free energy and entropy states, warm-starting
+        # from the free energies of the previous analysis if available.
+        initial_f_k = None
+        if cache is not None:
+            logger.info("Warm-starting MBAR from the analysis of %d iterations cached in %s" % (cache['niterations'], cache_path))
+            initial_f_k = cache['f_k']
+        mbar = initialize_MBAR(ncfile, u_kln=u_kln, N_k=N_k, initial_f_k=initial_f_k)
+
+        # Estimate free energies, use fully interacting state if present
+        (Deltaf_ij, dDeltaf_ij) = estimate_free_energies(ncfile, mbar=mbar)
+
+        # Estimate average enthalpies
+        (DeltaH_i, dDeltaH_i) = estimate_enthalpies(ncfile, mbar=mbar)
+
+        # Get temperatures.
+        ncvar = ncfile.groups['thermodynamic_states'].variables['temperatures']
+        temperature = ncvar[0] * units.kelvin
+        kT = kB * temperature
+    finally:
+        ncfile.close()
+
+    # Plain floats keep the entry picklable and serializable to JSON.
+    entry = dict()
+    entry['DeltaF'] = float(Deltaf_ij[0, -1])
+    entry['dDeltaF'] = float(dDeltaf_ij[0, -1])
+    entry['DeltaH'] = float(DeltaH_i[0, -1])
+    entry['dDeltaH'] = float(dDeltaH_i[0, -1])
+    entry['DeltaF_restraints'] = float(DeltaF_restraints)
+    entry['kT'] = kT / units.kilocalories_per_mole
+
+    # Cache results and intermediates.
+    if use_cache:
+        cache = collections.OrderedDict()
+        cache['store_identifier'] = store_identifier
+        cache['niterations'] = niterations
+        cache['nequil'] = int(nequil)
+        cache['statistical_inefficiency'] = float(g_t)
+        cache['f_k'] = [float(f) for f in mbar.f_k]
+        cache['entry'] = entry
+        _save_analysis_cache(cache_path, cache)
+
+    return entry
+
+
+def _analyze_phase_task(task):
+    """Run analyze_phase() in a worker process, returning the error message instead of raising."""
+    ncfile_path, max_memory, use_cache = task
+    try:
+        return analyze_phase(ncfile_path, max_memory=max_memory, use_cache=use_cache), None
+    except Exception as e:
+        logger.error('Analysis of {} failed: {}'.format(ncfile_path, e))
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+
+def _read_analysis_script(source_directory):
+    """Return the list of (phase, sign) pairs in the analysis.yaml script of the directory."""
     analysis_script_path = os.path.join(source_directory, 'analysis.yaml')
     if not os.path.isfile(analysis_script_path):
         err_msg = 'Cannot find analysis.yaml script in {}'.format(source_directory)
         logger.error(err_msg)
         raise RuntimeError(err_msg)
     with open(analysis_script_path, 'r') as f:
-        analysis = yaml.load(f)
-    phases = [phase_name for phase_name, sign in analysis]
+        return yaml.load(f)
 
-    # Storage for different phases.
-    data = dict()
 
-    # Process each netcdf file.
-    for phase in phases:
-        ncfile_path = os.path.join(source_directory, phase + '.nc')
+def _get_available_memory():
+    """Return the available physical memory in bytes, or None if this cannot be determined."""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
 
-        # Open NetCDF file for reading.
-        logger.info("Opening NetCDF trajectory file %(ncfile_path)s for reading..." % vars())
-        try:
-            ncfile = netcdf.Dataset(ncfile_path, 'r')
-
-            logger.debug("dimensions:")
-            for dimension_name in ncfile.dimensions.keys():
-                logger.debug("%16s %8d" % (dimension_name, len(ncfile.dimensions[dimension_name])))
-
-            # Read dimensions.
-            niterations = ncfile.variables['positions'].shape[0]
-            nstates = ncfile.variables['positions'].shape[1]
-            logger.info("Read %(niterations)d iterations, %(nstates)d states" % vars())
-
-            DeltaF_restraints = 0.0
-            if 'metadata' in ncfile.groups:
-                # Read phase direction and standard state correction free energy.
-                # Yank sets correction to 0 if there are no restraints
-                DeltaF_restraints = ncfile.groups['metadata'].variables['standard_state_correction'][0]
-
-            # Choose number of samples to discard to equilibration
-            MIN_ITERATIONS = 10 # minimum number of iterations to use automatic detection
-            if niterations > MIN_ITERATIONS:
-                from pymbar import timeseries
-                u_n = extract_u_n(ncfile)
-                u_n = u_n[1:] # discard initial frame of zero energies TODO: Get rid of initial frame of zero energies
-                [nequil, g_t, Neff_max] = timeseries.detectEquilibration(u_n)
-                nequil += 1 # account for initial frame of zero energies
-                logger.info([nequil, Neff_max])
-            else:
-                nequil = 1  # discard first frame
-                g_t = 1
-                Neff_max = niterations
 
-            # Examine acceptance probabilities.
-            show_mixing_statistics(ncfile, cutoff=0.05, nequil=nequil)
+def estimate_phase_memory(ncfile_path, max_memory=None):
+    """
+    Estimate the peak memory in bytes needed to analyze the store file of a phase.
 
-            # Extract equilibrated, decorrelated energies, check for fully interacting state
-            (u_kln, N_k, u_n) = extract_ncfile_energies(ncfile, ndiscard=nequil, g=g_t)
+    The estimate assumes that no sample is discarded as correlated, and that MBAR needs
+    a few copies of the reduced potentials of all samples in all states.
 
-            # Create MBAR object to use for free energy and entropy states
-            mbar = initialize_MBAR(ncfile, u_kln=u_kln, N_k=N_k)
+    Parameters
+    ----------
+    ncfile_path : str
+       The path of the NetCDF store file of the phase.
+    max_memory : int, optional, default=None
+       Maximum number of bytes of energies to read at once (default: MAX_ANALYSIS_MEMORY).
 
-            # Estimate free energies, use fully interacting state if present
-            (Deltaf_ij, dDeltaf_ij) = estimate_free_energies(ncfile, mbar=mbar)
+    """
+    if max_memory is None:
+        max_memory = MAX_ANALYSIS_MEMORY
+    ncfile = netcdf.Dataset(ncfile_path, 'r')
+    try:
+        niterations, nreplicas, nstates = ncfile.variables['energies'].shape
+    finally:
+        ncfile.close()
+    # Expanded cutoff states add two states.
+    nstates += 2
+    u_kln_size = nstates * nstates * niterations * np.dtype(np.float64).itemsize
+    return max_memory + 4 * u_kln_size
 
-            # Estimate average enthalpies
-            (DeltaH_i, dDeltaH_i) = estimate_enthalpies(ncfile, mbar=mbar)
 
-            # Accumulate free energy differences
-            entry = dict()
-            entry['DeltaF'] = Deltaf_ij[0, -1]
-            entry['dDeltaF'] = dDeltaf_ij[0, -1]
-            entry['DeltaH'] = DeltaH_i[0, -1]
-            entry['dDeltaH'] = dDeltaH_i[0, -1]
-            entry['DeltaF_restraints'] = DeltaF_restraints
-            data[phase] = entry
+def compute_analysis_jobs(ncfile_paths, jobs, max_memory=None):
+    """
+    Return the number of worker processes that can analyze the given phases in parallel.
 
-            # Get temperatures.
-            ncvar = ncfile.groups['thermodynamic_states'].variables['temperatures']
-            temperature = ncvar[0] * units.kelvin
-            kT = kB * temperature
+    The number of workers is bounded by the requested jobs, the number of phases, the number
+    of CPUs and the number of the most memory-demanding phases that fit in the available memory.
 
-        finally:
-            ncfile.close()
+    Parameters
+    ----------
+    ncfile_paths : list of str
+       The store files to analyze.
+    jobs : int
+       The maximum number of worker processes.
+    max_memory : int, optional, default=None
+       Maximum number of bytes of energies to read at once by each worker (default: MAX_ANALYSIS_MEMORY).
+
+    Returns
+    -------
+    jobs : int
+       The number of worker processes to use.
+
+    """
+    import multiprocessing
+    jobs = min(jobs, len(ncfile_paths), multiprocessing.cpu_count())
+    available_memory = _get_available_memory()
+    if jobs > 1 and available_memory is not None:
+        phase_memory = max(estimate_phase_memory(ncfile_path, max_memory) for ncfile_path in ncfile_paths)
+        memory_jobs = int(available_memory // phase_memory)
+        if memory_jobs < jobs:
+            logger.info('Limiting analysis to {} parallel jobs to fit in the available memory.'.format(max(1, memory_jobs)))
+            jobs = memory_jobs
+    return max(1, jobs)
+
+
+def _combine_phases(source_directory, analysis, data):
+    """Combine the results of the phases of an experiment, log them and return the summary."""
+    phases = [phase_name for phase_name, sign in analysis]
+    summary = collections.OrderedDict([('directory', source_directory), ('phases', data)])
+
+    errors = {phase: data[phase]['error'] for phase in phases if 'error' in data[phase]}
+    if len(errors) > 0:
+        summary['error'] = '; '.join('{}: {}'.format(phase, error) for phase, error in sorted(errors.items()))
+        logger.error('Could not analyze {}: {}'.format(source_directory, summary['error']))
+        return summary
 
     # Compute free energy and enthalpy
     DeltaF = 0.0
@@ -540,6 +871,7 @@ def analyze(source_directory):
         dDeltaH += data[phase]['dDeltaH']**2
     dDeltaF = np.sqrt(dDeltaF)
     dDeltaH = np.sqrt(dDeltaH)
+    kT = data[phases[-1]]['kT'] * units.kilocalories_per_mole
 
     # Attempt to guess type of calculation
     calculation_type = ''
@@ -567,6 +899,130 @@ def analyze(source_directory):
         calculation_type, DeltaH, dDeltaH, DeltaH * kT / units.kilocalories_per_mole,
         dDeltaH * kT / units.kilocalories_per_mole))
 
+    summary['DeltaF'] = float(DeltaF)
+    summary['dDeltaF'] = float(dDeltaF)
+    summary['DeltaH'] = float(DeltaH)
+    summary['dDeltaH'] = float(dDeltaH)
+    summary['DeltaF_kcal_mol'] = float(DeltaF * kT / units.kilocalories_per_mole)
+    summary['dDeltaF_kcal_mol'] = float(dDeltaF * kT / units.kilocalories_per_mole)
+    summary['DeltaH_kcal_mol'] = float(DeltaH * kT / units.kilocalories_per_mole)
+    summary['dDeltaH_kcal_mol'] = float(dDeltaH * kT / units.kilocalories_per_mole)
+    return summary
+
+
+def analyze_directories(source_directories, jobs=1, max_memory=None, use_cache=True):
+    """
+    Analyze the store files of several experiments, in parallel over all their phases.
+
+    A phase that cannot be analyzed does not stop the analysis of the others. Its error
+    is reported in the 'error' field of the summary of its experiment.
+
+    Parameters
+    ----------
+    source_directories : list of str
+       The locations of the NetCDF simulation storage files of each experiment.
+    jobs : int, optional, default=1
+       The maximum number of worker processes (see compute_analysis_jobs()).
+    max_memory : int, optional, default=None
+       Maximum number of bytes of energies to read at once by each worker (default: MAX_ANALYSIS_MEMORY).
+    use_cache : bool, optional, default=True
+       If False, the analysis caches of the phases are neither read nor written (see analyze_phase()).
+
+    Returns
+    -------
+    summaries : list of dict
+       summaries[i] contains the free energies and enthalpies of source_directories[i] in kT
+       and kcal/mol, and the results of each of its phases under the key 'phases'.
+
+    """
+    analyses = [_read_analysis_script(source_directory) for source_directory in source_directories]
+    tasks = [(os.path.join(source_directory, phase + '.nc'), max_memory, use_cache)
+             for source_directory, analysis in zip(source_directories, analyses) for phase, sign in analysis]
+
+    # Analyze all phases.
+    jobs = compute_analysis_jobs([task[0] for task in tasks], jobs, max_memory)
+    if jobs > 1:
+        import multiprocessing
+        logger.info('Analyzing {} phases with {} parallel jobs...'.format(len(tasks), jobs))
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_analyze_phase_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_analyze_phase_task(task) for task in tasks]
+
+    # Combine the phases of each experiment.
+    summaries = list()
+    results = iter(results)
+    for source_directory, analysis in zip(source_directories, analyses):
+        data = dict()
+        for phase, sign in analysis:
+            entry, error = next(results)
+            data[phase] = entry if error is None else {'error': error}
+        summaries.append(_combine_phases(source_directory, analysis, data))
+    return summaries
+
+
+def write_analysis_summary(summaries, summary_path):
+    """
+    Write the summaries returned by analyze_directories() to a JSON or CSV file.
+
+    The format is determined by the extension of the file. The CSV file contains one row
+    per experiment without the results of the single phases.
+
+    Parameters
+    ----------
+    summaries : list of dict
+       The summaries to write.
+    summary_path : str
+       The path of the file to create, ending with '.json' or '.csv'.
+
+    """
+    extension = os.path.splitext(summary_path)[1].lower()
+    if extension == '.json':
+        import json
+        with open(summary_path, 'w') as f:
+            json.dump(summaries, f, indent=2)
+    elif extension == '.csv':
+        import csv
+        fields = ['directory', 'DeltaF', 'dDeltaF', 'DeltaF_kcal_mol', 'dDeltaF_kcal_mol',
+                  'DeltaH', 'dDeltaH', 'DeltaH_kcal_mol', 'dDeltaH_kcal_mol', 'error']
+        with open(summary_path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+            writer.writeheader()
+            for summary in summaries:
+                writer.writerow(summary)
+    else:
+        raise ValueError('Cannot determine the format of the summary file {}. '
+                         'Use the extension .json or .csv.'.format(summary_path))
+
+
+def analyze(source_directory, max_memory=None, use_cache=True):
+    """
+    Analyze contents of store files to compute free energy differences.
+
+    Parameters
+    ----------
+    source_directory : string
+       The location of the NetCDF simulation storage files.
+    max_memory : int, optional, default=None
+       Maximum number of bytes of energies to read at once (default: MAX_ANALYSIS_MEMORY).
+    use_cache : bool, optional, default=True
+       If False, the analysis caches of the phases are neither read nor written (see analyze_phase()).
+
+    Returns
+    -------
+    summary : dict
+       The free energy and enthalpy of the experiment (see analyze_directories()).
+
+    """
+    summary = analyze_directories([source_directory], max_memory=max_memory, use_cache=use_cache)[0]
+    if 'error' in summary:
+        raise RuntimeError('Could not analyze {}: {}'.format(source_directory, summary['error']))
+    return summary
+
 
 # ==============================================================================
 # Extract trajectory from NetCDF4 file
@@ -613,9 +1069,11 @@ def extract_trajectory(output_path, nc_path, state_index=None, replica_index=Non
     if not os.path.isfile(nc_path):
         raise ValueError('Cannot find file {}'.format(nc_path))
 
-    # Import simulation data
+    # Import simulation data. Positions may be stored in a separate trajectory file.
+    trajectory_nc_file = None
     try:
         nc_file = netcdf.Dataset(nc_path, 'r')
+        trajectory_nc_file = open_trajectory_file(nc_file, nc_path)
 
         # Extract topology and system serialization
         serialized_system = nc_file.groups['metadata'].variables['reference_system'][0]
@@ -628,17 +1086,29 @@ def extract_trajectory(output_path, nc_path, state_index=None, replica_index=Non
         logger.info('Detected periodic boundary conditions: {}'.format(is_periodic))
 
         # Get dimensions
-        n_iterations = nc_file.variables['positions'].shape[0]
-        n_atoms = nc_file.variables['positions'].shape[2]
+        n_iterations = trajectory_nc_file.variables['positions'].shape[0]
+        n_atoms = trajectory_nc_file.variables['positions'].shape[2]
         logger.info('Number of iterations: {}, atoms: {}'.format(n_iterations, n_atoms))
 
+        # Positions may be stored only for a subset of atoms
+        if 'trajectory_atom_indices' in trajectory_nc_file.variables:
+            trajectory_atom_indices = trajectory_nc_file.variables['trajectory_atom_indices'][:]
+        else:
+            trajectory_atom_indices = None
+
+        # Positions may be stored only every few iterations
+        positions_write_interval = 1
+        if 'positions_write_interval' in nc_file.groups['options'].variables:
+            positions_write_interval = int(nc_file.groups['options'].variables['positions_write_interval'].getValue())
+
         # Determine frames to extract
         if start_frame <= 0:
             # TODO yank saves first frame with 0 energy!
             start_frame = 1
         if end_frame < 0:
             end_frame = n_iterations + end_frame + 1
-        frame_indices = range(start_frame, end_frame, skip_frame)
+        frame_indices = [frame for frame in range(start_frame, end_frame, skip_frame)
+                         if frame % positions_write_interval == 0]
         if len(frame_indices) == 0:
             raise ValueError('No frames selected')
         logger.info('Extracting frames from {} to {} every {}'.format(
@@ -652,7 +1122,8 @@ def extract_trajectory(output_path, nc_path, state_index=None, replica_index=Non
                          "effectively uncorrelated samples)...").format(n_equil, n_eff))
             frame_indices = frame_indices[n_equil:-1]
 
-        # Extract state positions and box vectors
+        # Extract state positions and box vectors. Positions stored with a fixed-precision
+        # integer encoding are decoded by netCDF4 through their scale_factor attribute.
         positions = np.zeros((len(frame_indices), n_atoms, 3))
         if is_periodic:
             box_vectors = np.zeros((len(frame_indices), 3, 3))
@@ -668,7 +1139,7 @@ def extract_trajectory(output_path, nc_path, state_index=None, replica_index=Non
             # Extract state positions and box vectors
             for i, iteration in enumerate(frame_indices):
                 replica_index = state_indices[i]
-                positions[i, :, :] = nc_file.variables['positions'][iteration, replica_index, :, :].astype(np.float32)
+                positions[i, :, :] = trajectory_nc_file.variables['positions'][iteration, replica_index, :, :].astype(np.float32)
                 if is_periodic:
                     box_vectors[i, :, :] = nc_file.variables['box_vectors'][iteration, replica_index, :, :].astype(np.float32)
 
@@ -676,15 +1147,19 @@ def extract_trajectory(output_path, nc_path, state_index=None, replica_index=Non
             logger.info('Extracting positions of replica {}...'.format(replica_index))
 
             for i, iteration in enumerate(frame_indices):
-                positions[i, :, :] = nc_file.variables['positions'][iteration, replica_index, :, :].astype(np.float32)
+                positions[i, :, :] = trajectory_nc_file.variables['positions'][iteration, replica_index, :, :].astype(np.float32)
                 if is_periodic:
                     box_vectors[i, :, :] = nc_file.variables['box_vectors'][iteration, replica_index, :, :].astype(np.float32)
     finally:
+        if trajectory_nc_file is not None and trajectory_nc_file is not nc_file:
+            trajectory_nc_file.close()
         nc_file.close()
 
     # Create trajectory object
     logger.info('Creating trajectory object...')
     topology = utils.deserialize_topology(serialized_topology)
+    if trajectory_atom_indices is not None:
+        topology = topology.subset(trajectory_atom_indices)
     trajectory = mdtraj.Trajectory(positions, topology)
     if is_periodic:
         trajectory.unitcell_vectors = box_vectors
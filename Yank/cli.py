@@ -37,6 +37,7 @@ Commands:
   status                        Get the current status
   analyze                       Analyze data OR extract trajectory from a NetCDF file in a common format.
   cleanup                       Clean up (delete) run files.
+  migrate                       Rewrite a NetCDF file into the current storage layout.
 
 Options:
   -h --help                     Display this message and quit
@@ -51,6 +52,7 @@ def main(argv=None):
     # Parse command-line arguments.
     from docopt import docopt
     from . import version
+    from .repex import SimulationInterrupted, RESUMABLE_EXIT_CODE
     # Parse the initial options, the options_first flag must be True to for <ARGS> to act as a wildcard for options (- and --) as well
     args = docopt(usage, version=version.version, argv=argv, options_first=True)
 
@@ -71,7 +73,12 @@ def main(argv=None):
         command_usage = getattr(commands, command).usage
         command_args  = docopt(command_usage, version=version.version, argv=argv) # This will terminate if command is invalid
         # Execute Command
-        dispatched = getattr(commands, command).dispatch(command_args)
+        try:
+            dispatched = getattr(commands, command).dispatch(command_args)
+        except SimulationInterrupted as e:
+            # The simulation can be resumed, signal it to the job scheduler with the exit status.
+            print(str(e))
+            return RESUMABLE_EXIT_CODE
         
     # If unsuccessful, print usage and exit with an error.
     if not dispatched:
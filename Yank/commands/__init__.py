@@ -15,3 +15,4 @@ from . import script
 from . import status
 from . import analyze
 from . import cleanup
+from . import migrate
@@ -23,14 +23,22 @@ usage = """
 YANK analyze
 
 Usage:
-  yank analyze (-s STORE | --store=STORE) [-v | --verbose]
+  yank analyze (-s STORE | --store=STORE)... [--jobs=N] [--summary=FILEPATH] [--max-memory=MB] [--nocache] [-v | --verbose]
+  yank analyze performance (-s STORE | --store=STORE)... [-v | --verbose]
   yank analyze extract-trajectory --netcdf=FILEPATH (--state=STATE | --replica=REPLICA) --trajectory=FILEPATH [--start=START_FRAME] [--skip=SKIP_FRAME] [--end=END_FRAME] [--nosolvent] [--discardequil] [--imagemol] [-v | --verbose]
 
 Description:
   Analyze the data to compute Free Energies OR extract the trajectory from the NetCDF file into a common fortmat.
+  The performance command reports the parallel efficiency and the time spent by each MPI process in each activity.
 
 Free Energy Required Arguments:
-  -s=STORE, --store=STORE       Storage directory for NetCDF data files.
+  -s=STORE, --store=STORE       Storage directory for NetCDF data files. Repeat to analyze multiple experiments.
+
+Free Energy Options:
+  --jobs=N                      Maximum number of phases to analyze in parallel [default: 1]
+  --summary=FILEPATH            Write the free energies of all experiments to a .json or .csv file
+  --max-memory=MB               Maximum memory in MB used to read energies at once [default: 256]
+  --nocache                     Do not read or write the analysis results cached next to the NetCDF files
 
 Extract Trajectory Required Arguments:
   --netcdf=FILEPATH             Path to the NetCDF file.
@@ -60,9 +68,23 @@ def dispatch(args):
 
     if args['extract-trajectory']:
         return dispatch_extract_trajectory(args)
-
-    analyze.analyze(args['--store'])
-    return True
+    if args['performance']:
+        return dispatch_performance(args)
+
+    max_memory = int(float(args['--max-memory']) * 2**20)
+    summaries = analyze.analyze_directories(args['--store'], jobs=int(args['--jobs']), max_memory=max_memory,
+                                            use_cache=not args['--nocache'])
+    if args['--summary']:
+        analyze.write_analysis_summary(summaries, args['--summary'])
+    # Failing experiments are reported in their summary, but the command must still fail.
+    return all('error' not in summary for summary in summaries)
+
+
+def dispatch_performance(args):
+    success = True
+    for store_directory in args['--store']:
+        success = analyze.print_performance_report(store_directory) and success
+    return success
 
 
 def dispatch_extract_trajectory(args):
@@ -0,0 +1,59 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Rewrite YANK store files into the current storage layout.
+
+"""
+
+#=============================================================================================
+# MODULE IMPORTS
+#=============================================================================================
+
+from .. import utils
+
+#=============================================================================================
+# COMMAND-LINE INTERFACE
+#=============================================================================================
+
+usage = """
+YANK migrate
+
+Usage:
+  yank migrate --netcdf=FILEPATH --output=FILEPATH [--chunk-iterations=N] [--complevel=LEVEL] [--nocompression] [--noshuffle] [-v | --verbose]
+
+Description:
+  Rewrite a NetCDF store file into a new file with the chunking and compression used by the current version of YANK.
+  Per-iteration variables are chunked for one-iteration appends and whole time-series reads.
+
+Required Arguments:
+  --netcdf=FILEPATH             Path to the NetCDF file to migrate.
+  --output=FILEPATH             Path to the NetCDF file to create.
+
+Migration Options:
+  --chunk-iterations=N          Maximum number of iterations in a chunk [default: 64]
+  --complevel=LEVEL             Compression level between 1 and 9 [default: 4]
+  --nocompression               Do not compress per-iteration variables
+  --noshuffle                   Do not apply the shuffle filter before compression
+
+General Options:
+  -v, --verbose                 Print verbose output
+
+"""
+
+#=============================================================================================
+# COMMAND DISPATCH
+#=============================================================================================
+
+def dispatch(args):
+    from .. import repex
+    utils.config_root_logger(args['--verbose'])
+    repex.migrate_netcdf_layout(args['--netcdf'], args['--output'],
+                                chunk_iterations=int(args['--chunk-iterations']),
+                                zlib=not args['--nocompression'],
+                                complevel=int(args['--complevel']),
+                                shuffle=not args['--noshuffle'])
+    return True
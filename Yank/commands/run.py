@@ -100,6 +100,10 @@ def dispatch(args):
             else:
                 raise Exception("Platform selection logic is outdated and needs to be updated to add platform '%s'." % platform_name)
 
+    # Spread the MPI processes of each node across its GPUs.
+    if mpicomm is not None and 'platform' in options:
+        utils.bind_platform_device(options['platform'], mpicomm)
+
     # Create YANK object associated with data storage directory.
     yank = Yank(store_directory, mpicomm=mpicomm, **options)
 
@@ -0,0 +1,315 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Integrators and helpers for the MCMC moves used to propagate replicas.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import logging
+logger = logging.getLogger(__name__)
+
+from simtk import openmm, unit
+
+#=============================================================================================
+# MODULE CONSTANTS
+#=============================================================================================
+
+kB = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA # Boltzmann constant
+
+# Forces assigned to the slow force group by the multiple timestep integrator.
+MTS_SLOW_FORCES = ['NonbondedForce', 'CustomNonbondedForce', 'GBSAOBCForce', 'CustomGBForce', 'AmoebaMultipoleForce']
+
+# Timestep above which light atoms must be repartitioned.
+MAX_TIMESTEP_WITHOUT_HMR = 2.0 * unit.femtoseconds
+
+# Mass below which a particle is considered a non-repartitioned hydrogen.
+LIGHT_PARTICLE_MASS = 2.0 * unit.amu
+
+#=============================================================================================
+# Integrators
+#=============================================================================================
+
+class BAOABLangevinIntegrator(openmm.CustomIntegrator):
+    """
+    Langevin integrator using the BAOAB splitting with support for constraints.
+
+    The BAOAB splitting samples configurations with smaller timestep errors than the
+    standard OpenMM LangevinIntegrator, which makes it a good choice for larger timesteps.
+
+    References
+    ----------
+    [1] Leimkuhler B and Matthews C. Robust and efficient configurational molecular sampling via Langevin
+        dynamics. J. Chem. Phys. 138:174102, 2013. DOI: 10.1063/1.4802990
+
+    Examples
+    --------
+    >>> integrator = BAOABLangevinIntegrator(300.0 * unit.kelvin, 5.0 / unit.picoseconds, 2.0 * unit.femtoseconds)
+
+    """
+
+    def __init__(self, temperature, collision_rate, timestep):
+        """
+        Parameters
+        ----------
+        temperature : simtk.unit.Quantity with units compatible with kelvin
+           The temperature of the heat bath.
+        collision_rate : simtk.unit.Quantity with units compatible with 1/picoseconds
+           The collision rate.
+        timestep : simtk.unit.Quantity with units compatible with femtoseconds
+           The integration timestep.
+
+        """
+        super(BAOABLangevinIntegrator, self).__init__(timestep)
+
+        self.addGlobalVariable('kT', kB * temperature)
+        self.addGlobalVariable('gamma', collision_rate)
+        self.addGlobalVariable('a', 0.0)
+        self.addGlobalVariable('b', 0.0)
+        self.addPerDofVariable('x1', 0.0)
+
+        self.addUpdateContextState()
+        # Velocity scaling factors depend on dt, which may be changed with setStepSize().
+        self.addComputeGlobal('a', 'exp(-gamma*dt)')
+        self.addComputeGlobal('b', 'sqrt(1-exp(-2*gamma*dt))')
+        _add_velocity_update(self, 'f', '0.5*dt')
+        _add_position_update(self, '0.5*dt')
+        self.addComputePerDof('v', 'a*v + b*sqrt(kT/m)*gaussian')
+        self.addConstrainVelocities()
+        _add_position_update(self, '0.5*dt')
+        _add_velocity_update(self, 'f', '0.5*dt')
+
+    def getTemperature(self):
+        """Return the temperature of the heat bath."""
+        return self.getGlobalVariableByName('kT') * unit.kilojoules_per_mole / kB
+
+    def setTemperature(self, temperature):
+        """Set the temperature of the heat bath."""
+        self.setGlobalVariableByName('kT', (kB * temperature).value_in_unit(unit.kilojoules_per_mole))
+
+
+class MTSLangevinIntegrator(openmm.CustomIntegrator):
+    """
+    Multiple timestep (RESPA) Langevin integrator.
+
+    Forces in force group 1 (see assign_mts_force_groups()) are evaluated once per timestep,
+    while forces in fast_force_groups are integrated with nsubsteps inner steps, each of which
+    applies a BAOAB-like splitting of the fast forces. Forces in any other group are ignored,
+    so fast_force_groups should list every group of the system other than 1 (see
+    get_mts_fast_force_groups()).
+
+    References
+    ----------
+    [1] Tuckerman M, Berne BJ, and Martyna GJ. Reversible multiple time scale molecular dynamics.
+        J. Chem. Phys. 97:1990, 1992. DOI: 10.1063/1.463137
+
+    Examples
+    --------
+    >>> integrator = MTSLangevinIntegrator(300.0 * unit.kelvin, 5.0 / unit.picoseconds, 4.0 * unit.femtoseconds, 4)
+
+    """
+
+    def __init__(self, temperature, collision_rate, timestep, nsubsteps=4, fast_force_groups=(0,)):
+        """
+        Parameters
+        ----------
+        temperature : simtk.unit.Quantity with units compatible with kelvin
+           The temperature of the heat bath.
+        collision_rate : simtk.unit.Quantity with units compatible with 1/picoseconds
+           The collision rate.
+        timestep : simtk.unit.Quantity with units compatible with femtoseconds
+           The outer timestep used for slow forces.
+        nsubsteps : int, optional, default=4
+           The number of inner steps used to integrate fast forces.
+        fast_force_groups : list of int, optional, default=(0,)
+           The force groups integrated in the inner steps. Must not contain the slow group 1.
+
+        """
+        if 1 in fast_force_groups:
+            raise ValueError('Force group 1 is the slow force group and cannot be a fast force group.')
+        super(MTSLangevinIntegrator, self).__init__(timestep)
+
+        self.addGlobalVariable('kT', kB * temperature)
+        self.addGlobalVariable('gamma', collision_rate)
+        self.addGlobalVariable('a', 0.0)
+        self.addGlobalVariable('b', 0.0)
+        self.addPerDofVariable('x1', 0.0)
+
+        h = 'dt/%d' % nsubsteps
+        if len(fast_force_groups) > 0:
+            fast_forces = '(%s)' % '+'.join('f%d' % group for group in sorted(fast_force_groups))
+        else:
+            fast_forces = '0'
+        self.addUpdateContextState()
+        self.addComputeGlobal('a', 'exp(-gamma*%s)' % h)
+        self.addComputeGlobal('b', 'sqrt(1-exp(-2*gamma*%s))' % h)
+        _add_velocity_update(self, 'f1', '0.5*dt')
+        for substep in range(nsubsteps):
+            _add_velocity_update(self, fast_forces, '0.5*%s' % h)
+            _add_position_update(self, '0.5*%s' % h)
+            self.addComputePerDof('v', 'a*v + b*sqrt(kT/m)*gaussian')
+            self.addConstrainVelocities()
+            _add_position_update(self, '0.5*%s' % h)
+            _add_velocity_update(self, fast_forces, '0.5*%s' % h)
+        _add_velocity_update(self, 'f1', '0.5*dt')
+
+    def getTemperature(self):
+        """Return the temperature of the heat bath."""
+        return self.getGlobalVariableByName('kT') * unit.kilojoules_per_mole / kB
+
+    def setTemperature(self, temperature):
+        """Set the temperature of the heat bath."""
+        self.setGlobalVariableByName('kT', (kB * temperature).value_in_unit(unit.kilojoules_per_mole))
+
+
+def _add_velocity_update(integrator, force, fraction):
+    """Add a constrained velocity update with the given force and fraction of dt."""
+    integrator.addComputePerDof('v', 'v + %s*%s/m' % (fraction, force))
+    integrator.addConstrainVelocities()
+
+
+def _add_position_update(integrator, fraction):
+    """Add a constrained position update with the given fraction of dt."""
+    integrator.addComputePerDof('x', 'x + %s*v' % fraction)
+    integrator.addComputePerDof('x1', 'x')
+    integrator.addConstrainPositions()
+    integrator.addComputePerDof('v', 'v + (x - x1)/(%s)' % fraction)
+
+#=============================================================================================
+# Integrator factory
+#=============================================================================================
+
+INTEGRATOR_TYPES = ['langevin', 'baoab', 'mts-langevin']
+
+
+def assign_mts_force_groups(system):
+    """
+    Assign nonbonded forces to the slow force group (1) and all other forces to group 0.
+
+    If any force is not in the default group 0, the force groups are assumed to have been
+    assigned by the user and the system is left unchanged. In this case, group 1 is still
+    treated as the slow group and all other groups as fast (see get_mts_fast_force_groups()).
+
+    Parameters
+    ----------
+    system : simtk.openmm.System
+       The system to modify.
+
+    Returns
+    -------
+    assigned : bool
+       False if the system already had custom force groups and was not modified.
+
+    """
+    forces = system.getForces()
+    if any(force.getForceGroup() != 0 for force in forces):
+        return False
+    for force in forces:
+        if force.__class__.__name__ in MTS_SLOW_FORCES:
+            force.setForceGroup(1)
+    return True
+
+
+def get_mts_fast_force_groups(system):
+    """
+    Return the force groups that MTSLangevinIntegrator must integrate in its inner steps.
+
+    These are all the force groups used by the system except for the slow force group 1.
+
+    Parameters
+    ----------
+    system : simtk.openmm.System
+       The system that will be integrated.
+
+    Returns
+    -------
+    fast_force_groups : list of int
+       The sorted force groups of the system other than 1.
+
+    """
+    return sorted(set(force.getForceGroup() for force in system.getForces()) - set([1]))
+
+
+def check_hydrogen_mass_repartitioning(system, timestep):
+    """
+    Warn if the timestep is too large for the masses of the light atoms in the system.
+
+    Timesteps larger than 2 fs are stable only when hydrogen masses are repartitioned.
+    Light atoms in rigid water are ignored since their angles are constrained.
+
+    Parameters
+    ----------
+    system : simtk.openmm.System
+       The system to check.
+    timestep : simtk.unit.Quantity with units compatible with femtoseconds
+       The integration timestep.
+
+    Returns
+    -------
+    safe : bool
+       False if the system contains light atoms in unconstrained angles.
+
+    """
+    if timestep <= MAX_TIMESTEP_WITHOUT_HMR:
+        return True
+
+    light_particles = set(particle_index for particle_index in range(system.getNumParticles())
+                          if 0.0 * unit.amu < system.getParticleMass(particle_index) < LIGHT_PARTICLE_MASS)
+    for force in system.getForces():
+        if not isinstance(force, openmm.HarmonicAngleForce):
+            continue
+        for angle_index in range(force.getNumAngles()):
+            particles = force.getAngleParameters(angle_index)[:3]
+            if any(particle_index in light_particles for particle_index in particles):
+                logger.warning("Timestep %s is larger than %s but the system contains atoms lighter than %s. "
+                               "Consider using hydrogen mass repartitioning (e.g. 'hydrogen_mass: 4 * amu')."
+                               % (str(timestep), str(MAX_TIMESTEP_WITHOUT_HMR), str(LIGHT_PARTICLE_MASS)))
+                return False
+
+    return True
+
+
+def create_integrator(integrator_type, temperature, collision_rate, timestep, mts_substeps=4,
+                      mts_fast_force_groups=(0,)):
+    """
+    Create an integrator of the given type.
+
+    Parameters
+    ----------
+    integrator_type : str
+       One of INTEGRATOR_TYPES. 'langevin' is the OpenMM LangevinIntegrator, 'baoab'
+       is BAOABLangevinIntegrator, and 'mts-langevin' is MTSLangevinIntegrator.
+    temperature : simtk.unit.Quantity with units compatible with kelvin
+       The temperature of the heat bath.
+    collision_rate : simtk.unit.Quantity with units compatible with 1/picoseconds
+       The collision rate.
+    timestep : simtk.unit.Quantity with units compatible with femtoseconds
+       The integration timestep.
+    mts_substeps : int, optional, default=4
+       The number of inner steps for the 'mts-langevin' integrator.
+    mts_fast_force_groups : list of int, optional, default=(0,)
+       The force groups integrated in the inner steps of the 'mts-langevin' integrator.
+
+    Returns
+    -------
+    integrator : simtk.openmm.Integrator
+       The new integrator. The force groups of the system must be assigned with
+       assign_mts_force_groups() and mts_fast_force_groups obtained with
+       get_mts_fast_force_groups() before using an 'mts-langevin' integrator.
+
+    """
+    if integrator_type == 'langevin':
+        return openmm.LangevinIntegrator(temperature, collision_rate, timestep)
+    elif integrator_type == 'baoab':
+        return BAOABLangevinIntegrator(temperature, collision_rate, timestep)
+    elif integrator_type == 'mts-langevin':
+        return MTSLangevinIntegrator(temperature, collision_rate, timestep, mts_substeps,
+                                     fast_force_groups=mts_fast_force_groups)
+    raise ValueError("Unknown integrator type '%s'. Valid types are %s." % (integrator_type, ', '.join(INTEGRATOR_TYPES)))
@@ -63,6 +63,10 @@ import os, os.path
 import math
 import copy
 import time
+import zlib
+import uuid
+import hashlib
+import collections
 import datetime
 import logging
 
@@ -70,7 +74,9 @@ import numpy as np
 import mdtraj as md
 import netCDF4 as netcdf
 
-from .utils import is_terminal_verbose, delayed_termination
+from .utils import (is_terminal_verbose, delay_termination, delayed_termination, handle_termination, catch_stop_signals, mpi_allgather_rows,
+                    mpi_gather_rows, get_node_communicator, allocate_shared_array, TRAJECTORY_FILE_SUFFIX)
+from . import mcmc
 
 logger = logging.getLogger(__name__)
 
@@ -84,6 +90,36 @@ kB = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA # Boltzmann constant
 #MAX_SEED = 4294967 # maximum seed for OpenMM setRandomNumberSeed
 MAX_SEED = 2**31 - 1 # maximum seed for OpenMM setRandomNumberSeed
 
+MAX_CHUNK_BYTES = 2**20 # maximum size of the chunks of the per-iteration NetCDF variables
+
+# NetCDF datatypes of the fixed-precision encodings of the stored positions.
+POSITIONS_INTEGER_ENCODINGS = {'int32': 'i4', 'int16': 'i2'}
+
+# NetCDF variable-length type of the zlib-compressed serialized Systems.
+COMPRESSED_SYSTEM_TYPE = 'compressed_system'
+SYSTEM_COMPRESSION_LEVEL = 6
+
+# Maximum number of store files whose restored states, options and metadata are kept in memory to speed up resume.
+MAX_RESUME_CACHE_SIZE = 8
+
+# Policies to assign replicas to MPI nodes.
+MPI_REPLICA_ASSIGNMENTS = ['balanced', 'round-robin']
+
+# Weight of the last iteration in the moving average of the propagation time of each state.
+PROPAGATION_COST_SMOOTHING = 0.3
+
+# Activities whose duration is recorded for each MPI process in timings/rank_timings.
+RANK_TIMINGS = ['propagate', 'energy', 'communication', 'io', 'idle']
+
+# Time the process has been running is measured for walltime_limit from the import of this module.
+PROCESS_START_TIME = time.time()
+
+# Multiple of the longest iteration time that must remain before walltime_limit to start a new iteration.
+WALLTIME_ITERATION_MARGIN = 1.5
+
+# Exit status of a simulation stopped before completion that can be resumed (EX_TEMPFAIL).
+RESUMABLE_EXIT_CODE = 75
+
 #=============================================================================================
 # Exceptions
 #=============================================================================================
@@ -102,6 +138,482 @@ class ParameterException(Exception):
     """
     pass
 
+class SimulationInterrupted(Exception):
+    """
+    Exception denoting that the simulation was stopped cleanly before completion and can be resumed.
+
+    """
+    pass
+
+#=============================================================================================
+# NetCDF storage layout
+#=============================================================================================
+
+def compute_netcdf_chunksizes(dimensions, shape, itemsize, chunk_iterations):
+    """
+    Return the chunk shape of a variable in the store file layout.
+
+    Variables holding per-atom data are chunked by single iterations and replicas, so that
+    appending an iteration and reading the trajectory of a replica touch only the data needed.
+    The other per-iteration variables are chunked in blocks of chunk_iterations iterations, so
+    that reading a whole time series requires few read operations. Chunks are capped at
+    MAX_CHUNK_BYTES to fit the HDF5 chunk cache while they are being filled.
+
+    Parameters
+    ----------
+    dimensions : tuple of str
+       The names of the dimensions of the variable.
+    shape : tuple of int
+       The sizes of the dimensions. The size of the 'iteration' dimension is ignored.
+    itemsize : int
+       The size in bytes of an element of the variable.
+    chunk_iterations : int
+       The maximum number of iterations in a chunk.
+
+    Returns
+    -------
+    chunksizes : tuple of int or None
+       The chunk shape, or None if the variable does not have an 'iteration' dimension.
+
+    Examples
+    --------
+    >>> compute_netcdf_chunksizes(('iteration', 'replica', 'atom', 'spatial'), (0, 10, 2000, 3), 4, 64)
+    (1, 1, 2000, 3)
+    >>> compute_netcdf_chunksizes(('iteration', 'replica', 'replica'), (0, 10, 10), 8, 64)
+    (64, 10, 10)
+
+    """
+    if len(dimensions) == 0 or dimensions[0] != 'iteration':
+        return None
+
+    chunksizes = [1] + list(shape[1:])
+    if ('atom' in dimensions) or ('trajectory_atom' in dimensions):
+        if len(dimensions) > 1 and dimensions[1] == 'replica':
+            chunksizes[1] = 1
+        return tuple(chunksizes)
+
+    iteration_bytes = itemsize * int(np.prod(chunksizes))
+    chunksizes[0] = int(max(1, min(chunk_iterations, MAX_CHUNK_BYTES // max(iteration_bytes, 1))))
+    return tuple(chunksizes)
+
+def _get_netcdf_dimension_size(ncgrp, dimension_name):
+    """Return the size of a dimension defined in ncgrp or in one of its parents."""
+    while dimension_name not in ncgrp.dimensions:
+        ncgrp = ncgrp.parent
+    return len(ncgrp.dimensions[dimension_name])
+
+def _copy_netcdf_group(input_ncgrp, output_ncgrp, chunk_iterations, zlib, complevel, shuffle):
+    """Recursively copy dimensions, variables, attributes and subgroups, relayouting per-iteration variables."""
+    output_ncgrp.setncatts({name: input_ncgrp.getncattr(name) for name in input_ncgrp.ncattrs()})
+
+    for dimension_name, dimension in input_ncgrp.dimensions.items():
+        output_ncgrp.createDimension(dimension_name, None if dimension.isunlimited() else len(dimension))
+
+    for variable_name, input_ncvar in input_ncgrp.variables.items():
+        is_string = input_ncvar.dtype is str
+        datatype = input_ncvar.datatype
+        if isinstance(datatype, netcdf.VLType):
+            datatype = _get_netcdf_vltype(output_ncgrp, datatype.dtype, datatype.name)
+        attributes = {name: input_ncvar.getncattr(name) for name in input_ncvar.ncattrs() if name != '_FillValue'}
+        fill_value = input_ncvar.getncattr('_FillValue') if '_FillValue' in input_ncvar.ncattrs() else None
+        shape = tuple(_get_netcdf_dimension_size(input_ncgrp, dimension) for dimension in input_ncvar.dimensions)
+        itemsize = 8 if is_string else input_ncvar.dtype.itemsize
+        chunksizes = compute_netcdf_chunksizes(input_ncvar.dimensions, shape, itemsize, chunk_iterations)
+
+        if chunksizes is not None:
+            variable_zlib, variable_complevel, variable_shuffle = zlib and not is_string, complevel, shuffle
+        else:
+            # Keep the original layout of variables that are not written every iteration.
+            filters = input_ncvar.filters() or {}
+            variable_zlib = filters.get('zlib', False)
+            variable_complevel = filters.get('complevel', 4)
+            variable_shuffle = filters.get('shuffle', False)
+            chunking = input_ncvar.chunking()
+            if chunking != 'contiguous' and chunking is not None:
+                chunksizes = chunking
+
+        output_ncvar = output_ncgrp.createVariable(variable_name, datatype, input_ncvar.dimensions,
+                                                   zlib=variable_zlib, complevel=variable_complevel,
+                                                   shuffle=variable_shuffle, chunksizes=chunksizes,
+                                                   fill_value=fill_value)
+        output_ncvar.setncatts(attributes)
+
+        # Copy data, in blocks of iterations to limit memory usage.
+        if len(input_ncvar.dimensions) == 0:
+            output_ncvar.assignValue(input_ncvar.getValue())
+        elif input_ncvar.dimensions[0] == 'iteration':
+            niterations = input_ncvar.shape[0]
+            for start in range(0, niterations, chunksizes[0]):
+                end = min(start + chunksizes[0], niterations)
+                output_ncvar[start:end] = input_ncvar[start:end]
+        else:
+            output_ncvar[:] = input_ncvar[:]
+
+    for group_name, input_subgroup in input_ncgrp.groups.items():
+        output_subgroup = output_ncgrp.createGroup(group_name)
+        _copy_netcdf_group(input_subgroup, output_subgroup, chunk_iterations, zlib, complevel, shuffle)
+
+def migrate_netcdf_layout(input_filename, output_filename, chunk_iterations=64, zlib=True, complevel=4, shuffle=True):
+    """
+    Rewrite a store file into a new file with the chunking and compression of the current layout.
+
+    All groups, variables, attributes and fill values are copied. Per-iteration variables are
+    rechunked with compute_netcdf_chunksizes() and optionally compressed, while the other variables
+    keep their original layout. If positions are stored in a separate trajectory file, this is
+    migrated too, into the same relative directory of the new store file, and linked to it.
+
+    Parameters
+    ----------
+    input_filename : str
+       Path to the store file to migrate.
+    output_filename : str
+       Path to the new store file. This must not exist.
+    chunk_iterations : int, optional, default=64
+       The maximum number of iterations in a chunk (see ReplicaExchange.storage_chunk_iterations).
+    zlib : bool, optional, default=True
+       If True, per-iteration variables are compressed with zlib.
+    complevel : int, optional, default=4
+       The zlib compression level between 1 and 9.
+    shuffle : bool, optional, default=True
+       If True, the HDF5 shuffle filter is applied before compression.
+
+    """
+    if os.path.exists(output_filename):
+        raise RuntimeError("File %s already exists; cowardly refusing to overwrite." % output_filename)
+
+    input_ncfile = netcdf.Dataset(input_filename, 'r')
+    try:
+        # Determine where the trajectory file of the new store file goes.
+        input_trajectory_filename = None
+        if 'trajectory_file' in input_ncfile.ncattrs():
+            input_trajectory_filename = get_trajectory_filename(input_ncfile, input_filename)
+            if not os.path.exists(input_trajectory_filename):
+                raise RuntimeError("Cannot find the trajectory file %s of %s." % (input_trajectory_filename, input_filename))
+            output_directory = os.path.dirname(os.path.abspath(output_filename))
+            output_trajectory_filename = os.path.join(output_directory, os.path.dirname(input_ncfile.trajectory_file),
+                                                      os.path.splitext(os.path.basename(output_filename))[0] + TRAJECTORY_FILE_SUFFIX)
+            if os.path.exists(output_trajectory_filename):
+                raise RuntimeError("File %s already exists; cowardly refusing to overwrite." % output_trajectory_filename)
+
+        output_ncfile = netcdf.Dataset(output_filename, 'w', version='NETCDF4')
+        try:
+            _copy_netcdf_group(input_ncfile, output_ncfile, chunk_iterations, zlib, complevel, shuffle)
+            if input_trajectory_filename is not None:
+                setattr(output_ncfile, 'trajectory_file', os.path.relpath(output_trajectory_filename, output_directory))
+        finally:
+            output_ncfile.close()
+    finally:
+        input_ncfile.close()
+
+    # Migrate the trajectory file and link it to the new store file. The UUID is copied with the store file.
+    if input_trajectory_filename is not None:
+        if not os.path.isdir(os.path.dirname(output_trajectory_filename)):
+            os.makedirs(os.path.dirname(output_trajectory_filename))
+        input_ncfile = netcdf.Dataset(input_trajectory_filename, 'r')
+        output_ncfile = netcdf.Dataset(output_trajectory_filename, 'w', version='NETCDF4')
+        try:
+            _copy_netcdf_group(input_ncfile, output_ncfile, chunk_iterations, zlib, complevel, shuffle)
+            setattr(output_ncfile, 'store_file', os.path.relpath(os.path.abspath(output_filename),
+                                                                 os.path.dirname(output_trajectory_filename)))
+        finally:
+            input_ncfile.close()
+            output_ncfile.close()
+
+def _get_netcdf_vltype(ncgrp, dtype, name):
+    """Return the variable-length type with the given name, creating it in the root group if needed."""
+    root_ncgrp = ncgrp
+    while root_ncgrp.parent is not None:
+        root_ncgrp = root_ncgrp.parent
+    if name not in root_ncgrp.vltypes:
+        root_ncgrp.createVLType(dtype, name)
+    return root_ncgrp.vltypes[name]
+
+def store_serialized_systems(ncgrp, variable_name, dimensions, serialized_systems):
+    """
+    Store serialized OpenMM Systems compressed with zlib.
+
+    HDF5 filters do not apply to variable-length strings, so the XML is compressed before
+    being stored as a variable-length array of bytes.
+
+    Parameters
+    ----------
+    ncgrp : netCDF4.Group
+       The group in which to create the variable.
+    variable_name : str
+       The name of the new variable.
+    dimensions : tuple of str
+       The dimensions of the new variable, with size len(serialized_systems).
+    serialized_systems : list of str
+       The XML serialization of the systems.
+
+    Returns
+    -------
+    ncvar : netCDF4.Variable
+       The new variable.
+
+    """
+    compressed_system_type = _get_netcdf_vltype(ncgrp, np.uint8, COMPRESSED_SYSTEM_TYPE)
+    ncvar = ncgrp.createVariable(variable_name, compressed_system_type, dimensions)
+    setattr(ncvar, 'compression', 'zlib')
+    for index, serialized in enumerate(serialized_systems):
+        compressed = zlib.compress(serialized.encode('utf-8'), SYSTEM_COMPRESSION_LEVEL)
+        logger.debug("Compressed serialized system from %.3f MB to %.3f MB" % (len(serialized) / 1024.0**2, len(compressed) / 1024.0**2))
+        ncvar[index] = np.frombuffer(compressed, dtype=np.uint8)
+    return ncvar
+
+def load_serialized_system(ncvar, index=0):
+    """
+    Read a serialized OpenMM System stored with store_serialized_systems().
+
+    Uncompressed XML strings stored by previous versions are also supported.
+
+    Parameters
+    ----------
+    ncvar : netCDF4.Variable
+       The variable storing the systems.
+    index : int, optional, default=0
+       The index of the system in the variable.
+
+    Returns
+    -------
+    serialized : str
+       The XML serialization of the system, which can be passed to System.__setstate__().
+
+    """
+    return _decode_serialized_system(ncvar[index])
+
+def _decode_serialized_system(data):
+    """Return the XML of a system stored either as a compressed array of bytes or as a string."""
+    if not isinstance(data, np.ndarray):
+        return str(data)
+    serialized = zlib.decompress(np.asarray(data, dtype=np.uint8).tobytes())
+    if not isinstance(serialized, str): # Python 3
+        serialized = serialized.decode('utf-8')
+    return serialized
+
+class _LazySystemLoader(object):
+    """Callable deserializing a stored System the first time it is called (see lazy_system_loader())."""
+
+    def __init__(self, data, system_class):
+        self._data = data
+        self._system_class = system_class
+        self._system = None
+
+    def __call__(self):
+        if self._system is None:
+            self._system = self._system_class()
+            self._system.__setstate__(_decode_serialized_system(self._data))
+        return self._system
+
+    def __deepcopy__(self, memo):
+        # The stored data is never modified, so copies can share it and still deserialize their own System.
+        loader = _LazySystemLoader(self._data, self._system_class)
+        if self._system is not None:
+            loader._system = copy.deepcopy(self._system, memo)
+        return loader
+
+def lazy_system_loader(ncvar, index=0, system_class=openmm.System):
+    """
+    Return a function deserializing a stored System the first time it is called.
+
+    Only the stored data is read immediately, so the file can be closed before the
+    System is needed. Later calls return the same System object. A deep copy of the
+    function deserializes a new System instead.
+
+    Parameters
+    ----------
+    ncvar : netCDF4.Variable
+       The variable storing the systems.
+    index : int, optional, default=0
+       The index of the system in the variable.
+    system_class : type, optional, default=simtk.openmm.System
+       The class of the System to create.
+
+    Returns
+    -------
+    load_system : function
+       A function without arguments returning the System.
+
+    """
+    return _LazySystemLoader(ncvar[index], system_class)
+
+def get_trajectory_filename(ncfile, store_filename):
+    """
+    Return the path of the file storing the positions of a store file.
+
+    Parameters
+    ----------
+    ncfile : netCDF4.Dataset
+       The open store file.
+    store_filename : str
+       The path of the store file.
+
+    Returns
+    -------
+    trajectory_filename : str
+       The path of the linked trajectory file, or store_filename if positions are stored in the store file.
+
+    """
+    if 'trajectory_file' not in ncfile.ncattrs():
+        return store_filename
+    return os.path.join(os.path.dirname(os.path.abspath(store_filename)), ncfile.trajectory_file)
+
+def open_trajectory_file(ncfile, store_filename, mode='r'):
+    """
+    Open the file storing the positions of a store file.
+
+    Parameters
+    ----------
+    ncfile : netCDF4.Dataset
+       The open store file.
+    store_filename : str
+       The path of the store file.
+    mode : str, optional, default='r'
+       The mode used to open the trajectory file if this is separate from the store file.
+
+    Returns
+    -------
+    trajectory_ncfile : netCDF4.Dataset
+       The trajectory file, or ncfile itself if positions are stored in the store file.
+
+    """
+    if 'trajectory_file' not in ncfile.ncattrs():
+        return ncfile
+    trajectory_filename = get_trajectory_filename(ncfile, store_filename)
+    if not os.path.exists(trajectory_filename):
+        raise RuntimeError("Cannot find the trajectory file %s of %s." % (trajectory_filename, store_filename))
+    trajectory_ncfile = netcdf.Dataset(trajectory_filename, mode)
+    if getattr(trajectory_ncfile, 'store_file_UUID', None) != getattr(ncfile, 'UUID', None):
+        trajectory_ncfile.close()
+        raise RuntimeError("Trajectory file %s does not belong to %s." % (trajectory_filename, store_filename))
+    return trajectory_ncfile
+
+#=============================================================================================
+# MPI load balancing
+#=============================================================================================
+
+def compute_load_imbalance(replica_costs, replica_assignment, nnodes):
+    """
+    Return the relative excess of the most loaded node over the average load.
+
+    Parameters
+    ----------
+    replica_costs : array of float
+       replica_costs[i] is the (predicted) propagation time of replica i.
+    replica_assignment : array of int
+       replica_assignment[i] is the node handling replica i.
+    nnodes : int
+       The number of nodes.
+
+    Returns
+    -------
+    imbalance : float
+       max(loads) / mean(loads) - 1, which is 0 when the load is perfectly balanced.
+
+    """
+    loads = np.bincount(replica_assignment, weights=replica_costs, minlength=nnodes)
+    mean_load = loads.sum() / nnodes
+    if mean_load <= 0.0:
+        return 0.0
+    return loads.max() / mean_load - 1.0
+
+def balance_replica_assignment(replica_costs, replica_assignment, nnodes, tolerance=0.0):
+    """
+    Distribute replicas among nodes to balance their load, moving as few replicas as possible.
+
+    Replicas are considered by decreasing cost. A replica stays on its current node if the node
+    load does not exceed the average load by more than tolerance. The remaining replicas are
+    then assigned to the least loaded node (longest processing time first scheduling).
+
+    Parameters
+    ----------
+    replica_costs : array of float
+       replica_costs[i] is the (predicted) propagation time of replica i.
+    replica_assignment : array of int
+       replica_assignment[i] is the node currently handling replica i.
+    nnodes : int
+       The number of nodes.
+    tolerance : float, optional, default=0.0
+       The relative load excess allowed to keep a replica on its current node.
+
+    Returns
+    -------
+    new_assignment : numpy.ndarray of int
+       new_assignment[i] is the node that will handle replica i.
+
+    """
+    replica_costs = np.asarray(replica_costs, np.float64)
+    max_load = replica_costs.sum() / nnodes * (1.0 + tolerance)
+    order = np.argsort(-replica_costs, kind='mergesort')
+    new_assignment = np.zeros(len(replica_costs), np.int64) - 1
+    loads = np.zeros([nnodes], np.float64)
+
+    # Keep replicas on their node while it is not overloaded.
+    for replica_index in order:
+        node = replica_assignment[replica_index]
+        if 0 <= node < nnodes and loads[node] + replica_costs[replica_index] <= max_load:
+            new_assignment[replica_index] = node
+            loads[node] += replica_costs[replica_index]
+
+    # Move the others to the least loaded nodes.
+    for replica_index in order:
+        if new_assignment[replica_index] == -1:
+            node = int(np.argmin(loads))
+            new_assignment[replica_index] = node
+            loads[node] += replica_costs[replica_index]
+
+    return new_assignment
+
+
+class SharedReplicaQuantities(object):
+    """
+    List-like container of per-replica Quantities (e.g. positions) stored in a single array.
+
+    Items are returned as Quantities wrapping views of the array, and assigned items are copied
+    into it, so that the array can live in memory shared by the MPI processes of a node (see
+    utils.allocate_shared_array()).
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+       array[i] holds the unitless value of the quantity of replica i.
+    quantity_unit : simtk.unit.Unit
+       The unit of the values in array.
+    allow_none : bool, optional, default=False
+       If True, None can be assigned to items. This is encoded as NaN in array.
+
+    Examples
+    --------
+    >>> positions = SharedReplicaQuantities(np.zeros([2, 3, 3]), unit.nanometers)
+    >>> positions[1] = unit.Quantity(np.ones([3, 3]), unit.angstroms)
+    >>> float(positions[1][0,0] / unit.nanometers)
+    0.1
+
+    """
+
+    def __init__(self, array, quantity_unit, allow_none=False):
+        self._array = array
+        self._unit = quantity_unit
+        self._allow_none = allow_none
+
+    def __len__(self):
+        return len(self._array)
+
+    def __getitem__(self, replica_index):
+        if self._allow_none and np.isnan(self._array[replica_index].flat[0]):
+            return None
+        return unit.Quantity(self._array[replica_index], self._unit)
+
+    def __setitem__(self, replica_index, value):
+        if value is None and self._allow_none:
+            self._array[replica_index] = np.nan
+        else:
+            self._array[replica_index] = np.asarray(value.value_in_unit(self._unit))
+
+    def __iter__(self):
+        for replica_index in range(len(self)):
+            yield self[replica_index]
+
 #=============================================================================================
 # Thermodynamic state description
 #=============================================================================================
@@ -155,6 +667,7 @@ class ThermodynamicState(object):
         """
 
         # Initialize.
+        self._system_loader = None  # function returning the System, if this is deserialized lazily
         self.system = None          # the System object governing the potential energy computation
         self.temperature = None     # the temperature
         self.pressure = None        # the pressure, or None if not isobaric
@@ -169,6 +682,51 @@ class ThermodynamicState(object):
 
         return
 
+    @property
+    def system(self):
+        """
+        The System object governing the potential energy computation.
+
+        If a loader was set with set_system_loader(), the System is deserialized on first access.
+        """
+        if self._system_loader is not None:
+            self._system = self._system_loader()
+            self._system_loader = None
+        return self._system
+
+    @system.setter
+    def system(self, system):
+        self._system = system
+        self._system_loader = None
+
+    def set_system_loader(self, system_loader):
+        """
+        Set a function returning the System, which is called only when the System is first accessed.
+
+        Parameters
+        ----------
+        system_loader : function
+           A function without arguments returning a simtk.openmm.System (see lazy_system_loader()).
+
+        """
+        self._system = None
+        self._system_loader = system_loader
+
+    def __getstate__(self):
+        # Load the System before pickling since loaders cannot be pickled.
+        state = self.__dict__.copy()
+        state['_system'] = self.system
+        state['_system_loader'] = None
+        return state
+
+    def __deepcopy__(self, memo):
+        # Copy the loader rather than the System so that deep copies are still deserialized lazily.
+        state = ThermodynamicState.__new__(self.__class__)
+        memo[id(self)] = state
+        for name, value in self.__dict__.items():
+            state.__dict__[name] = copy.deepcopy(value, memo)
+        return state
+
     @property
     def kT(self):
         """
@@ -442,6 +1000,12 @@ class ThermodynamicState(object):
 # Replica-exchange simulation
 #=============================================================================================
 
+# _resume_cache[(class name, store path, file UUID)] is the tuple (signature, (options, metadata, attributes)),
+# where signature summarizes the file when it was cached and the values restored from the store file are
+# copied, attributes being the values of ReplicaExchange._resume_cache_attributes.
+_resume_cache = collections.OrderedDict()
+
+
 class ReplicaExchange(object):
     """
     Replica-exchange simulation facility.
@@ -488,6 +1052,9 @@ class ReplicaExchange(object):
        Set minimization tolerance (default: 1.0 * unit.kilojoules_per_mole / unit.nanometers).
     minimize_max_iterations : int
        Maximum number of iterations for minimization.
+    minimize_relaxation_max_iterations : int
+       Maximum number of iterations used to relax a replica that shares its starting configuration
+       with a replica already minimized in a state with a different potential (default: 100).
     replica_mixing_scheme : str
        Specify how to mix replicas. Supported schemes are 'swap-neighbors' and
        'swap-all' (default: 'swap-all').
@@ -499,10 +1066,83 @@ class ReplicaExchange(object):
        If True, will print energies at each iteration (default: True).
     show_mixing_statistics : bool
        If True, will show mixing statistics at each iteration (default: True).
+    integrator_type : str
+       Integrator used to propagate dynamics. One of 'langevin', 'baoab' and 'mts-langevin'
+       (default: 'langevin'). See the mcmc module for details.
+    mts_substeps : int
+       Number of inner steps for fast forces when integrator_type is 'mts-langevin' (default: 4).
+    persist_velocities : bool
+       If True, the velocities of each replica are kept between iterations, and rescaled when a swap
+       changes the temperature, instead of being redrawn from the Maxwell-Boltzmann distribution at every
+       iteration. Velocities are stored in the 'checkpoint' group of the store file (default: False).
+    positions_write_interval : int
+       Positions are written to the store file every positions_write_interval iterations. Energies and
+       the other per-iteration data are always written every iteration (default: 1).
+    positions_atom_indices : list of int
+       If specified, only the positions of these atoms are written to the store file. The positions of
+       all atoms needed to resume the simulation are kept in the 'checkpoint' group (default: None).
+    storage_chunk_iterations : int
+       Maximum number of iterations in a chunk of the per-iteration variables of the store file that
+       do not hold per-atom data. See compute_netcdf_chunksizes() for details (default: 64).
+    storage_zlib : bool
+       If True, the per-iteration variables are compressed with zlib (default: True).
+    storage_complevel : int
+       The zlib compression level between 1 and 9 (default: 4).
+    storage_shuffle : bool
+       If True, the HDF5 shuffle filter is applied before compression (default: True).
+    positions_precision : simtk.unit.Quantity (units: length)
+       Precision of the positions stored in the trajectory. If 0, positions are stored without loss
+       as float32 (default: 0 nm).
+    positions_encoding : str
+       Encoding of the stored positions. With 'float', positions are stored as float32 quantized to
+       positions_precision through the NetCDF least_significant_digit mechanism. With 'int32' and
+       'int16', positions are stored as integer multiples of positions_precision, which is saved in
+       the scale_factor attribute of the variable so that NetCDF readers transparently decode them.
+       'int16' can represent coordinates only within +-32766 * positions_precision (default: 'float').
+    storage_sync_interval : int
+       The store file is flushed to disk every storage_sync_interval iterations. 0 disables this
+       criterion (default: 1).
+    storage_sync_seconds : float
+       The store file is flushed to disk if at least storage_sync_seconds seconds have passed since
+       the last flush. 0 disables this criterion (default: 0).
+       The store file is always flushed at the end of run() and when SIGINT or SIGTERM are received.
+       Iterations written after the last flush may be lost in a crash and, since NetCDF4 files are
+       HDF5 files, a crash between two flushes can leave the file unreadable. Keep the default
+       storage_sync_interval of 1 when robustness is more important than I/O performance.
+    trajectory_directory : str
+       If not None, positions and the checkpoint group are stored in a separate trajectory file in this
+       directory, so that the store file holds only energies, states and metadata. Relative paths are
+       relative to the directory of the store file. The trajectory file is named after the store file
+       with the suffix '_trajectory.nc' and is linked to it through the store file attribute 'trajectory_file'
+       (default: None).
+    mpi_replica_assignment : str
+       How replicas are assigned to MPI nodes. With 'round-robin', states are distributed among nodes
+       in a round-robin fashion and each node propagates the replicas currently in its states, so
+       replicas change node after every swap. With 'balanced', replicas stay on the same node and are
+       redistributed only when the load predicted from the measured propagation time of their states
+       is unbalanced (default: 'balanced').
+    mpi_rebalance_threshold : float
+       With mpi_replica_assignment 'balanced', replicas are redistributed when the predicted load of
+       the most loaded node exceeds the average load by more than this fraction (default: 0.1).
+    max_replica_failure_retries : int
+       If the propagation of a replica raises an exception, the replica is rolled back to its configuration
+       before the propagation and retried at most this number of times. If all the attempts fail, the
+       replica keeps its previous configuration and is excluded from the next round of swaps, and the
+       failure is stored in the 'failures' variable of the NetCDF file (default: 2).
+    mpi_shared_memory : bool
+       If True, the positions, box vectors and persisted velocities of the replicas are stored in a
+       single copy per node in memory shared by its MPI processes, which exchange them without
+       communication. Only the processes on different nodes send configurations to each other
+       (default: False).
+    walltime_limit : simtk.unit.Quantity with units compatible with seconds
+       If not None, run() stops before starting an iteration that is not expected to complete before
+       this time has passed since the process started, estimated from the longest iteration of the run.
+       The last iteration is checkpointed and synced, and SimulationInterrupted is raised. The same
+       happens when one of utils.STOP_SIGNALS (e.g. SIGTERM or SIGUSR1 sent by the batch scheduler)
+       is received (default: None).
 
     TODO
     ----
-    * Replace hard-coded Langevin dynamics with general MCMC moves.
     * Allow parallel resource to be used, if available (likely via Parallel Python).
     * Add support for and autodetection of other NetCDF4 interfaces.
     * Add HDF5 support.
@@ -560,15 +1200,38 @@ class ReplicaExchange(object):
                           'minimize': True,
                           'minimize_tolerance': 1.0 * unit.kilojoules_per_mole / unit.nanometers,
                           'minimize_max_iterations': 0,
+                          'minimize_relaxation_max_iterations': 100,
                           'replica_mixing_scheme': 'swap-all',
                           'online_analysis': False,
                           'online_analysis_min_iterations': 20,
                           'show_energies': True,
-                          'show_mixing_statistics': True
+                          'show_mixing_statistics': True,
+                          'integrator_type': 'langevin',
+                          'mts_substeps': 4,
+                          'persist_velocities': False,
+                          'positions_write_interval': 1,
+                          'positions_atom_indices': None,
+                          'storage_chunk_iterations': 64,
+                          'storage_zlib': True,
+                          'storage_complevel': 4,
+                          'storage_shuffle': True,
+                          'positions_precision': 0.0 * unit.nanometers,
+                          'positions_encoding': 'float',
+                          'storage_sync_interval': 1,
+                          'storage_sync_seconds': 0.0,
+                          'trajectory_directory': None,
+                          'mpi_replica_assignment': 'balanced',
+                          'mpi_rebalance_threshold': 0.1,
+                          'max_replica_failure_retries': 2,
+                          'mpi_shared_memory': False,
+                          'walltime_limit': None
                           }
 
+    # Attributes restored by _restore_thermodynamic_states() that are kept in the resume cache.
+    _resume_cache_attributes = ['states', 'nstates']
+
     # Options to store.
-    options_to_store = ['collision_rate', 'constraint_tolerance', 'timestep', 'nsteps_per_iteration', 'number_of_iterations', 'equilibration_timestep', 'number_of_equilibration_iterations', 'title', 'minimize', 'replica_mixing_scheme', 'online_analysis', 'show_mixing_statistics']
+    options_to_store = ['collision_rate', 'constraint_tolerance', 'timestep', 'nsteps_per_iteration', 'number_of_iterations', 'equilibration_timestep', 'number_of_equilibration_iterations', 'title', 'minimize', 'replica_mixing_scheme', 'online_analysis', 'show_mixing_statistics', 'integrator_type', 'mts_substeps', 'persist_velocities', 'positions_write_interval', 'storage_chunk_iterations', 'storage_zlib', 'storage_complevel', 'storage_shuffle', 'positions_precision', 'positions_encoding', 'storage_sync_interval', 'storage_sync_seconds', 'trajectory_directory']
 
     def __init__(self, store_filename, mpicomm=None, platform=None, mm=None, **kwargs):
         """
@@ -616,6 +1279,9 @@ class ReplicaExchange(object):
         # Record store file filename
         self.store_filename = store_filename
 
+        # Time spent in each step of resuming the simulation, filled by resume() and _initialize_resume().
+        self._resume_timings = collections.OrderedDict()
+
         # Check if netcdf file exists, assuming we want to resume if one exists.
         self._resume = os.path.exists(self.store_filename) and (os.path.getsize(self.store_filename) > 0)
         if self.mpicomm:
@@ -712,20 +1378,30 @@ class ReplicaExchange(object):
         if not file_exists:
             raise Exception("NetCDF file %s does not exist; cannot resume." % self.store_filename)
 
-        # Try to restore thermodynamic states and run options from the NetCDF file.
+        # Try to restore thermodynamic states and run options from the NetCDF file, or from the
+        # cache if this file was already resumed by this process.
+        self._resume_timings = collections.OrderedDict()
+        initial_time = time.time()
         ncfile = netcdf.Dataset(self.store_filename, 'r')
-        self._restore_thermodynamic_states(ncfile)
-        self._restore_options(ncfile)
-        self._restore_metadata(ncfile)
+        cache_key = self._get_resume_cache_key(ncfile)
+        if self._is_resume_cache_valid(cache_key, ncfile):
+            self._restore_from_resume_cache(cache_key)
+            self._resume_timings['cached states and options'] = time.time() - initial_time
+        else:
+            self._restore_thermodynamic_states(ncfile)
+            self._resume_timings['thermodynamic states'] = time.time() - initial_time
+            initial_time = time.time()
+            self._restore_options(ncfile)
+            self._restore_metadata(ncfile)
+            self._resume_timings['options and metadata'] = time.time() - initial_time
+            self._store_in_resume_cache(cache_key, ncfile)
         ncfile.close()
 
         # Determine number of replicas from the number of specified thermodynamic states.
         self.nreplicas = len(self.states)
 
-        # Check to make sure all states have the same number of atoms and are in the same thermodynamic ensemble.
-        for state in self.states:
-            if not state.is_compatible_with(self.states[0]):
-                raise ParameterError("Provided ThermodynamicState states must all be from the same thermodynamic ensemble.")
+        # The states were checked for compatibility when the simulation was created. Checking
+        # them again here would deserialize all the Systems that are loaded lazily.
 
         # Handle provided 'options' dict, replacing any options provided by caller in dictionary.
         # TODO: Check to make sure that only allowed overrides are specified.
@@ -738,6 +1414,87 @@ class ReplicaExchange(object):
 
         return
 
+    def _get_resume_cache_key(self, ncfile):
+        """
+        Return the key identifying the store file in the resume cache.
+
+        Files created by previous versions do not have a UUID, and they are never cached.
+
+        """
+        if 'UUID' not in ncfile.ncattrs():
+            return None
+        return (self.__class__.__name__, os.path.realpath(self.store_filename), ncfile.UUID)
+
+    @staticmethod
+    def _get_resume_cache_signature(ncfile):
+        """
+        Return a summary of the stored states and options used to check that a cached file was not modified.
+
+        Only small variables are read, so this is much faster than restoring the states.
+
+        """
+        ncgrp_stateinfo = ncfile.groups['thermodynamic_states']
+        variable_shapes = tuple(sorted((name, ncvar.shape) for name, ncvar in ncgrp_stateinfo.variables.items()))
+        temperatures = tuple(ncgrp_stateinfo.variables['temperatures'][:].tolist())
+        pressures = None
+        if 'pressures' in ncgrp_stateinfo.variables:
+            pressures = tuple(ncgrp_stateinfo.variables['pressures'][:].tolist())
+        option_names = tuple(sorted(ncfile.groups['options'].variables.keys()))
+        return (variable_shapes, temperatures, pressures, option_names)
+
+    def _is_resume_cache_valid(self, cache_key, ncfile):
+        """
+        Return True if the file is in the resume cache and the cached entry is still compatible with it.
+
+        Incompatible entries are removed from the cache.
+
+        """
+        if cache_key is None or cache_key not in _resume_cache:
+            return False
+        if _resume_cache[cache_key][0] != self._get_resume_cache_signature(ncfile):
+            logger.debug("Store file %s changed since it was cached; restoring it from file." % self.store_filename)
+            del _resume_cache[cache_key]
+            return False
+        return True
+
+    def _store_in_resume_cache(self, cache_key, ncfile):
+        """
+        Cache copies of the restored states, options and metadata for future resumes from the same file.
+
+        Parameters
+        ----------
+        cache_key : tuple
+           The key returned by _get_resume_cache_key(), or None if the file cannot be cached.
+        ncfile : netCDF4.Dataset
+           The open store file the states and options were restored from.
+
+        """
+        if cache_key is None:
+            return
+        signature = self._get_resume_cache_signature(ncfile)
+        options = {option_name: getattr(self, option_name) for option_name in signature[-1]}
+        attributes = {name: getattr(self, name) for name in self._resume_cache_attributes if hasattr(self, name)}
+        # Copy everything since integrators and barostats modify the Systems of the simulation.
+        _resume_cache[cache_key] = (signature, copy.deepcopy((options, self.metadata, attributes)))
+        while len(_resume_cache) > MAX_RESUME_CACHE_SIZE:
+            _resume_cache.popitem(last=False)
+
+    def _restore_from_resume_cache(self, cache_key):
+        """
+        Restore copies of the cached states, options and metadata.
+
+        Systems not yet deserialized in the cache are still deserialized lazily.
+
+        """
+        logger.debug("Restoring thermodynamic states and options of %s from cache..." % self.store_filename)
+        options, metadata, attributes = copy.deepcopy(_resume_cache[cache_key][1])
+        _resume_cache[cache_key] = _resume_cache.pop(cache_key) # mark as most recently used
+        for option_name, value in options.items():
+            setattr(self, option_name, value)
+        self.metadata = metadata
+        for name, value in attributes.items():
+            setattr(self, name, value)
+
     def __repr__(self):
         """
         Return a 'formal' representation that can be used to reconstruct the class, if possible.
@@ -786,9 +1543,9 @@ class ReplicaExchange(object):
         """
         status = dict()
 
-        status['number_of_iterations'] = ncfile.variables['positions'].shape[0]
-        status['nstates'] = ncfile.variables['positions'].shape[1]
-        status['natoms'] = ncfile.variables['positions'].shape[2]
+        status['number_of_iterations'] = ncfile.variables['states'].shape[0]
+        status['nstates'] = ncfile.variables['states'].shape[1]
+        status['natoms'] = len(ncfile.dimensions['atom'])
 
         return status
 
@@ -843,21 +1600,67 @@ class ReplicaExchange(object):
            If specfied, only at most the specified number of iterations will be run.
 
         """
-        if not self._initialized:
-            self._initialize_resume()
+        # Stop signals are recorded from the start, since resuming and equilibrating may take long.
+        with handle_termination(lambda: self._sync_netcdf(force=True)), catch_stop_signals() as stop_signals:
+            if not self._initialized:
+                self._initialize_resume()
+
+            # Log platform configuration
+            if self.platform is None:
+                logger.info('No user-specified platform found. Will run with OpenMM default.')
+            else:
+                logger.info('Running with platform {}'.format(self.platform.getName()))
+
+            # Main loop
+            run_start_time = time.time()
+            run_start_iteration = self.iteration
+            self._rank_timings_time = run_start_time
+            iteration_limit = self.number_of_iterations
+            if niterations_to_run:
+                iteration_limit = min(self.iteration + niterations_to_run, iteration_limit)
+            self._last_sync_iteration = self.iteration - 1
+            self._last_sync_time = run_start_time
+
+            # Stop before the first iteration if a stop was requested during the initialization.
+            stop_reason = None
+            if self.iteration < iteration_limit:
+                stop_reason = self._check_stop_request(stop_signals, 0.0)
+            if stop_reason is None:
+                stop_reason = self._run_iterations(iteration_limit, run_start_time, run_start_iteration, stop_signals)
 
-        # Log platform configuration
-        if self.platform is None:
-            logger.info('No user-specified platform found. Will run with OpenMM default.')
-        else:
-            logger.info('Running with platform {}'.format(self.platform.getName()))
-
-        # Main loop
-        run_start_time = time.time()
-        run_start_iteration = self.iteration
-        iteration_limit = self.number_of_iterations
-        if niterations_to_run:
-            iteration_limit = min(self.iteration + niterations_to_run, iteration_limit)
+        # Clean up and close storage files.
+        self._finalize()
+        if self.mpicomm:
+            self._release_shared_memory()
+
+        if stop_reason is not None:
+            raise SimulationInterrupted("Simulation stopped at iteration %d/%d (%s). It can be resumed from %s." %
+                                        (self.iteration, self.number_of_iterations, stop_reason, self.store_filename))
+
+        return
+
+    def _run_iterations(self, iteration_limit, run_start_time, run_start_iteration, stop_signals=()):
+        """
+        Run replica-exchange iterations until iteration_limit is reached.
+
+        Parameters
+        ----------
+        iteration_limit : int
+           The iteration at which to stop.
+        run_start_time : float
+           The time at which run() was called.
+        run_start_iteration : int
+           The iteration at which run() was called.
+        stop_signals : list of int, optional
+           The stop signals received so far (see utils.catch_stop_signals()).
+
+        Returns
+        -------
+        stop_reason : str or None
+           Why the run stopped before iteration_limit, or None if it was reached.
+
+        """
+        max_iteration_time = 0.0
         while (self.iteration < iteration_limit):
             logger.debug("\nIteration %d / %d" % (self.iteration+1, self.number_of_iterations))
             initial_time = time.time()
@@ -868,15 +1671,33 @@ class ReplicaExchange(object):
             # Propagate replicas.
             self._propagate_replicas()
 
-            # Compute energies of all replicas at all states.
+            # Compute energies of all replicas at all states. The communication time is recorded separately.
+            energies_start_time = time.time()
+            communication_time = self._communication_time
             self._compute_energies()
+            self._rank_timings['energy'] = time.time() - energies_start_time - (self._communication_time - communication_time)
 
             # Show energies.
             if self.show_energies:
                 self._show_energies()
 
-            # Write iteration to storage file.
-            self._write_iteration_netcdf()
+            # Complete the communications overlapped with the computation of energies.
+            if self.mpicomm:
+                self._complete_replica_gather()
+                self._collect_communication_time()
+
+            # Write iteration to storage file and flush it according to the sync policy. Termination
+            # signals are delayed until the file is consistent, since their handler flushes it.
+            # The time spent by each node in each activity is stored before the flush, so the time
+            # spent flushing is accounted to the next iteration.
+            io_start_time = time.time()
+            with delay_termination():
+                self._write_iteration_netcdf()
+                self._rank_timings['io'] += time.time() - io_start_time
+                self._store_rank_timings()
+                sync_start_time = time.time()
+                self._sync_netcdf()
+            self._rank_timings['io'] += time.time() - sync_start_time
 
             # Increment iteration counter.
             self.iteration += 1
@@ -902,10 +1723,47 @@ class ReplicaExchange(object):
             # Perform sanity checks to see if we should terminate here.
             self._run_sanity_checks()
 
-        # Clean up and close storage files.
-        self._finalize()
+            # Stop cleanly if the scheduler asked to or the next iteration may not fit in the walltime.
+            max_iteration_time = max(max_iteration_time, time.time() - initial_time)
+            if self.iteration < iteration_limit:
+                stop_reason = self._check_stop_request(stop_signals, max_iteration_time)
+                if stop_reason is not None:
+                    logger.warning("Stopping at iteration %d: %s." % (self.iteration, stop_reason))
+                    self._sync_netcdf(force=True)
+                    return stop_reason
 
-        return
+        return None
+
+    def _check_stop_request(self, stop_signals, max_iteration_time):
+        """
+        Return why the run must stop before the next iteration, or None if it can continue.
+
+        With MPI, this must be called by all nodes, and the run stops if any node requests it.
+
+        Parameters
+        ----------
+        stop_signals : list of int
+           The stop signals received so far.
+        max_iteration_time : float
+           The longest time taken by an iteration of this run (in seconds).
+
+        Returns
+        -------
+        stop_reason : str or None
+           A description of the reason to stop, or None.
+
+        """
+        stop_reason = None
+        if len(stop_signals) > 0:
+            stop_reason = 'received signal %d' % stop_signals[0]
+        elif self.walltime_limit is not None:
+            remaining_time = self.walltime_limit / unit.seconds - (time.time() - PROCESS_START_TIME)
+            if remaining_time < WALLTIME_ITERATION_MARGIN * max_iteration_time:
+                stop_reason = 'walltime limit %s would be exceeded' % str(self.walltime_limit)
+        if self.mpicomm:
+            stop_reasons = [reason for reason in self.mpicomm.allgather(stop_reason) if reason is not None]
+            stop_reason = stop_reasons[0] if len(stop_reasons) > 0 else None
+        return stop_reason
 
     def _initialize_create(self):
         """
@@ -935,9 +1793,28 @@ class ReplicaExchange(object):
         # Determine number of atoms in systems.
         self.natoms = representative_system.getNumParticles()
 
+        # Warn once if the timestep is too large for the hydrogen masses.
+        if (self.mpicomm is None) or (self.mpicomm.rank == 0):
+            mcmc.check_hydrogen_mass_repartitioning(representative_system, self.timestep)
+
         # Allocate storage.
         self.replica_positions = list() # replica_positions[i] is the configuration currently held in replica i
         self.replica_box_vectors = list() # replica_box_vectors[i] is the set of box vectors currently held in replica i
+        self.replica_velocities = [None] * self.nstates # replica_velocities[i] are the velocities of replica i or None if not persisted
+        self.replica_velocities_states = np.zeros([self.nstates], np.int64) # replica_velocities_states[i] is the state where replica_velocities[i] were generated
+        self._replica_nodes = np.zeros([self.nstates], np.int64) - 1 # _replica_nodes[i] is the node that last propagated replica i, or -1 if all nodes hold its configuration
+        self._replica_assignment = None # _replica_assignment[i] is the node that propagates replica i (see _update_replica_assignment())
+        self._state_propagation_costs = np.zeros([self.nstates], np.float64) + np.nan # moving average of the propagation time in each state
+        self._pending_replica_gather = None # configurations being sent to the root node (see _gather_replica_configurations())
+        self._communication_time = 0.0 # seconds spent waiting for MPI communication in this iteration
+        self._rank_timings = dict.fromkeys(RANK_TIMINGS, 0.0) # seconds spent by this node in each activity in this iteration
+        self._replica_propagation_times = np.zeros([self.nstates], np.float64) # seconds spent propagating each replica in this iteration
+        self._failed_replicas = np.zeros([self.nstates], np.bool_) # _failed_replicas[i] is True if all attempts to propagate replica i failed in the last iteration
+        self._node_comm = None # communicator of the MPI processes sharing the replica configurations (see _share_replica_configurations())
+        self._rank_nodes = None # _rank_nodes[rank] identifies the node of MPI process rank when configurations are shared
+        self._shared_memory_windows = list() # MPI windows owning the shared replica configurations
+        self._Nij_proposed_total = np.zeros([self.nstates, self.nstates], np.int64) # swaps proposed in all stored iterations
+        self._Nij_accepted_total = np.zeros([self.nstates, self.nstates], np.int64) # swaps accepted in all stored iterations
         self.replica_states     = np.zeros([self.nstates], np.int64) # replica_states[i] is the state that replica i is currently at
         self.u_kl               = np.zeros([self.nstates, self.nstates], np.float64)
         self.swap_Pij_accepted  = np.zeros([self.nstates, self.nstates], np.float64)
@@ -971,9 +1848,9 @@ class ReplicaExchange(object):
         # Store initial state.
         self._write_iteration_netcdf()
 
-        # Close NetCDF file.
-        self.ncfile.close()
-        self.ncfile = None
+        # Close NetCDF files.
+        if (self.mpicomm is None) or (self.mpicomm.rank == 0):
+            self._close_netcdf()
 
         return
 
@@ -1008,6 +1885,21 @@ class ReplicaExchange(object):
         # Allocate storage.
         self.replica_positions = list() # replica_positions[i] is the configuration currently held in replica i
         self.replica_box_vectors = list() # replica_box_vectors[i] is the set of box vectors currently held in replica i
+        self.replica_velocities = [None] * self.nstates # replica_velocities[i] are the velocities of replica i or None if not persisted
+        self.replica_velocities_states = np.zeros([self.nstates], np.int64) # replica_velocities_states[i] is the state where replica_velocities[i] were generated
+        self._replica_nodes = np.zeros([self.nstates], np.int64) - 1 # _replica_nodes[i] is the node that last propagated replica i, or -1 if all nodes hold its configuration
+        self._replica_assignment = None # _replica_assignment[i] is the node that propagates replica i (see _update_replica_assignment())
+        self._state_propagation_costs = np.zeros([self.nstates], np.float64) + np.nan # moving average of the propagation time in each state
+        self._pending_replica_gather = None # configurations being sent to the root node (see _gather_replica_configurations())
+        self._communication_time = 0.0 # seconds spent waiting for MPI communication in this iteration
+        self._rank_timings = dict.fromkeys(RANK_TIMINGS, 0.0) # seconds spent by this node in each activity in this iteration
+        self._replica_propagation_times = np.zeros([self.nstates], np.float64) # seconds spent propagating each replica in this iteration
+        self._failed_replicas = np.zeros([self.nstates], np.bool_) # _failed_replicas[i] is True if all attempts to propagate replica i failed in the last iteration
+        self._node_comm = None # communicator of the MPI processes sharing the replica configurations (see _share_replica_configurations())
+        self._rank_nodes = None # _rank_nodes[rank] identifies the node of MPI process rank when configurations are shared
+        self._shared_memory_windows = list() # MPI windows owning the shared replica configurations
+        self._Nij_proposed_total = np.zeros([self.nstates, self.nstates], np.int64) # swaps proposed in all stored iterations
+        self._Nij_accepted_total = np.zeros([self.nstates, self.nstates], np.int64) # swaps accepted in all stored iterations
         self.replica_states     = np.zeros([self.nstates], np.int32) # replica_states[i] is the state that replica i is currently at
         self.u_kl               = np.zeros([self.nstates, self.nstates], np.float64)
         self.swap_Pij_accepted  = np.zeros([self.nstates, self.nstates], np.float64)
@@ -1018,15 +1910,8 @@ class ReplicaExchange(object):
         if not self._resume:
             self.replica_positions = [ copy.deepcopy(self.provided_positions[replica_index % len(self.provided_positions)]) for replica_index in range(self.nstates) ]
 
-        # Assign default box vectors.
-        self.replica_box_vectors = list()
-        for state in self.states:
-            [a,b,c] = state.system.getDefaultPeriodicBoxVectors()
-            box_vectors = unit.Quantity(np.zeros([3,3], np.float32), unit.nanometers)
-            box_vectors[0,:] = a
-            box_vectors[1,:] = b
-            box_vectors[2,:] = c
-            self.replica_box_vectors.append(box_vectors)
+        # Box vectors are restored from the store file, so the Systems of the states, which
+        # may be deserialized lazily, are not accessed here.
 
         # Assign initial replica states.
         for replica_index in range(self.nstates):
@@ -1041,16 +1926,24 @@ class ReplicaExchange(object):
         ncfile = netcdf.Dataset(self.store_filename, 'r')
 
         # Resume from NetCDF file.
+        initial_time = time.time()
         self._resume_from_netcdf(ncfile)
+        self._resume_timings['replica data'] = time.time() - initial_time
 
         # Close NetCDF file.
         ncfile.close()
 
+        # Keep a single copy of the replica configurations on each node.
+        if self.mpicomm and self.mpi_shared_memory:
+            self._share_replica_configurations()
+
         if (self.mpicomm is None) or (self.mpicomm.rank == 0):
-            # Reopen NetCDF file for appending, and maintain handle.
+            # Reopen NetCDF files for appending, and maintain handles.
             self.ncfile = netcdf.Dataset(self.store_filename, 'a')
+            self.trajectory_ncfile = open_trajectory_file(self.ncfile, self.store_filename, 'a')
         else:
             self.ncfile = None
+            self.trajectory_ncfile = None
 
         # On first iteration, we need to do some initialization.
         if self.iteration == 0:
@@ -1062,6 +1955,8 @@ class ReplicaExchange(object):
 
             # Compute energies of all alchemical replicas
             self._compute_energies()
+            if self.mpicomm:
+                self._complete_replica_gather()
 
             # Show energies.
             if self.show_energies:
@@ -1089,6 +1984,10 @@ class ReplicaExchange(object):
         # Analysis object starts off empty.
         self.analysis = None
 
+        # Report where the time to resume was spent.
+        logger.info("Resuming took %.3f s (%s)." % (sum(self._resume_timings.values()),
+                    ', '.join("%s: %.3f s" % (name, elapsed) for name, elapsed in self._resume_timings.items())))
+
         # Signal that the class has been initialized.
         self._initialized = True
 
@@ -1104,8 +2003,7 @@ class ReplicaExchange(object):
             # Only the root node needs to clean up.
             if self.mpicomm.rank != 0: return
 
-        if hasattr(self, 'ncfile') and self.ncfile:
-            self.ncfile.sync()
+        self._sync_netcdf(force=True)
 
         return
 
@@ -1121,9 +2019,7 @@ class ReplicaExchange(object):
             if self.mpicomm.rank != 0: return
 
         if hasattr(self, 'ncfile'):
-            if self.ncfile is not None:
-                self.ncfile.close()
-                self.ncfile = None
+            self._close_netcdf()
 
         return
 
@@ -1183,6 +2079,75 @@ class ReplicaExchange(object):
         else:
             return self.mm.Context(system, integrator, self.platform)
 
+    def _create_integrator(self, temperature, system):
+        """
+        Create the integrator specified by integrator_type with a random seed.
+
+        Parameters
+        ----------
+        temperature : simtk.unit.Quantity with units compatible with kelvin
+           The temperature of the heat bath.
+        system : simtk.openmm.System
+           The system that will be integrated. Its force groups are assigned if a
+           multiple timestep integrator is requested.
+
+        Returns
+        -------
+        integrator : simtk.openmm.Integrator
+           The created integrator.
+
+        """
+        mts_fast_force_groups = (0,)
+        if self.integrator_type == 'mts-langevin':
+            mcmc.assign_mts_force_groups(system)
+            mts_fast_force_groups = mcmc.get_mts_fast_force_groups(system)
+        integrator = mcmc.create_integrator(self.integrator_type, temperature, self.collision_rate,
+                                            self.timestep, mts_substeps=self.mts_substeps,
+                                            mts_fast_force_groups=mts_fast_force_groups)
+        integrator.setRandomNumberSeed(int(np.random.randint(0, MAX_SEED)))
+        return integrator
+
+    def _assign_replica_velocities(self, replica_index, context):
+        """
+        Set the velocities of the replica in the context.
+
+        If persist_velocities is True and velocities have been stored for the replica, these are rescaled
+        by sqrt(T_new/T_old) to the temperature of the current state of the replica. Otherwise, velocities
+        are drawn from the Maxwell-Boltzmann distribution.
+
+        Parameters
+        ----------
+        replica_index : int
+           The index of the replica.
+        context : simtk.openmm.Context
+           The context where the positions of the replica have already been set.
+
+        """
+        state = self.states[self.replica_states[replica_index]]
+        velocities = self.replica_velocities[replica_index]
+        if self.persist_velocities and (velocities is not None):
+            old_temperature = self.states[self.replica_velocities_states[replica_index]].temperature
+            scale_factor = float(np.sqrt(state.temperature / old_temperature))
+            context.setVelocities(velocities * scale_factor)
+        else:
+            context.setVelocitiesToTemperature(state.temperature, int(np.random.randint(0, MAX_SEED)))
+
+    def _store_replica_velocities(self, replica_index, openmm_state):
+        """
+        Store the velocities of the replica if persist_velocities is True.
+
+        Parameters
+        ----------
+        replica_index : int
+           The index of the replica.
+        openmm_state : simtk.openmm.State
+           The state obtained from the context after propagation, with velocities.
+
+        """
+        if self.persist_velocities:
+            self.replica_velocities[replica_index] = openmm_state.getVelocities(asNumpy=True)
+            self.replica_velocities_states[replica_index] = self.replica_states[replica_index]
+
     def _propagate_replica(self, replica_index):
         """
         Propagate the replica corresponding to the specified replica index.
@@ -1227,8 +2192,7 @@ class ReplicaExchange(object):
                 state.system.addForce(barostat)
 
         # Create Context and integrator.
-        integrator = openmm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
-        integrator.setRandomNumberSeed(int(np.random.randint(0, MAX_SEED)))
+        integrator = self._create_integrator(state.temperature, state.system)
         context = self._create_context(state.system, integrator)
 
         # Set box vectors.
@@ -1238,19 +2202,22 @@ class ReplicaExchange(object):
         positions = self.replica_positions[replica_index]
         context.setPositions(positions)
         setpositions_end_time = time.time()
-        # Assign Maxwell-Boltzmann velocities.
-        context.setVelocitiesToTemperature(state.temperature, int(np.random.randint(0, MAX_SEED)))
+        # Assign persisted or Maxwell-Boltzmann velocities.
+        self._assign_replica_velocities(replica_index, context)
         setvelocities_end_time = time.time()
         # Run dynamics.
         integrator.step(self.nsteps_per_iteration)
         integrator_end_time = time.time()
         # Store final positions
         getstate_start_time = time.time()
-        openmm_state = context.getState(getPositions=True, enforcePeriodicBox=state.system.usesPeriodicBoundaryConditions())
+        openmm_state = context.getState(getPositions=True, getVelocities=self.persist_velocities,
+                                        enforcePeriodicBox=state.system.usesPeriodicBoundaryConditions())
         getstate_end_time = time.time()
         self.replica_positions[replica_index] = openmm_state.getPositions(asNumpy=True)
         # Store box vectors.
         self.replica_box_vectors[replica_index] = openmm_state.getPeriodicBoxVectors(asNumpy=True)
+        # Store velocities.
+        self._store_replica_velocities(replica_index, openmm_state)
 
         # Clean up.
         del context, integrator
@@ -1266,53 +2233,450 @@ class ReplicaExchange(object):
 
         return elapsed_time
 
-    def _propagate_replicas_mpi(self):
+    def _propagate_replica_safely(self, replica_index):
         """
-        Propagate all replicas using MPI communicator.
+        Propagate a replica, rolling it back and retrying if the propagation raises an exception.
 
-        It is presumed all nodes have the correct configurations in the correct replica slots, but that state indices may be unsynchronized.
+        The replica is retried at most max_replica_failure_retries times from the configuration it
+        had before the propagation. If all attempts fail, it keeps that configuration.
 
-        TODO
+        Parameters
+        ----------
+        replica_index : int
+           The index of the replica to propagate.
+
+        Returns
+        -------
+        success : bool
+           False if all the attempts to propagate the replica failed.
+
+        """
+        checkpoint = self._pack_replica_configuration(replica_index)
+        nattempts = self.max_replica_failure_retries + 1
+        for attempt in range(nattempts):
+            try:
+                self._propagate_replica(replica_index)
+                return True
+            except Exception as e:
+                logger.warning("Replica %d state %d: propagation failed (attempt %d/%d): %s" %
+                               (replica_index, self.replica_states[replica_index], attempt+1, nattempts, str(e)))
+                logger.debug("Propagation error traceback:", exc_info=True)
+                self._unpack_replica_configuration(replica_index, checkpoint)
+                self._reset_propagation_context()
+        return False
+
+    def _reset_propagation_context(self):
+        """
+        Discard any OpenMM object reused between propagations, which may be in an invalid state after an error.
+
+        ReplicaExchange creates a new Context and integrator for each propagation, so there is
+        nothing to discard here. Subclasses caching them between propagations must override this.
 
-        * Move synchronization of state information to mix_replicas?
-        * Broadcast from root node only?
+        """
+        pass
+
+    def _mpi_replica_indices_per_rank(self):
+        """
+        Return the replicas handled by each node.
+
+        Each node propagates the replicas assigned to it by _update_replica_assignment() and
+        computes their energies.
+
+        Returns
+        -------
+        replica_indices_per_rank : list of list of int
+           replica_indices_per_rank[rank] are the indices of the replicas handled by node rank.
+
+        """
+        if self._replica_assignment is None:
+            self._update_replica_assignment()
+        return [np.flatnonzero(self._replica_assignment == rank).tolist() for rank in range(self.mpicomm.size)]
+
+    def _update_replica_assignment(self):
+        """
+        Assign replicas to nodes according to mpi_replica_assignment.
+
+        With 'balanced', replicas are initially distributed in a round-robin fashion and then kept
+        on the same node until the load predicted from the propagation costs of their current states
+        is unbalanced by more than mpi_rebalance_threshold. All nodes compute the same assignment
+        since replica states and propagation costs are shared.
+
+        """
+        nnodes = self.mpicomm.size
+        if self.mpi_replica_assignment == 'round-robin':
+            self._replica_assignment = np.array(self.replica_states, np.int64) % nnodes
+            return
+        elif self.mpi_replica_assignment != 'balanced':
+            raise ParameterException("MPI replica assignment '%s' unknown. Valid assignments are %s." %
+                                     (self.mpi_replica_assignment, ', '.join(MPI_REPLICA_ASSIGNMENTS)))
+
+        if self._replica_assignment is None:
+            self._replica_assignment = np.arange(self.nstates, dtype=np.int64) % nnodes
+
+        # Wait until the cost of all states has been measured.
+        if np.any(np.isnan(self._state_propagation_costs)):
+            return
+        replica_costs = self._state_propagation_costs[self.replica_states]
+        imbalance = compute_load_imbalance(replica_costs, self._replica_assignment, nnodes)
+        if imbalance <= self.mpi_rebalance_threshold:
+            return
+
+        new_assignment = balance_replica_assignment(replica_costs, self._replica_assignment, nnodes,
+                                                    tolerance=self.mpi_rebalance_threshold)
+        new_imbalance = compute_load_imbalance(replica_costs, new_assignment, nnodes)
+        if new_imbalance < imbalance:
+            nmoved = np.count_nonzero(new_assignment != self._replica_assignment)
+            logger.debug("Rebalancing MPI load: moving %d replicas reduces the predicted imbalance from %.1f%% to %.1f%%" %
+                         (nmoved, imbalance * 100.0, new_imbalance * 100.0))
+            self._replica_assignment = new_assignment
+
+    def _update_propagation_costs(self, replica_elapsed_times):
+        """
+        Update the moving average of the propagation time in each state.
+
+        Parameters
+        ----------
+        replica_elapsed_times : array of float
+           replica_elapsed_times[i] is the time spent propagating replica i in the last iteration.
+
+        """
+        for (replica_index, state_index) in enumerate(self.replica_states):
+            elapsed_time = replica_elapsed_times[replica_index]
+            if np.isnan(self._state_propagation_costs[state_index]):
+                self._state_propagation_costs[state_index] = elapsed_time
+            else:
+                self._state_propagation_costs[state_index] += PROPAGATION_COST_SMOOTHING * (elapsed_time - self._state_propagation_costs[state_index])
+
+    def _propagate_replicas_mpi(self):
+        """
+        Propagate all replicas using MPI communicator.
+
+        Each node propagates the replicas in its share of states. The configurations of the replicas
+        that were propagated by another node in the previous iteration are first received from that
+        node, and the final configurations are sent only to the root node, which stores them.
 
         """
 
         # Propagate all replicas.
         logger.debug("Propagating all replicas for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / unit.picoseconds))
 
-        # Run just this node's share of states.
+        # Fetch the configurations of the replicas assigned to this node.
+        self._complete_replica_gather()
+        self._update_replica_assignment()
+        replica_indices_per_rank = self._mpi_replica_indices_per_rank()
+        replica_indices = replica_indices_per_rank[self.mpicomm.rank] # list of replica indices for this node to propagate
+        self._send_replica_configurations(replica_indices_per_rank)
+
+        # Run just this node's share of replicas.
         logger.debug("Running trajectories...")
         start_time = time.time()
-        # replica_lookup = { self.replica_states[replica_index] : replica_index for replica_index in range(self.nstates) } # replica_lookup[state_index] is the replica index currently at state 'state_index' # requires Python 2.7 features
-        replica_lookup = dict( (self.replica_states[replica_index], replica_index) for replica_index in range(self.nstates) ) # replica_lookup[state_index] is the replica index currently at state 'state_index' # Python 2.6 compatible
-        replica_indices = [ replica_lookup[state_index] for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size) ] # list of replica indices for this node to propagate
+        local_results = list()
         for replica_index in replica_indices:
             logger.debug("Node %3d/%3d propagating replica %3d state %3d..." % (self.mpicomm.rank, self.mpicomm.size, replica_index, self.replica_states[replica_index]))
-            self._propagate_replica(replica_index)
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        # Collect elapsed time.
-        node_elapsed_times = self.mpicomm.gather(elapsed_time, root=0) # barrier
+            replica_start_time = time.time()
+            success = self._propagate_replica_safely(replica_index)
+            local_results.append([time.time() - replica_start_time, 0.0 if success else 1.0])
+        # Collect elapsed time of all replicas to estimate the cost of each state, and report failures.
+        replica_results = np.zeros([self.nstates, 2], np.float64)
+        mpi_allgather_rows(self.mpicomm, np.reshape(local_results, (-1, 2)), replica_indices_per_rank, replica_results) # barrier
+        replica_elapsed_times = replica_results[:,0]
+        self._failed_replicas = replica_results[:,1] > 0.0
+        self._update_propagation_costs(replica_elapsed_times)
+        self._replica_propagation_times = replica_elapsed_times
+        self._rank_timings['propagate'] = replica_elapsed_times[replica_indices].sum()
         if self.mpicomm.rank == 0 and logger.isEnabledFor(logging.DEBUG):
-            node_elapsed_times = np.array(node_elapsed_times)
+            node_elapsed_times = np.array([replica_elapsed_times[indices].sum() for indices in replica_indices_per_rank])
             end_time = time.time()
             elapsed_time = end_time - start_time
             barrier_wait_times = elapsed_time - node_elapsed_times
             logger.debug("Running trajectories: elapsed time %.3f s (barrier time min %.3f s | max %.3f s | avg %.3f s)" % (elapsed_time, barrier_wait_times.min(), barrier_wait_times.max(), barrier_wait_times.mean()))
             logger.debug("Total time spent waiting for GPU: %.3f s" % (node_elapsed_times.sum()))
 
-        # Send final configurations and box vectors back to all nodes.
+        # Start sending final configurations and box vectors to the root node, which needs
+        # them only to store them, while energies are computed.
+        self._gather_replica_configurations(replica_indices_per_rank)
+
+        return
+
+    def _share_replica_configurations(self):
+        """
+        Move the replica positions, box vectors and persisted velocities to arrays shared by the MPI processes of each node.
+
+        The configurations propagated by a process are then visible to the other processes of its
+        node without communication (see _same_node()).
+
+        """
+        node_comm = get_node_communicator(self.mpicomm)
+        if node_comm is None:
+            logger.warning("The MPI library does not support shared memory. Replica configurations are not shared.")
+            return
+        node_leader = node_comm.bcast(self.mpicomm.rank, root=0)
+        self._rank_nodes = np.array(self.mpicomm.allgather(node_leader), np.int64)
+
+        # Only the first process of the node copies the configurations, which all processes hold after resuming.
+        shared_arrays = list()
+        positions, window = allocate_shared_array(node_comm, (self.nstates, self.natoms, 3))
+        shared_arrays.append((positions, window, 'replica_positions', unit.nanometers, False))
+        box_vectors, window = allocate_shared_array(node_comm, (self.nstates, 3, 3))
+        shared_arrays.append((box_vectors, window, 'replica_box_vectors', unit.nanometers, False))
+        if self.persist_velocities:
+            velocities, window = allocate_shared_array(node_comm, (self.nstates, self.natoms, 3))
+            shared_arrays.append((velocities, window, 'replica_velocities', unit.nanometers / unit.picoseconds, True))
+        for (array, window, attribute_name, quantity_unit, allow_none) in shared_arrays:
+            shared_quantities = SharedReplicaQuantities(array, quantity_unit, allow_none=allow_none)
+            if node_comm.rank == 0:
+                for (replica_index, value) in enumerate(getattr(self, attribute_name)):
+                    shared_quantities[replica_index] = value
+            setattr(self, attribute_name, shared_quantities)
+            self._shared_memory_windows.append(window)
+        if self.persist_velocities:
+            velocities_states, window = allocate_shared_array(node_comm, (self.nstates,), np.int64)
+            if node_comm.rank == 0:
+                velocities_states[:] = self.replica_velocities_states[:]
+            self.replica_velocities_states = velocities_states
+            self._shared_memory_windows.append(window)
+        node_comm.Barrier()
+
+        self._node_comm = node_comm
+        logger.debug("Node %d/%d: sharing replica configurations with %d processes." % (self.mpicomm.rank, self.mpicomm.size, node_comm.size))
+
+    def _release_shared_memory(self):
+        """
+        Copy the shared replica configurations to private memory and free the shared memory.
+
+        """
+        if self._node_comm is None:
+            return
+        self.replica_positions = [copy.deepcopy(positions) for positions in self.replica_positions]
+        self.replica_box_vectors = [copy.deepcopy(box_vectors) for box_vectors in self.replica_box_vectors]
+        if self.persist_velocities:
+            self.replica_velocities = [copy.deepcopy(velocities) for velocities in self.replica_velocities]
+            self.replica_velocities_states = np.array(self.replica_velocities_states)
+        for window in self._shared_memory_windows:
+            window.Free()
+        self._node_comm.Free()
+        self._node_comm = None
+        self._rank_nodes = None
+        self._shared_memory_windows = list()
+
+    def _same_node(self, rank1, rank2):
+        """
+        Return True if the two MPI processes share the memory holding the replica configurations.
+
+        """
+        return self._node_comm is not None and self._rank_nodes[rank1] == self._rank_nodes[rank2]
+
+    def _replica_configuration_size(self):
+        """Return the size of the buffer holding the configuration of a replica (see _pack_replica_configuration())."""
+        size = 3*self.natoms + 9 # positions and box vectors
+        if self.persist_velocities:
+            size += 2 + 3*self.natoms # velocities state, 1 if velocities are defined, velocities
+        return size
+
+    def _pack_replica_configuration(self, replica_index):
+        """
+        Return the positions, box vectors and, if persisted, velocities of a replica as a flat unitless array.
+
+        Parameters
+        ----------
+        replica_index : int
+           The index of the replica.
+
+        Returns
+        -------
+        buffer : numpy.ndarray of numpy.float64
+           The configuration in nanometers and nanometers/picoseconds.
+
+        """
+        buffer = np.zeros([self._replica_configuration_size()], np.float64)
+        npositions = 3*self.natoms
+        buffer[:npositions] = np.ravel(self.replica_positions[replica_index] / unit.nanometers)
+        buffer[npositions:npositions+9] = np.ravel(self.replica_box_vectors[replica_index] / unit.nanometers)
+        if self.persist_velocities:
+            # Replicas that have not been propagated yet have no velocities.
+            buffer[npositions+9] = self.replica_velocities_states[replica_index]
+            if self.replica_velocities[replica_index] is not None:
+                buffer[npositions+10] = 1.0
+                buffer[npositions+11:] = np.ravel(self.replica_velocities[replica_index] / (unit.nanometers / unit.picoseconds))
+        return buffer
+
+    def _unpack_replica_configuration(self, replica_index, buffer):
+        """
+        Restore the configuration of a replica from an array created by _pack_replica_configuration().
+
+        Parameters
+        ----------
+        replica_index : int
+           The index of the replica.
+        buffer : numpy.ndarray of numpy.float64
+           The packed configuration.
+
+        """
+        npositions = 3*self.natoms
+        self.replica_positions[replica_index] = unit.Quantity(buffer[:npositions].reshape(self.natoms, 3), unit.nanometers)
+        self.replica_box_vectors[replica_index] = unit.Quantity(buffer[npositions:npositions+9].reshape(3, 3), unit.nanometers)
+        if self.persist_velocities:
+            self.replica_velocities_states[replica_index] = int(buffer[npositions+9])
+            if buffer[npositions+10]:
+                velocities = buffer[npositions+11:].reshape(self.natoms, 3)
+                self.replica_velocities[replica_index] = unit.Quantity(velocities, unit.nanometers / unit.picoseconds)
+            else:
+                self.replica_velocities[replica_index] = None
+
+    def _send_replica_configurations(self, replica_indices_per_rank):
+        """
+        Send point-to-point the configurations of the replicas that are assigned to a new node.
+
+        Only the node that last propagated a replica holds its current configuration, besides the
+        root node, which receives all of them to store them.
+
+        Parameters
+        ----------
+        replica_indices_per_rank : list of list of int
+           replica_indices_per_rank[rank] are the indices of the replicas that node rank will propagate.
+
+        """
+        start_time = time.time()
+        requests = list()
+        received = list()
+        for (rank, replica_indices) in enumerate(replica_indices_per_rank):
+            for replica_index in replica_indices:
+                source = self._replica_nodes[replica_index]
+                # The processes of the root node hold all configurations after _complete_replica_gather().
+                if source == -1 or source == rank or rank == 0 or self._same_node(source, rank) or self._same_node(rank, 0):
+                    continue
+                if self.mpicomm.rank == source:
+                    buffer = self._pack_replica_configuration(replica_index)
+                    requests.append((self.mpicomm.Isend(buffer, dest=rank, tag=replica_index), buffer))
+                elif self.mpicomm.rank == rank:
+                    buffer = np.empty([self._replica_configuration_size()], np.float64)
+                    requests.append((self.mpicomm.Irecv(buffer, source=source, tag=replica_index), buffer))
+                    received.append((replica_index, buffer))
+        wait_start_time = time.time()
+        for (request, buffer) in requests:
+            request.Wait()
+        self._communication_time += time.time() - wait_start_time
+        for (replica_index, buffer) in received:
+            self._unpack_replica_configuration(replica_index, buffer)
+        logger.debug("Node %d/%d: received %d replica configurations in %.3f s" % (self.mpicomm.rank, self.mpicomm.size,
+                     len(received), time.time() - start_time))
+
+    def _gather_replica_configurations(self, replica_indices_per_rank):
+        """
+        Start sending the configurations of the replicas handled by each node to the root node.
+
+        The communication is non-blocking when supported by the MPI library, and it must be
+        completed with _complete_replica_gather() on all nodes.
+
+        Parameters
+        ----------
+        replica_indices_per_rank : list of list of int
+           replica_indices_per_rank[rank] are the indices of the replicas that node rank has propagated.
+
+        """
+        logger.debug("Gathering trajectories...")
+        # The processes sharing memory with the root node have already stored their configurations there.
+        gather_indices_per_rank = [list() if rank != 0 and self._same_node(rank, 0) else replica_indices
+                                   for (rank, replica_indices) in enumerate(replica_indices_per_rank)]
+        replica_indices = gather_indices_per_rank[self.mpicomm.rank]
+        local_configurations = np.array([self._pack_replica_configuration(replica_index) for replica_index in replica_indices])
+        configurations = np.empty([self.nstates, self._replica_configuration_size()], np.float64)
+        pending = mpi_gather_rows(self.mpicomm, local_configurations, gather_indices_per_rank, configurations,
+                                  nonblocking=True)
+        for (rank, rank_replica_indices) in enumerate(replica_indices_per_rank):
+            for replica_index in rank_replica_indices:
+                self._replica_nodes[replica_index] = rank
+        self._pending_replica_gather = (pending, configurations, gather_indices_per_rank)
+
+    def _complete_replica_gather(self):
+        """
+        Wait for the configurations sent by _gather_replica_configurations() and restore them on the root node.
+
+        """
+        if self._pending_replica_gather is None:
+            return
+        pending, configurations, replica_indices_per_rank = self._pending_replica_gather
+        self._pending_replica_gather = None
+        wait_time = pending.wait()
+        self._communication_time += wait_time
+        if self.mpicomm.rank == 0:
+            for (rank, rank_replica_indices) in enumerate(replica_indices_per_rank[1:], start=1):
+                for replica_index in rank_replica_indices:
+                    self._unpack_replica_configuration(replica_index, configurations[replica_index])
+        # Make the configurations in shared memory visible to all the processes of the node.
+        if self._node_comm is not None:
+            self._node_comm.Barrier()
+        logger.debug("Gathering configurations and box vectors: waited %.3f s" % wait_time)
+
+    def _collect_communication_time(self):
+        """
+        Reduce on the root node the maximum time spent by a node waiting for MPI communication in this iteration.
+
+        """
+        from mpi4py import MPI
+        self._rank_timings['communication'] = self._communication_time
+        communication_time = self.mpicomm.reduce(self._communication_time, op=MPI.MAX, root=0)
+        self._communication_time = communication_time if self.mpicomm.rank == 0 else 0.0
+
+    def _store_rank_timings(self):
+        """
+        Gather on the root node the time spent by each node in each activity of RANK_TIMINGS and store it.
+
+        The time elapsed since the previous call that was not spent in the other activities, mostly
+        waiting for the other nodes at synchronization points, is recorded as idle. The timings are
+        gathered with a single collective call per iteration.
+
+        """
+        end_time = time.time()
+        elapsed_time = end_time - self._rank_timings_time
+        self._rank_timings_time = end_time
+        self._rank_timings['idle'] = max(0.0, elapsed_time - sum(self._rank_timings[name] for name in RANK_TIMINGS if name != 'idle'))
+        local_timings = np.array([self._rank_timings[name] for name in RANK_TIMINGS], np.float64)
+        self._rank_timings = dict.fromkeys(RANK_TIMINGS, 0.0)
+
+        if self.mpicomm:
+            rank_timings = np.empty([self.mpicomm.size, len(RANK_TIMINGS)], np.float64) if self.mpicomm.rank == 0 else None
+            self.mpicomm.Gather(local_timings, rank_timings, root=0)
+            # Only the root node writes data.
+            if self.mpicomm.rank != 0: return
+        else:
+            rank_timings = np.reshape(local_timings, (1, -1))
+
+        # Files created by previous versions don't have the variable, and timings of a different
+        # number of MPI processes than the one that created the file are not stored.
+        ncgrp_timings = self.ncfile.groups['timings']
+        ncgrp_timings.variables['iteration'][self.iteration] = elapsed_time
+        if 'rank_timings' in ncgrp_timings.variables and len(ncgrp_timings.dimensions['rank']) == len(rank_timings):
+            ncgrp_timings.variables['rank_timings'][self.iteration,:,:] = rank_timings
+
+    def _sync_replica_configurations(self, replica_indices):
+        """
+        Send the configurations, box vectors and, if persisted, velocities of the replicas handled by
+        this node to all nodes.
+
+        Parameters
+        ----------
+        replica_indices : list of int
+           The indices of the replicas that this node has updated.
+
+        """
         logger.debug("Synchronizing trajectories...")
         start_time = time.time()
-        replica_indices_gather = self.mpicomm.allgather(replica_indices)
-        replica_positions_gather = self.mpicomm.allgather([ self.replica_positions[replica_index] for replica_index in replica_indices ])
-        replica_box_vectors_gather = self.mpicomm.allgather([ self.replica_box_vectors[replica_index] for replica_index in replica_indices ])
-        for (source, replica_indices) in enumerate(replica_indices_gather):
-            for (index, replica_index) in enumerate(replica_indices):
-                self.replica_positions[replica_index] = replica_positions_gather[source][index]
-                self.replica_box_vectors[replica_index] = replica_box_vectors_gather[source][index]
+        replica_indices_per_rank = self.mpicomm.allgather(list(replica_indices))
+
+        # Exchange unitless configurations as contiguous buffers.
+        local_configurations = np.array([self._pack_replica_configuration(replica_index) for replica_index in replica_indices])
+        configurations = np.empty([self.nstates, self._replica_configuration_size()], np.float64)
+        mpi_allgather_rows(self.mpicomm, local_configurations, replica_indices_per_rank, configurations)
+        for (rank, rank_replica_indices) in enumerate(replica_indices_per_rank):
+            # In shared memory, the first process of the node stores only the configurations of the other nodes.
+            unpack = self._node_comm is None or (self._node_comm.rank == 0 and not self._same_node(rank, self.mpicomm.rank))
+            for replica_index in rank_replica_indices:
+                if unpack:
+                    self._unpack_replica_configuration(replica_index, configurations[replica_index])
+                self._replica_nodes[replica_index] = -1
+        if self._node_comm is not None:
+            self._node_comm.Barrier()
         end_time = time.time()
         logger.debug("Synchronizing configurations and box vectors: elapsed time %.3f s" % (end_time - start_time))
 
@@ -1327,7 +2691,10 @@ class ReplicaExchange(object):
         # Propagate all replicas.
         logger.debug("Propagating all replicas for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / unit.picoseconds))
         for replica_index in range(self.nstates):
-            self._propagate_replica(replica_index)
+            replica_start_time = time.time()
+            self._failed_replicas[replica_index] = not self._propagate_replica_safely(replica_index)
+            self._replica_propagation_times[replica_index] = time.time() - replica_start_time
+        self._rank_timings['propagate'] = self._replica_propagation_times.sum()
 
         return
 
@@ -1342,11 +2709,20 @@ class ReplicaExchange(object):
         """
         start_time = time.time()
 
+        self._failed_replicas[:] = False
         if self.mpicomm:
             self._propagate_replicas_mpi()
         else:
             self._propagate_replicas_serial()
 
+        # Report replicas that could not be propagated.
+        failed_replica_indices = np.flatnonzero(self._failed_replicas)
+        if len(failed_replica_indices) == self.nstates:
+            raise RuntimeError("The propagation of all replicas failed.")
+        if len(failed_replica_indices) > 0 and (not self.mpicomm or self.mpicomm.rank == 0):
+            logger.warning("Iteration %d: the propagation of replicas %s failed. They keep their previous configuration "
+                           "and are excluded from the next swap attempts." % (self.iteration, ', '.join(str(i) for i in failed_replica_indices)))
+
         end_time = time.time()
         elapsed_time = end_time - start_time
         time_per_replica = elapsed_time / float(self.nstates)
@@ -1355,11 +2731,20 @@ class ReplicaExchange(object):
 
         return
 
-    def _minimize_replica(self, replica_index):
+    def _minimize_replica(self, replica_index, max_iterations=None):
         """
         Minimize the specified replica.
 
+        Parameters
+        ----------
+        replica_index : int
+           The index of the replica to minimize.
+        max_iterations : int, optional, default=None
+           Maximum number of minimization iterations. If None, minimize_max_iterations is used.
+
         """
+        if max_iterations is None:
+            max_iterations = self.minimize_max_iterations
         # Retrieve thermodynamic state.
         state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
         state = self.states[state_index] # thermodynamic state
@@ -1373,7 +2758,7 @@ class ReplicaExchange(object):
         positions = self.replica_positions[replica_index]
         context.setPositions(positions)
         # Minimize energy.
-        minimized_positions = self.mm.LocalEnergyMinimizer.minimize(context, self.minimize_tolerance, self.minimize_max_iterations)
+        minimized_positions = self.mm.LocalEnergyMinimizer.minimize(context, self.minimize_tolerance, max_iterations)
         # Store final positions
         self.replica_positions[replica_index] = context.getState(getPositions=True, enforcePeriodicBox=state.system.usesPeriodicBoundaryConditions()).getPositions(asNumpy=True)
         # Clean up.
@@ -1381,47 +2766,123 @@ class ReplicaExchange(object):
 
         return
 
+    def _minimization_state_key(self, state_index):
+        """
+        Return a key identifying the potential energy function of a state.
+
+        Replicas in states with the same key have the same energy minima, so that a
+        configuration minimized in one of them doesn't need to be minimized again.
+
+        Parameters
+        ----------
+        state_index : int
+           The index of the thermodynamic state.
+
+        Returns
+        -------
+        key : hashable
+           States sharing the same potential return equal keys.
+
+        """
+        return id(self.states[state_index].system)
+
+    def _plan_minimization(self):
+        """
+        Group the replicas that share the same starting configuration.
+
+        Returns
+        -------
+        minimization_groups : list of list of int
+           minimization_groups[i] is the list of replica indices with identical positions
+           and box vectors. The first replica of each group is the one that is fully minimized.
+
+        """
+        minimization_groups = list()
+        group_indices = dict() # group_indices[hash] is the index of the group in minimization_groups
+        for replica_index in range(self.nstates):
+            configuration_hash = hashlib.sha1()
+            configuration_hash.update(np.ascontiguousarray(self.replica_positions[replica_index] / unit.nanometers))
+            configuration_hash.update(np.ascontiguousarray(self.replica_box_vectors[replica_index] / unit.nanometers))
+            configuration_hash = configuration_hash.hexdigest()
+            if configuration_hash in group_indices:
+                minimization_groups[group_indices[configuration_hash]].append(replica_index)
+            else:
+                group_indices[configuration_hash] = len(minimization_groups)
+                minimization_groups.append([replica_index])
+
+        return minimization_groups
+
+    def _minimize_replicas(self, replica_indices, max_iterations=None):
+        """
+        Minimize the specified replicas, distributing them among nodes if MPI is used.
+
+        Parameters
+        ----------
+        replica_indices : list of int
+           The indices of the replicas to minimize.
+        max_iterations : int, optional, default=None
+           Maximum number of minimization iterations. If None, minimize_max_iterations is used.
+
+        """
+        if self.mpicomm:
+            # MPI implementation.
+            # Minimize this node's share of replicas.
+            start_time = time.time()
+            node_replica_indices = replica_indices[self.mpicomm.rank::self.mpicomm.size]
+            for replica_index in node_replica_indices:
+                logger.debug("node %d / %d : minimizing replica %d / %d" % (self.mpicomm.rank, self.mpicomm.size, replica_index, self.nstates))
+                self._minimize_replica(replica_index, max_iterations=max_iterations)
+            end_time = time.time()
+            logger.debug("Minimizing replicas: elapsed time %.3f s" % (end_time - start_time))
+
+            # Send final configurations and box vectors back to all nodes.
+            self._sync_replica_configurations(node_replica_indices)
+
+        else:
+            # Serial implementation.
+            for replica_index in replica_indices:
+                logger.debug("minimizing replica %d / %d" % (replica_index, self.nstates))
+                self._minimize_replica(replica_index, max_iterations=max_iterations)
+
+        return
+
     def _minimize_and_equilibrate(self):
         """
         Minimize and equilibrate all replicas.
 
+        Each unique starting configuration is minimized only once in the state of the first
+        replica holding it. The result is then copied to the other replicas sharing that
+        configuration, and a short relaxation of at most minimize_relaxation_max_iterations
+        is performed only for those in states with a different potential.
+
         """
 
         # Minimize
         if self.minimize:
             logger.debug("Minimizing all replicas...")
+            start_time = time.time()
+
+            # Fully minimize each unique starting configuration once.
+            minimization_groups = self._plan_minimization()
+            logger.debug("Minimizing %d unique configurations for %d replicas." % (len(minimization_groups), self.nstates))
+            self._minimize_replicas([group[0] for group in minimization_groups])
+
+            # Copy the minimized configurations to the other replicas and relax them where needed.
+            relaxation_indices = list()
+            for group in minimization_groups:
+                reference_index = group[0]
+                reference_key = self._minimization_state_key(self.replica_states[reference_index])
+                for replica_index in group[1:]:
+                    self.replica_positions[replica_index] = copy.deepcopy(self.replica_positions[reference_index])
+                    self.replica_box_vectors[replica_index] = copy.deepcopy(self.replica_box_vectors[reference_index])
+                    if self._minimization_state_key(self.replica_states[replica_index]) != reference_key:
+                        relaxation_indices.append(replica_index)
+            if len(relaxation_indices) > 0:
+                logger.debug("Relaxing %d replicas in states with different potentials." % len(relaxation_indices))
+                self._minimize_replicas(relaxation_indices, max_iterations=self.minimize_relaxation_max_iterations)
 
-            if self.mpicomm:
-                # MPI implementation.
-                logger.debug("MPI implementation.")
-                # Minimize this node's share of replicas.
-                start_time = time.time()
-                for replica_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
-                    logger.debug("node %d / %d : minimizing replica %d / %d" % (self.mpicomm.rank, self.mpicomm.size, replica_index, self.nstates))
-                    self._minimize_replica(replica_index)
-                end_time = time.time()
-                debug_msg = 'Node {}/{}: MPI barrier'.format(self.mpicomm.rank, self.mpicomm.size)
-                logger.debug(debug_msg + ' - waiting for the minimization to be completed.')
-                self.mpicomm.barrier()
-                logger.debug("Running trajectories: elapsed time %.3f s" % (end_time - start_time))
-
-                # Send final configurations and box vectors back to all nodes.
-                logger.debug("Synchronizing trajectories...")
-                replica_positions_gather = self.mpicomm.allgather(self.replica_positions[self.mpicomm.rank:self.nstates:self.mpicomm.size])
-                replica_box_vectors_gather = self.mpicomm.allgather(self.replica_box_vectors[self.mpicomm.rank:self.nstates:self.mpicomm.size])
-                for replica_index in range(self.nstates):
-                    source = replica_index % self.mpicomm.size # node with trajectory data
-                    index = replica_index // self.mpicomm.size # index within trajectory batch
-                    self.replica_positions[replica_index] = replica_positions_gather[source][index]
-                    self.replica_box_vectors[replica_index] = replica_box_vectors_gather[source][index]
-                logger.debug("Synchronizing configurations and box vectors: elapsed time %.3f s" % (end_time - start_time))
-
-            else:
-                # Serial implementation.
-                logger.debug("Serial implementation.")
-                for replica_index in range(self.nstates):
-                    logger.debug("minimizing replica %d / %d" % (replica_index, self.nstates))
-                    self._minimize_replica(replica_index)
+            end_time = time.time()
+            logger.debug("Minimizing all replicas: elapsed time %.3f s" % (end_time - start_time))
 
         # Equilibrate: temporarily set timestep to equilibration timestep
         production_timestep = self.timestep
@@ -1451,17 +2912,17 @@ class ReplicaExchange(object):
         if self.mpicomm:
             # MPI version.
 
-            # Compute energies for this node's share of states.
-            for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
-                for replica_index in range(self.nstates):
+            # Compute energies at all states for this node's replicas, whose configurations it holds.
+            replica_indices_per_rank = self._mpi_replica_indices_per_rank()
+            node_replica_indices = replica_indices_per_rank[self.mpicomm.rank]
+            for state_index in range(self.nstates):
+                for replica_index in node_replica_indices:
                     self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)
 
             # Send final energies to all nodes.
-            energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
-            for state_index in range(self.nstates):
-                source = state_index % self.mpicomm.size # node with trajectory data
-                index = state_index // self.mpicomm.size # index within trajectory batch
-                self.u_kl[:,state_index] = energies_gather[source][:,index]
+            communication_start_time = time.time()
+            mpi_allgather_rows(self.mpicomm, self.u_kl[node_replica_indices,:], replica_indices_per_rank, self.u_kl)
+            self._communication_time += time.time() - communication_start_time
 
         else:
             # Serial version.
@@ -1602,7 +3063,9 @@ class ReplicaExchange(object):
             # Non-root nodes receive state information.
             logger.debug('Node {}/{}: MPI bcast - sharing replica_states'.format(
                     self.mpicomm.rank, self.mpicomm.size))
+            communication_start_time = time.time()
             self.replica_states = self.mpicomm.bcast(self.replica_states, root=0)
+            self._communication_time += time.time() - communication_start_time
             return
 
         logger.debug("Mixing replicas...")
@@ -1611,6 +3074,12 @@ class ReplicaExchange(object):
         self.Nij_proposed[:,:] = 0
         self.Nij_accepted[:,:] = 0
 
+        # Replicas whose propagation failed keep their state since swaps with NaN energies are rejected.
+        u_kl = self.u_kl
+        if np.any(self._failed_replicas):
+            self.u_kl = np.array(u_kl)
+            self.u_kl[self._failed_replicas,:] = np.nan
+
         # Perform swap attempts according to requested scheme.
         start_time = time.time()
         if self.replica_mixing_scheme == 'swap-neighbors':
@@ -1628,6 +3097,7 @@ class ReplicaExchange(object):
         else:
             raise ParameterException("Replica mixing scheme '%s' unknown.  Choose valid 'replica_mixing_scheme' parameter." % self.replica_mixing_scheme)
         end_time = time.time()
+        self.u_kl = u_kl
 
         # Determine fraction of swaps accepted this iteration.
         nswaps_attempted = self.Nij_proposed.sum()
@@ -1637,8 +3107,8 @@ class ReplicaExchange(object):
         logger.debug("Accepted %d / %d attempted swaps (%.1f %%)" % (nswaps_accepted, nswaps_attempted, swap_fraction_accepted * 100.0))
 
         # Estimate cumulative transition probabilities between all states.
-        Nij_accepted = self.ncfile.variables['accepted'][:,:,:].sum(0) + self.Nij_accepted
-        Nij_proposed = self.ncfile.variables['proposed'][:,:,:].sum(0) + self.Nij_proposed
+        Nij_accepted = self._Nij_accepted_total + self.Nij_accepted
+        Nij_proposed = self._Nij_proposed_total + self.Nij_proposed
         swap_Pij_accepted = np.zeros([self.nstates,self.nstates], np.float64)
         for istate in range(self.nstates):
             Ni = Nij_proposed[istate,:].sum()
@@ -1757,28 +3227,74 @@ class ReplicaExchange(object):
         # Open NetCDF 4 file for writing.
         ncfile = netcdf.Dataset(self.store_filename, 'w', version='NETCDF4')
 
+        # Open the trajectory file for writing if positions are stored separately.
+        if self.trajectory_directory is None:
+            trajectory_ncfile = ncfile
+        else:
+            store_directory = os.path.dirname(os.path.abspath(self.store_filename))
+            trajectory_filename = os.path.join(store_directory, self.trajectory_directory,
+                                               os.path.splitext(os.path.basename(self.store_filename))[0] + TRAJECTORY_FILE_SUFFIX)
+            if not os.path.isdir(os.path.dirname(trajectory_filename)):
+                os.makedirs(os.path.dirname(trajectory_filename))
+            trajectory_ncfile = netcdf.Dataset(trajectory_filename, 'w', version='NETCDF4')
+
+        ncdatasets = [ncfile] if trajectory_ncfile is ncfile else [ncfile, trajectory_ncfile]
+
         # Create dimensions.
-        ncfile.createDimension('iteration', 0) # unlimited number of iterations
-        ncfile.createDimension('replica', self.nreplicas) # number of replicas
-        ncfile.createDimension('atom', self.natoms) # number of atoms in system
-        ncfile.createDimension('spatial', 3) # number of spatial dimensions
+        for ncdataset in ncdatasets:
+            ncdataset.createDimension('iteration', 0) # unlimited number of iterations
+            ncdataset.createDimension('replica', self.nreplicas) # number of replicas
+            ncdataset.createDimension('atom', self.natoms) # number of atoms in system
+            ncdataset.createDimension('spatial', 3) # number of spatial dimensions
+        if self.positions_atom_indices is not None:
+            trajectory_ncfile.createDimension('trajectory_atom', len(self.positions_atom_indices)) # number of atoms with stored positions
+            trajectory_atom_dimension = 'trajectory_atom'
+        else:
+            trajectory_atom_dimension = 'atom'
 
         # Set global attributes.
-        setattr(ncfile, 'title', self.title)
-        setattr(ncfile, 'application', 'YANK')
-        setattr(ncfile, 'program', 'yank.py')
-        setattr(ncfile, 'programVersion', 'unknown') # TODO: Include actual version.
-        setattr(ncfile, 'Conventions', 'YANK')
-        setattr(ncfile, 'ConventionVersion', '0.1')
+        for ncdataset in ncdatasets:
+            setattr(ncdataset, 'title', self.title)
+            setattr(ncdataset, 'application', 'YANK')
+            setattr(ncdataset, 'program', 'yank.py')
+            setattr(ncdataset, 'programVersion', 'unknown') # TODO: Include actual version.
+            setattr(ncdataset, 'Conventions', 'YANK')
+            setattr(ncdataset, 'ConventionVersion', '0.1')
+            setattr(ncdataset, 'UUID', str(uuid.uuid4()))
+
+        # Link the store and trajectory files.
+        if trajectory_ncfile is not ncfile:
+            setattr(ncfile, 'trajectory_file', os.path.relpath(trajectory_filename, store_directory))
+            setattr(trajectory_ncfile, 'store_file', os.path.relpath(os.path.abspath(self.store_filename),
+                                                                     os.path.dirname(trajectory_filename)))
+            setattr(trajectory_ncfile, 'store_file_UUID', ncfile.UUID)
+
+        # Determine the encoding of the positions.
+        positions_precision = self.positions_precision / unit.nanometers
+        least_significant_digit = None
+        if self.positions_encoding == 'float':
+            positions_datatype = 'f4'
+            if positions_precision > 0.0:
+                least_significant_digit = int(math.ceil(-math.log10(positions_precision)))
+        elif self.positions_encoding in POSITIONS_INTEGER_ENCODINGS:
+            positions_datatype = POSITIONS_INTEGER_ENCODINGS[self.positions_encoding]
+            if positions_precision <= 0.0:
+                raise ParameterException("positions_encoding '%s' requires a positions_precision greater than 0." % self.positions_encoding)
+        else:
+            raise ParameterException("Positions encoding '%s' unknown. Valid encodings are float, %s." % (self.positions_encoding, ', '.join(sorted(POSITIONS_INTEGER_ENCODINGS))))
 
         # Create variables.
-        ncvar_positions = ncfile.createVariable('positions', 'f4', ('iteration','replica','atom','spatial'), zlib=True, chunksizes=(1,self.nreplicas,self.natoms,3))
-        ncvar_states    = ncfile.createVariable('states', 'i4', ('iteration','replica'), zlib=False, chunksizes=(1,self.nreplicas))
-        ncvar_energies  = ncfile.createVariable('energies', 'f8', ('iteration','replica','replica'), zlib=False, chunksizes=(1,self.nreplicas,self.nreplicas))
-        ncvar_proposed  = ncfile.createVariable('proposed', 'i4', ('iteration','replica','replica'), zlib=False, chunksizes=(1,self.nreplicas,self.nreplicas))
-        ncvar_accepted  = ncfile.createVariable('accepted', 'i4', ('iteration','replica','replica'), zlib=False, chunksizes=(1,self.nreplicas,self.nreplicas))
-        ncvar_box_vectors = ncfile.createVariable('box_vectors', 'f4', ('iteration','replica','spatial','spatial'), zlib=False, chunksizes=(1,self.nreplicas,3,3))
-        ncvar_volumes  = ncfile.createVariable('volumes', 'f8', ('iteration','replica'), zlib=False, chunksizes=(1,self.nreplicas))
+        ncvar_positions = self._create_netcdf_variable(trajectory_ncfile, 'positions', positions_datatype, ('iteration','replica',trajectory_atom_dimension,'spatial'),
+                                                       least_significant_digit=least_significant_digit)
+        if self.positions_encoding in POSITIONS_INTEGER_ENCODINGS:
+            setattr(ncvar_positions, 'scale_factor', positions_precision)
+        ncvar_states    = self._create_netcdf_variable(ncfile, 'states', 'i4', ('iteration','replica'))
+        ncvar_energies  = self._create_netcdf_variable(ncfile, 'energies', 'f8', ('iteration','replica','replica'))
+        ncvar_proposed  = self._create_netcdf_variable(ncfile, 'proposed', 'i4', ('iteration','replica','replica'))
+        ncvar_accepted  = self._create_netcdf_variable(ncfile, 'accepted', 'i4', ('iteration','replica','replica'))
+        ncvar_box_vectors = self._create_netcdf_variable(ncfile, 'box_vectors', 'f4', ('iteration','replica','spatial','spatial'))
+        ncvar_volumes  = self._create_netcdf_variable(ncfile, 'volumes', 'f8', ('iteration','replica'))
+        ncvar_failures = self._create_netcdf_variable(ncfile, 'failures', 'i1', ('iteration','replica'))
 
         # Define units for variables.
         setattr(ncvar_positions, 'units', 'nm')
@@ -1788,24 +3304,40 @@ class ReplicaExchange(object):
         setattr(ncvar_accepted,  'units', 'none')
         setattr(ncvar_box_vectors, 'units', 'nm')
         setattr(ncvar_volumes, 'units', 'nm**3')
+        setattr(ncvar_failures, 'units', 'none')
 
         # Define long (human-readable) names for variables.
-        setattr(ncvar_positions, "long_name", "positions[iteration][replica][atom][spatial] is position of coordinate 'spatial' of atom 'atom' from replica 'replica' for iteration 'iteration'.")
+        setattr(ncvar_positions, "long_name", "positions[iteration][replica][atom][spatial] is position of coordinate 'spatial' of atom 'atom' from replica 'replica' for iteration 'iteration'. Positions are stored only every positions_write_interval iterations.")
         setattr(ncvar_states,    "long_name", "states[iteration][replica] is the state index (0..nstates-1) of replica 'replica' of iteration 'iteration'.")
         setattr(ncvar_energies,  "long_name", "energies[iteration][replica][state] is the reduced (unitless) energy of replica 'replica' from iteration 'iteration' evaluated at state 'state'.")
         setattr(ncvar_proposed,  "long_name", "proposed[iteration][i][j] is the number of proposed transitions between states i and j from iteration 'iteration-1'.")
         setattr(ncvar_accepted,  "long_name", "accepted[iteration][i][j] is the number of proposed transitions between states i and j from iteration 'iteration-1'.")
         setattr(ncvar_box_vectors, "long_name", "box_vectors[iteration][replica][i][j] is dimension j of box vector i for replica 'replica' from iteration 'iteration-1'.")
         setattr(ncvar_volumes, "long_name", "volume[iteration][replica] is the box volume for replica 'replica' from iteration 'iteration-1'.")
+        setattr(ncvar_failures, "long_name", "failures[iteration][replica] is 1 if replica 'replica' could not be propagated in iteration 'iteration' and kept its previous configuration, 0 otherwise.")
+
+        # Store the indices of the atoms whose positions are stored.
+        if self.positions_atom_indices is not None:
+            ncvar_trajectory_atom_indices = trajectory_ncfile.createVariable('trajectory_atom_indices', 'i4', ('trajectory_atom',))
+            ncvar_trajectory_atom_indices[:] = np.array(self.positions_atom_indices, np.int32)
+            setattr(ncvar_trajectory_atom_indices, "long_name", "trajectory_atom_indices[atom] is the index in the system of atom 'atom' of the positions variable.")
 
         # Create timestamp variable.
-        ncvar_timestamp = ncfile.createVariable('timestamp', str, ('iteration',), zlib=False, chunksizes=(1,))
+        ncvar_timestamp = self._create_netcdf_variable(ncfile, 'timestamp', str, ('iteration',))
 
         # Create group for performance statistics.
         ncgrp_timings = ncfile.createGroup('timings')
-        ncvar_iteration_time = ncgrp_timings.createVariable('iteration', 'f', ('iteration',), zlib=False, chunksizes=(1,)) # total iteration time (seconds)
-        ncvar_iteration_time = ncgrp_timings.createVariable('mixing', 'f', ('iteration',), zlib=False, chunksizes=(1,)) # time for mixing
-        ncvar_iteration_time = ncgrp_timings.createVariable('propagate', 'f', ('iteration','replica'), zlib=False, chunksizes=(1,self.nreplicas)) # total time to propagate each replica
+        ncvar_iteration_time = self._create_netcdf_variable(ncgrp_timings, 'iteration', 'f', ('iteration',)) # total iteration time (seconds)
+        ncvar_iteration_time = self._create_netcdf_variable(ncgrp_timings, 'mixing', 'f', ('iteration',)) # time for mixing
+        ncvar_iteration_time = self._create_netcdf_variable(ncgrp_timings, 'propagate', 'f', ('iteration','replica')) # total time to propagate each replica
+        ncvar_sync_time = self._create_netcdf_variable(ncgrp_timings, 'sync', 'f', ('iteration',)) # time to flush the file to disk, masked if not flushed
+        ncvar_communication_time = self._create_netcdf_variable(ncgrp_timings, 'communication_exposed', 'f', ('iteration',)) # maximum time a node waited for MPI communication, masked without MPI
+        ncgrp_timings.createDimension('rank', self.mpicomm.size if self.mpicomm else 1) # number of MPI processes
+        ncgrp_timings.createDimension('activity', len(RANK_TIMINGS)) # number of timed activities
+        ncvar_rank_timings = self._create_netcdf_variable(ncgrp_timings, 'rank_timings', 'f', ('iteration', 'rank', 'activity'))
+        setattr(ncvar_rank_timings, 'units', 's')
+        setattr(ncvar_rank_timings, 'activities', ' '.join(RANK_TIMINGS))
+        setattr(ncvar_rank_timings, 'long_name', "rank_timings[iteration][rank][activity] is the time spent by MPI process 'rank' in iteration 'iteration' in the activity 'activity' (one of the space-separated names in the 'activities' attribute).")
 
         # Store thermodynamic states.
         self._store_thermodynamic_states(ncfile)
@@ -1818,13 +3350,89 @@ class ReplicaExchange(object):
             self._store_metadata(ncfile)
 
         # Force sync to disk to avoid data loss.
+        trajectory_ncfile.sync()
         ncfile.sync()
 
-        # Store netcdf file handle.
+        # Store netcdf file handles.
         self.ncfile = ncfile
+        self.trajectory_ncfile = trajectory_ncfile
 
         return
 
+    def _close_netcdf(self):
+        """
+        Close the store file and, if positions are stored separately, the trajectory file.
+
+        """
+        trajectory_ncfile = getattr(self, 'trajectory_ncfile', None)
+        if trajectory_ncfile is not None and trajectory_ncfile is not self.ncfile:
+            trajectory_ncfile.close()
+        self.trajectory_ncfile = None
+        if self.ncfile is not None:
+            self.ncfile.close()
+            self.ncfile = None
+
+    def _create_netcdf_variable(self, ncgrp, variable_name, datatype, dimensions, least_significant_digit=None):
+        """
+        Create a per-iteration variable with the chunking and compression set by the storage options.
+
+        Parameters
+        ----------
+        ncgrp : netCDF4.Group
+           The group in which the variable is created.
+        variable_name : str
+           The name of the variable.
+        datatype : str or type
+           The NetCDF datatype of the variable (e.g. 'f4' or str).
+        dimensions : tuple of str
+           The dimensions of the variable. The first one must be 'iteration'.
+        least_significant_digit : int, optional, default=None
+           If specified, the data is quantized to retain this number of decimal digits.
+
+        Returns
+        -------
+        ncvar : netCDF4.Variable
+           The created variable.
+
+        """
+        is_string = datatype is str
+        itemsize = 8 if is_string else np.dtype(datatype).itemsize
+        shape = tuple(_get_netcdf_dimension_size(ncgrp, dimension) for dimension in dimensions)
+        chunksizes = compute_netcdf_chunksizes(dimensions, shape, itemsize, self.storage_chunk_iterations)
+        return ncgrp.createVariable(variable_name, datatype, dimensions, chunksizes=chunksizes,
+                                    zlib=self.storage_zlib and not is_string,
+                                    complevel=self.storage_complevel, shuffle=self.storage_shuffle,
+                                    least_significant_digit=least_significant_digit)
+
+    def _quantize_positions(self, x, ncvar_positions):
+        """
+        Encode positions as integer multiples of the scale factor of the positions variable.
+
+        Automatic scaling is disabled on the variable so that the quantized values are written as they are.
+
+        Parameters
+        ----------
+        x : np.ndarray
+           Positions in nanometers.
+        ncvar_positions : netCDF4.Variable
+           The integer positions variable with a scale_factor attribute.
+
+        Returns
+        -------
+        quantized_x : np.ndarray
+           The positions in units of scale_factor with the datatype of the variable.
+
+        """
+        ncvar_positions.set_auto_scale(False)
+        quantized_x = np.round(x / ncvar_positions.scale_factor)
+        # The minimum value of the integer type is reserved to the NetCDF fill value.
+        iinfo = np.iinfo(ncvar_positions.dtype)
+        if quantized_x.min() < iinfo.min + 2 or quantized_x.max() > iinfo.max:
+            raise ValueError("Positions at iteration %d exceed the range representable with encoding '%s' and precision %s. "
+                             "Use a larger positions_precision or int32 encoding." % (self.iteration, self.positions_encoding,
+                                                                                      str(self.positions_precision)))
+        return quantized_x.astype(ncvar_positions.dtype)
+
     @delayed_termination
     def _write_iteration_netcdf(self):
         """
@@ -1839,10 +3447,16 @@ class ReplicaExchange(object):
         initial_time = time.time()
 
         # Store replica positions.
-        for replica_index in range(self.nstates):
-            positions = self.replica_positions[replica_index]
-            x = positions / unit.nanometers
-            self.ncfile.variables['positions'][self.iteration,replica_index,:,:] = x[:,:]
+        if self.iteration % self.positions_write_interval == 0:
+            ncvar_positions = self.trajectory_ncfile.variables['positions']
+            for replica_index in range(self.nstates):
+                positions = self.replica_positions[replica_index]
+                x = positions / unit.nanometers
+                if self.positions_atom_indices is not None:
+                    x = x[self.positions_atom_indices,:]
+                if self.positions_encoding in POSITIONS_INTEGER_ENCODINGS:
+                    x = self._quantize_positions(x, ncvar_positions)
+                ncvar_positions[self.iteration,replica_index,:,:] = x[:,:]
 
         # Store box vectors and volume.
         for replica_index in range(self.nstates):
@@ -1857,6 +3471,10 @@ class ReplicaExchange(object):
         # Store state information.
         self.ncfile.variables['states'][self.iteration,:] = self.replica_states[:]
 
+        # Store replicas that could not be propagated (not available in files created by older versions).
+        if 'failures' in self.ncfile.variables:
+            self.ncfile.variables['failures'][self.iteration,:] = self._failed_replicas.astype(np.int8)
+
         # Store energies.
         self.ncfile.variables['energies'][self.iteration,:,:] = self.u_kl[:,:]
 
@@ -1864,22 +3482,120 @@ class ReplicaExchange(object):
         # TODO: Write mixing statistics for this iteration?
         self.ncfile.variables['proposed'][self.iteration,:,:] = self.Nij_proposed[:,:]
         self.ncfile.variables['accepted'][self.iteration,:,:] = self.Nij_accepted[:,:]
+        self._Nij_proposed_total += self.Nij_proposed
+        self._Nij_accepted_total += self.Nij_accepted
+
+        # Store the time spent waiting for MPI communication.
+        ncgrp_timings = self.ncfile.groups['timings']
+        if self.mpicomm and 'communication_exposed' in ncgrp_timings.variables:
+            ncgrp_timings.variables['communication_exposed'][self.iteration] = self._communication_time
+        self._communication_time = 0.0
+
+        # Store the time spent propagating each replica.
+        ncgrp_timings.variables['propagate'][self.iteration,:] = self._replica_propagation_times[:]
 
         # Store timestamp this iteration was written.
         self.ncfile.variables['timestamp'][self.iteration] = time.ctime()
 
-        # Force sync to disk to avoid data loss.
-        presync_time = time.time()
-        self.ncfile.sync()
+        # Overwrite restart information.
+        self._write_checkpoint_netcdf()
 
         # Print statistics.
-        final_time = time.time()
-        sync_time = final_time - presync_time
-        elapsed_time = final_time - initial_time
-        logger.debug("Writing data to NetCDF file took %.3f s (%.3f s for sync)" % (elapsed_time, sync_time))
+        elapsed_time = time.time() - initial_time
+        logger.debug("Writing data to NetCDF file took %.3f s" % elapsed_time)
 
         return
 
+    @delayed_termination
+    def _sync_netcdf(self, force=False):
+        """
+        Flush the store file to disk according to the sync policy.
+
+        The file is flushed if storage_sync_interval iterations or storage_sync_seconds seconds
+        have passed since the last flush. The time spent flushing is recorded in timings/sync at
+        the last written iteration, unless it was already flushed.
+
+        Parameters
+        ----------
+        force : bool, optional, default=False
+           If True, the file is flushed regardless of the sync policy.
+
+        """
+        if self.mpicomm:
+            # Only the root node writes data.
+            if self.mpicomm.rank != 0: return
+        if not getattr(self, 'ncfile', None):
+            return
+
+        # After the iteration counter is incremented, the last written iteration is the previous one.
+        last_written_iteration = min(self.iteration, len(self.ncfile.dimensions['iteration']) - 1)
+        if not force:
+            iterations_since_sync = self.iteration - self._last_sync_iteration
+            seconds_since_sync = time.time() - self._last_sync_time
+            if not ((self.storage_sync_interval > 0 and iterations_since_sync >= self.storage_sync_interval) or
+                    (self.storage_sync_seconds > 0 and seconds_since_sync >= self.storage_sync_seconds)):
+                return
+
+        # Sync the trajectory file first so that the store file is never ahead of it on disk.
+        presync_time = time.time()
+        if self.trajectory_ncfile is not self.ncfile:
+            self.trajectory_ncfile.sync()
+        self.ncfile.sync()
+        sync_time = time.time() - presync_time
+        flushed_new_iterations = last_written_iteration > getattr(self, '_last_sync_iteration', -1)
+        self._last_sync_iteration = last_written_iteration
+        self._last_sync_time = time.time()
+        logger.debug("Syncing NetCDF file took %.3f s" % sync_time)
+
+        # Record sync latency. Files created by previous versions don't have the variable.
+        ncgrp_timings = self.ncfile.groups['timings']
+        if 'sync' in ncgrp_timings.variables and flushed_new_iterations:
+            ncgrp_timings.variables['sync'][last_written_iteration] = sync_time
+
+    def _write_checkpoint_netcdf(self):
+        """
+        Overwrite the restart information in the 'checkpoint' group with the data of the current iteration.
+
+        Differently from the per-iteration variables, the checkpoint group holds only the data of the
+        last written iteration, which is needed to resume the simulation. The positions of all atoms
+        are checkpointed only if the positions variable does not store them at every iteration with
+        full precision. Positions and velocities are stored in single precision like the positions
+        variable, so that rewriting the checkpoint does not cost more I/O than storing the positions.
+
+        """
+        store_positions = ((self.positions_write_interval != 1) or (self.positions_atom_indices is not None) or
+                           (self.positions_encoding != 'float') or (self.positions_precision / unit.nanometers > 0.0))
+        store_velocities = self.persist_velocities and all(velocities is not None for velocities in self.replica_velocities)
+        if not (store_positions or store_velocities):
+            return
+
+        if 'checkpoint' not in self.trajectory_ncfile.groups:
+            ncgrp_checkpoint = self.trajectory_ncfile.createGroup('checkpoint')
+            ncvar_iteration = ncgrp_checkpoint.createVariable('iteration', 'i4')
+            setattr(ncvar_iteration, "long_name", "iteration is the iteration whose restart information is stored in the group.")
+        ncgrp_checkpoint = self.trajectory_ncfile.groups['checkpoint']
+
+        if store_positions:
+            if 'positions' not in ncgrp_checkpoint.variables:
+                ncvar_positions = ncgrp_checkpoint.createVariable('positions', 'f4', ('replica','atom','spatial'))
+                setattr(ncvar_positions, 'units', 'nm')
+                setattr(ncvar_positions, "long_name", "positions[replica][atom][spatial] is the position of coordinate 'spatial' of atom 'atom' from replica 'replica' at the end of the checkpoint iteration.")
+            for replica_index in range(self.nstates):
+                ncgrp_checkpoint.variables['positions'][replica_index,:,:] = self.replica_positions[replica_index] / unit.nanometers
+
+        if store_velocities:
+            if 'velocities' not in ncgrp_checkpoint.variables:
+                ncvar_velocities = ncgrp_checkpoint.createVariable('velocities', 'f4', ('replica','atom','spatial'))
+                ncvar_velocities_states = ncgrp_checkpoint.createVariable('velocities_states', 'i4', ('replica',))
+                setattr(ncvar_velocities, 'units', 'nm/ps')
+                setattr(ncvar_velocities, "long_name", "velocities[replica][atom][spatial] is the velocity of coordinate 'spatial' of atom 'atom' from replica 'replica' at the end of the checkpoint iteration.")
+                setattr(ncvar_velocities_states, "long_name", "velocities_states[replica] is the state whose temperature the velocities of replica 'replica' were generated at.")
+            for replica_index in range(self.nstates):
+                ncgrp_checkpoint.variables['velocities'][replica_index,:,:] = self.replica_velocities[replica_index] / (unit.nanometers / unit.picoseconds)
+            ncgrp_checkpoint.variables['velocities_states'][:] = self.replica_velocities_states[:]
+
+        ncgrp_checkpoint.variables['iteration'].assignValue(self.iteration)
+
     def _run_sanity_checks(self):
         """
         Run some checks on current state information to see if something has gone wrong that precludes continuation.
@@ -1942,14 +3658,32 @@ class ReplicaExchange(object):
 
         # TODO: Store other thermodynamic variables store in ThermodynamicState?  Generalize?
 
-        # Systems.
-        ncvar_serialized_states = ncgrp_stateinfo.createVariable('systems', str, ('replica',), zlib=True)
-        setattr(ncvar_serialized_states, 'long_name', "systems[state] is the serialized OpenMM System corresponding to the thermodynamic state 'state'")
+        # Systems. States often share the same System (e.g. parallel tempering), so each
+        # distinct System is serialized and stored only once.
+        serialized_systems = list()
+        system_indices = list()
+        system_indices_by_id = dict() # system_indices_by_id[id(system)] is the index of the system in serialized_systems
+        system_indices_by_hash = dict() # system_indices_by_hash[hash] is the index of the system in serialized_systems
         for state_index in range(self.nstates):
-            logger.debug("Serializing state %d..." % state_index)
-            serialized = self.states[state_index].system.__getstate__()
-            logger.debug("Serialized state is %d B | %.3f KB | %.3f MB" % (len(serialized), len(serialized) / 1024.0, len(serialized) / 1024.0 / 1024.0))
-            ncvar_serialized_states[state_index] = serialized
+            system = self.states[state_index].system
+            if id(system) not in system_indices_by_id:
+                logger.debug("Serializing state %d..." % state_index)
+                serialized = system.__getstate__()
+                logger.debug("Serialized state is %d B | %.3f KB | %.3f MB" % (len(serialized), len(serialized) / 1024.0, len(serialized) / 1024.0 / 1024.0))
+                serialized_hash = hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+                if serialized_hash not in system_indices_by_hash:
+                    system_indices_by_hash[serialized_hash] = len(serialized_systems)
+                    serialized_systems.append(serialized)
+                system_indices_by_id[id(system)] = system_indices_by_hash[serialized_hash]
+            system_indices.append(system_indices_by_id[id(system)])
+        logger.debug("Storing %d distinct systems for %d states." % (len(serialized_systems), self.nstates))
+
+        ncgrp_stateinfo.createDimension('system', len(serialized_systems))
+        ncvar_serialized_states = store_serialized_systems(ncgrp_stateinfo, 'systems', ('system',), serialized_systems)
+        setattr(ncvar_serialized_states, 'long_name', "systems[system] is the serialized OpenMM System with index 'system'")
+        ncvar_system_indices = ncgrp_stateinfo.createVariable('system_indices', 'i4', ('replica',))
+        setattr(ncvar_system_indices, 'long_name', "system_indices[state] is the index of the System of thermodynamic state 'state'")
+        ncvar_system_indices[:] = system_indices
         final_time = time.time()
         elapsed_time = final_time - initial_time
 
@@ -1975,8 +3709,15 @@ class ReplicaExchange(object):
         # Get number of states.
         self.nstates = ncgrp_stateinfo.variables['nstates'].getValue()
 
-        # Read state information.
+        # Files created by previous versions store one System for each state.
+        if 'system_indices' in ncgrp_stateinfo.variables:
+            system_indices = ncgrp_stateinfo.variables['system_indices'][:]
+        else:
+            system_indices = range(self.nstates)
+
+        # Read state information. Systems are deserialized only when they are first needed.
         self.states = list()
+        system_loaders = dict() # system_loaders[system_index] loads the System shared by all states using it
         for state_index in range(self.nstates):
             # Populate a new ThermodynamicState object.
             state = ThermodynamicState()
@@ -1986,8 +3727,10 @@ class ReplicaExchange(object):
             if 'pressures' in ncgrp_stateinfo.variables:
                 state.pressure = float(ncgrp_stateinfo.variables['pressures'][state_index]) * unit.atmospheres
             # Reconstitute System object.
-            state.system = self.mm.System()
-            state.system.__setstate__(str(ncgrp_stateinfo.variables['systems'][state_index]))
+            system_index = int(system_indices[state_index])
+            if system_index not in system_loaders:
+                system_loaders[system_index] = lazy_system_loader(ncgrp_stateinfo.variables['systems'], system_index, self.mm.System)
+            state.set_system_loader(system_loaders[system_index])
             # Store state.
             self.states.append(state)
 
@@ -2116,13 +3859,17 @@ class ReplicaExchange(object):
             type_name = getattr(option_ncvar, 'type')
             # TODO: Remove the if/elseif structure into one handy function
             # Get option value.
-            if type_name == 'NoneType':
+            # The type of None is 'NoneType' in Python 2 and 'builtins.NoneType' in Python 3.
+            if type_name.rsplit('.', 1)[-1] == 'NoneType':
                 option_value = None
             else: # Handle all Types not None
                 option_type = self._convert_netcdf_store_type(type_name)
                 if option_ncvar.shape == ():
                     # Handle Standard Types
                     option_value = option_type(option_ncvar.getValue())
+                elif option_type is str:
+                    # Strings are stored in the length-1 'scalar' dimension.
+                    option_value = str(option_ncvar[0])
                 elif (option_ncvar.shape[0] >= 0):
                     # Handle array types
                     option_value = np.array(option_ncvar[:], option_type)
@@ -2252,18 +3999,19 @@ class ReplicaExchange(object):
         # TODO: Perform sanity check on file before resuming
 
         # Get current dimensions.
-        self.iteration = ncfile.variables['positions'].shape[0] - 1
-        self.nstates = ncfile.variables['positions'].shape[1]
-        self.natoms = ncfile.variables['positions'].shape[2]
+        self.iteration = ncfile.variables['states'].shape[0] - 1
+        self.nstates = ncfile.variables['states'].shape[1]
+        self.natoms = len(ncfile.dimensions['atom'])
         self.nreplicas = self.nstates
         logger.debug("iteration = %d, nstates = %d, natoms = %d" % (self.iteration, self.nstates, self.natoms))
 
-        # Restore positions.
-        self.replica_positions = list()
-        for replica_index in range(self.nstates):
-            x = ncfile.variables['positions'][self.iteration,replica_index,:,:].astype(np.float64).copy()
-            positions = unit.Quantity(x, unit.nanometers)
-            self.replica_positions.append(positions)
+        # Positions and checkpoint may be stored in a separate trajectory file.
+        trajectory_ncfile = open_trajectory_file(ncfile, self.store_filename)
+        try:
+            self._resume_positions_from_netcdf(trajectory_ncfile)
+        finally:
+            if trajectory_ncfile is not ncfile:
+                trajectory_ncfile.close()
 
         # Restore box vectors.
         self.replica_box_vectors = list()
@@ -2278,6 +4026,60 @@ class ReplicaExchange(object):
         # Restore energies.
         self.u_kl = ncfile.variables['energies'][self.iteration,:,:].copy()
 
+        # Restore the number of swaps proposed and accepted in all stored iterations.
+        self._Nij_proposed_total = np.array(ncfile.variables['proposed'][:,:,:].sum(0), np.int64)
+        self._Nij_accepted_total = np.array(ncfile.variables['accepted'][:,:,:].sum(0), np.int64)
+
+        # The timings of each MPI process can be stored only if their number did not change.
+        ncgrp_timings = ncfile.groups['timings']
+        nranks = self.mpicomm.size if self.mpicomm else 1
+        if 'rank_timings' in ncgrp_timings.variables and len(ncgrp_timings.dimensions['rank']) != nranks:
+            logger.warning("The store file was created with %d MPI processes and the simulation is resumed with %d. "
+                           "The timings of each process will not be stored." % (len(ncgrp_timings.dimensions['rank']), nranks))
+
+    def _resume_positions_from_netcdf(self, trajectory_ncfile):
+        """
+        Restore positions and velocities of the last iteration.
+
+        Parameters
+        ----------
+        trajectory_ncfile : netcdf.Dataset
+            The NetCDF file storing positions and the checkpoint group.
+
+        """
+        # Restore the subset of atoms whose positions are stored.
+        if 'trajectory_atom_indices' in trajectory_ncfile.variables:
+            self.positions_atom_indices = trajectory_ncfile.variables['trajectory_atom_indices'][:].tolist()
+
+        # Restore positions from the checkpoint if the last iteration is not fully stored in the trajectory.
+        ncgrp_checkpoint = trajectory_ncfile.groups.get('checkpoint', None)
+        if (ncgrp_checkpoint is not None and 'positions' in ncgrp_checkpoint.variables and
+                int(ncgrp_checkpoint.variables['iteration'].getValue()) == self.iteration):
+            all_positions = ncgrp_checkpoint.variables['positions'][:,:,:]
+        elif ('trajectory_atom_indices' not in trajectory_ncfile.variables and self.iteration % self.positions_write_interval == 0 and
+                self.iteration < trajectory_ncfile.variables['positions'].shape[0]):
+            all_positions = trajectory_ncfile.variables['positions'][self.iteration,:,:,:]
+        else:
+            raise Exception("Cannot find the positions of all atoms for iteration %d to resume from." % self.iteration)
+        self.replica_positions = list()
+        for replica_index in range(self.nstates):
+            x = all_positions[replica_index,:,:].astype(np.float64).copy()
+            positions = unit.Quantity(x, unit.nanometers)
+            self.replica_positions.append(positions)
+
+        # Restore velocities if they were checkpointed at this iteration.
+        self.replica_velocities = [None] * self.nstates
+        self.replica_velocities_states = np.zeros([self.nstates], np.int64)
+        if self.persist_velocities and ('checkpoint' in trajectory_ncfile.groups):
+            ncgrp_checkpoint = trajectory_ncfile.groups['checkpoint']
+            if int(ncgrp_checkpoint.variables['iteration'].getValue()) == self.iteration:
+                for replica_index in range(self.nstates):
+                    x = ncgrp_checkpoint.variables['velocities'][replica_index,:,:].astype(np.float64).copy()
+                    self.replica_velocities[replica_index] = unit.Quantity(x, unit.nanometers / unit.picoseconds)
+                self.replica_velocities_states[:] = ncgrp_checkpoint.variables['velocities_states'][:]
+            else:
+                logger.warning("Checkpointed velocities do not belong to the last iteration; velocities will be redrawn.")
+
     def _show_energies(self):
         """
         Show energies (in units of kT) for all replicas at all states.
@@ -2650,7 +4452,9 @@ class ParallelTempering(ReplicaExchange):
             integrator = self.mm.VerletIntegrator(self.timestep)
             context = self._create_context(state.system, integrator)
 
-            for replica_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
+            replica_indices_per_rank = self._mpi_replica_indices_per_rank()
+            node_replica_indices = replica_indices_per_rank[self.mpicomm.rank]
+            for replica_index in node_replica_indices:
                 # Set positions.
                 context.setPositions(self.replica_positions[replica_index])
                 # Compute potential energy.
@@ -2663,11 +4467,9 @@ class ParallelTempering(ReplicaExchange):
                     self.u_kl[replica_index,state_index] = beta * potential_energy
 
             # Gather energies.
-            energies_gather = self.mpicomm.allgather(self.u_kl[self.mpicomm.rank:self.nstates:self.mpicomm.size,:])
-            for replica_index in range(self.nstates):
-                source = replica_index % self.mpicomm.size # node with trajectory data
-                index = replica_index // self.mpicomm.size # index within trajectory batch
-                self.u_kl[replica_index,:] = energies_gather[source][index]
+            communication_start_time = time.time()
+            mpi_allgather_rows(self.mpicomm, self.u_kl[node_replica_indices,:], replica_indices_per_rank, self.u_kl)
+            self._communication_time += time.time() - communication_start_time
 
             # Clean up.
             del context, integrator
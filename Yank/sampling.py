@@ -25,9 +25,19 @@ from simtk import openmm, unit
 from .repex import ThermodynamicState
 from .repex import ReplicaExchange
 from .repex import MAX_SEED
+from .repex import ParameterException
+from .repex import store_serialized_systems, load_serialized_system, lazy_system_loader
+from .utils import mpi_allgather_rows
 
 from alchemy import AbsoluteAlchemicalFactory, AlchemicalState
 
+#=============================================================================================
+# MODULE CONSTANTS
+#=============================================================================================
+
+MAX_NAN_RETRIES = 6 # maximum number of times a block of dynamics is retried after encountering a NaN
+NAN_ERROR_MESSAGES = ['Particle coordinate is nan', 'Potential energy is nan'] # errors that trigger a NaN retry
+
 #=============================================================================================
 # Alchemical Modified Hamiltonian exchange class.
 #=============================================================================================
@@ -75,8 +85,24 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
 
     """
 
+    default_parameters = dict(ReplicaExchange.default_parameters,
+                              nan_checkpoint_steps=0,
+                              nan_retry_timestep_scale=1.0,
+                              expanded_cutoff_stride=1,
+                              cache_expanded_cutoff_contexts=True,
+                              mcmc_moves=None)
+
     # Options to store.
-    options_to_store = ReplicaExchange.options_to_store + ['mc_atoms', 'mc_displacement', 'mc_rotation', 'displacement_sigma', 'displacement_trials_accepted', 'rotation_trials_accepted']
+    options_to_store = ReplicaExchange.options_to_store + ['mc_atoms', 'mc_displacement', 'mc_rotation', 'displacement_sigma', 'displacement_trials_accepted', 'rotation_trials_accepted',
+                                                           'nan_checkpoint_steps', 'nan_retry_timestep_scale',
+                                                           'expanded_cutoff_stride', 'cache_expanded_cutoff_contexts', 'mcmc_moves']
+
+    # Attributes restored by _restore_thermodynamic_states() that are kept in the resume cache.
+    _resume_cache_attributes = ReplicaExchange._resume_cache_attributes + ['base_system', 'fully_interacting_expanded_state',
+                                                                           'noninteracting_expanded_state']
+
+    # MCMC moves applied to each replica every iteration if mcmc_moves is None.
+    default_mcmc_moves = ['displacement', 'rotation', 'dynamics']
 
     def __init__(self, store_filename, **kwargs):
         """Constructor.
@@ -88,12 +114,33 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         store_filename : string
            Name of file to bind simulation to use as storage for checkpointing and storage of results.
 
+        Other Parameters
+        ----------------
+        nan_checkpoint_steps : int, optional, default=0
+           Number of steps in each block of dynamics after which an in-memory checkpoint of positions,
+           velocities and box vectors is taken. When a NaN is encountered, only the failed block is
+           rolled back and retried. If 0, each iteration is integrated as a single block.
+        nan_retry_timestep_scale : float, optional, default=1.0
+           The timestep of a block is multiplied by this factor at each retry after a NaN (e.g. 0.5
+           halves the timestep at the first retry). The original timestep is restored afterwards.
+        expanded_cutoff_stride : int, optional, default=1
+           Energies at the expanded cutoff states are evaluated only every expanded_cutoff_stride
+           iterations. Skipped iterations are left as fill values in the NetCDF file.
+        cache_expanded_cutoff_contexts : bool, optional, default=True
+           If False, the Contexts of the expanded cutoff states are freed after each evaluation
+           to save memory, and re-created when needed.
+        mcmc_moves : list of str, optional, default=None
+           The sequence of moves applied to each replica every iteration, chosen among 'displacement',
+           'rotation' (Monte Carlo moves of mc_atoms) and 'dynamics'. Moves can be repeated. If None,
+           default_mcmc_moves is used.
+
         """
         super(ModifiedHamiltonianExchange, self).__init__(store_filename, **kwargs)
         self._fully_interacting_expanded_context = None
         self.fully_interacting_expanded_state = None
         self._noninteracting_expanded_context = None
         self.noninteracting_expanded_state = None
+        self._expanded_cutoff_energies_evaluated = False
 
     def create(self, base_state, alchemical_states, positions, displacement_sigma=None, mc_atoms=None, options=None, metadata=None, fully_interacting_expanded_state=None, noninteracting_expanded_state=None):
         """
@@ -252,9 +299,8 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         logger.debug("Serializing system...")
         if 'scalar' not in ncfile.dimensions:
             ncfile.createDimension('scalar', 1) # scalar dimension
-        ncvar_serialized_base_system = ncgrp_stateinfo.createVariable('base_system', str, ('scalar',), zlib=True)
+        ncvar_serialized_base_system = store_serialized_systems(ncgrp_stateinfo, 'base_system', ('scalar',), [self.base_system.__getstate__()])
         setattr(ncvar_serialized_base_system, 'long_name', "baseline is the serialized OpenMM System corresponding to the reference System object")
-        ncvar_serialized_base_system[0] = self.base_system.__getstate__() # serialize reference system.
 
         # Expanded cutoffs
         if (self.fully_interacting_expanded_state is not None) and (self.noninteracting_expanded_state is not None):
@@ -273,12 +319,12 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                     ncvar_pressures[0] = self.fully_interacting_expanded_state.pressure / pressure_unit
             # System
             logger.debug("Serializing systems...")
-            ncvar_serialized_fully_interacting_expanded_system = ncgrp_stateinfo.createVariable('fully_interacting_expanded_system', str, ('scalar',), zlib=True)
-            ncvar_serialized_noninteracting_expanded_system = ncgrp_stateinfo.createVariable('noninteracting_expanded_system', str, ('scalar',), zlib=True)
+            ncvar_serialized_fully_interacting_expanded_system = store_serialized_systems(ncgrp_stateinfo, 'fully_interacting_expanded_system', ('scalar',),
+                                                                                          [self.fully_interacting_expanded_state.system.__getstate__()])
+            ncvar_serialized_noninteracting_expanded_system = store_serialized_systems(ncgrp_stateinfo, 'noninteracting_expanded_system', ('scalar',),
+                                                                                       [self.noninteracting_expanded_state.system.__getstate__()])
             setattr(ncvar_serialized_fully_interacting_expanded_system, 'long_name', "the serialized OpenMM System corresponding to the all forces reference state with expanded cutoff")
             setattr(ncvar_serialized_noninteracting_expanded_system, 'long_name', "the serialized OpenMM System corresponding to the no alchemical forces reference state with expanded cutoff")
-            ncvar_serialized_fully_interacting_expanded_system[0] = self.fully_interacting_expanded_state.system.__getstate__()
-            ncvar_serialized_noninteracting_expanded_system[0] = self.noninteracting_expanded_state.system.__getstate__()
 
         # Report timing information.
         final_time = time.time()
@@ -314,7 +360,7 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         self.states = list()
         # Read reference system
         self.base_system = self.mm.System()
-        self.base_system.__setstate__(str(ncgrp_stateinfo.variables['base_system'][0]))
+        self.base_system.__setstate__(load_serialized_system(ncgrp_stateinfo.variables['base_system']))
         # Read other parameters.
         for state_index in range(self.nstates):
             # Populate a new ThermodynamicState object.
@@ -346,12 +392,11 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
             if 'pressures' in ncgrp_stateinfo.variables:
                  fully_interacting_expanded_state.pressure = float(ncgrp_stateinfo.variables['pressures'][0]) * pressure_unit
                  noninteracting_expanded_state.pressure = float(ncgrp_stateinfo.variables['pressures'][0]) * pressure_unit
-            # Set System object
-            fully_interacting_expanded_state.system = self.mm.System()
-            noninteracting_expanded_state.system = self.mm.System()
-
-            fully_interacting_expanded_state.system.__setstate__(str(ncgrp_stateinfo.variables['fully_interacting_expanded_system'][0]))
-            noninteracting_expanded_state.system.__setstate__(str(ncgrp_stateinfo.variables['noninteracting_expanded_system'][0]))
+            # Set System objects, which are deserialized only when expanded cutoff energies are first computed.
+            fully_interacting_expanded_state.set_system_loader(lazy_system_loader(ncgrp_stateinfo.variables['fully_interacting_expanded_system'],
+                                                                                  system_class=self.mm.System))
+            noninteracting_expanded_state.set_system_loader(lazy_system_loader(ncgrp_stateinfo.variables['noninteracting_expanded_system'],
+                                                                               system_class=self.mm.System))
 
             self.fully_interacting_expanded_state = fully_interacting_expanded_state
             self.noninteracting_expanded_state = noninteracting_expanded_state
@@ -372,33 +417,63 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         initial_time = time.time()
         logger.debug("Creating and caching Context and Integrator.")
         state = self.states[0]
-        self._integrator = openmm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
-        self._integrator.setRandomNumberSeed(int(np.random.randint(0, MAX_SEED)))
+        self._integrator = self._create_integrator(state.temperature, state.system)
         self._context = self._create_context(state.system, self._integrator)
         final_time = time.time()
         elapsed_time = final_time - initial_time
         logger.debug("Context creation took %.3f s." % elapsed_time)
 
-        # Create Contexts to compute expanded cutoff states
-        if (self.fully_interacting_expanded_state is not None) and (self.noninteracting_expanded_state is not None):
+        return
+
+    def _reset_propagation_context(self):
+        """
+        Discard the cached Context and Integrator so that they are recreated for the next propagation.
+
+        """
+        if hasattr(self, '_context'):
+            del self._context, self._integrator
+
+    def _get_expanded_cutoff_contexts(self):
+        """
+        Return the Contexts of the fully interacting and noninteracting expanded cutoff states.
+
+        Contexts are created the first time they are needed and cached only if
+        cache_expanded_cutoff_contexts is True (see _free_expanded_cutoff_contexts).
+
+        Returns
+        -------
+        fully_interacting_expanded_context : simtk.openmm.Context
+           The Context of the fully interacting state with expanded cutoff.
+        noninteracting_expanded_context : simtk.openmm.Context
+           The Context of the noninteracting state with expanded cutoff.
+
+        """
+        if self._fully_interacting_expanded_context is None:
             initial_time = time.time()
-            logger.debug("Creating and caching Contexts and Integrators for to compute fully interacting state.")
-            fully_interacting_expanded_state = self.fully_interacting_expanded_state
-            noninteracting_expanded_state = self.noninteracting_expanded_state
+            logger.debug("Creating Contexts and Integrators to compute expanded cutoff states.")
 
             fully_interacting_expanded_state_integrator = openmm.VerletIntegrator(self.timestep)
             noninteracting_expanded_state_integrator = openmm.VerletIntegrator(self.timestep)
 
-            self._fully_interacting_expanded_context = self._create_context(fully_interacting_expanded_state.system,
+            self._fully_interacting_expanded_context = self._create_context(self.fully_interacting_expanded_state.system,
                                                                             fully_interacting_expanded_state_integrator)
-            self._noninteracting_expanded_context = self._create_context(noninteracting_expanded_state.system,
-                                                                            noninteracting_expanded_state_integrator)
+            self._noninteracting_expanded_context = self._create_context(self.noninteracting_expanded_state.system,
+                                                                         noninteracting_expanded_state_integrator)
 
             final_time = time.time()
             elapsed_time = final_time - initial_time
             logger.debug("Expanded cutoff Contexts creation took %.3f s." % elapsed_time)
 
-        return
+        return self._fully_interacting_expanded_context, self._noninteracting_expanded_context
+
+    def _free_expanded_cutoff_contexts(self):
+        """
+        Delete the Contexts of the expanded cutoff states unless they must be cached.
+
+        """
+        if not self.cache_expanded_cutoff_contexts:
+            self._fully_interacting_expanded_context = None
+            self._noninteracting_expanded_context = None
 
     def _finalize(self):
         """
@@ -589,11 +664,30 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         positions = unit.Quantity(x, positions_unit)
         return positions
 
-    def _minimize_replica(self, replica_index):
+    def _minimization_state_key(self, state_index):
+        """
+        Return a key identifying the potential energy function of a state.
+
+        All states share the same System, so they differ only by their alchemical parameters.
+
+        """
+        return tuple(sorted(self.states[state_index].alchemical_state.items()))
+
+    def _minimize_replica(self, replica_index, max_iterations=None):
         """
         Minimize the specified replica.
 
+        Parameters
+        ----------
+        replica_index : int
+           The index of the replica to minimize.
+        max_iterations : int, optional, default=None
+           Maximum number of minimization iterations. If None, minimize_max_iterations is used.
+
         """
+        if max_iterations is None:
+            max_iterations = self.minimize_max_iterations
+
         # Create and cache Integrator and Context if needed.
         if not hasattr(self, '_context'):
             self._cache_context()
@@ -619,7 +713,7 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         logger.debug("Replica %5d/%5d: initial energy %8.3f kT", replica_index, self.nstates, state.reduced_potential(positions, box_vectors=box_vectors, context=context))
 
         # Minimize energy.
-        self.mm.LocalEnergyMinimizer.minimize(context, self.minimize_tolerance, self.minimize_max_iterations)
+        self.mm.LocalEnergyMinimizer.minimize(context, self.minimize_tolerance, max_iterations)
 
         # Store final positions
         positions = context.getState(getPositions=True, enforcePeriodicBox=state.system.usesPeriodicBoundaryConditions()).getPositions(asNumpy=True)
@@ -631,7 +725,9 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
 
     def _propagate_replica(self, replica_index):
         """
-        Attempt a Monte Carlo rotation/translation move followed by dynamics.
+        Apply the sequence of MCMC moves in mcmc_moves to the specified replica.
+
+        By default, Monte Carlo displacement and rotation moves are attempted, followed by dynamics.
 
         """
 
@@ -679,113 +775,141 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         if np.isnan(reduced_potential):
             raise Exception('Initial potential for replica %d state %d is NaN before Monte Carlo displacement/rotation' % (replica_index, state_index))
 
-        #
-        # Attempt a Monte Carlo rotation/translation move.
-        #
+        # Apply MCMC moves.
+        mcmc_moves = self.mcmc_moves if self.mcmc_moves is not None else self.default_mcmc_moves
+        move_methods = {'displacement': self._mc_displacement_move,
+                        'rotation': self._mc_rotation_move,
+                        'dynamics': self._dynamics_move}
+        elapsed_time = 0.0
+        for move_name in mcmc_moves:
+            if move_name not in move_methods:
+                raise ParameterException("MCMC move '%s' unknown. Valid moves are %s." % (move_name, ', '.join(sorted(move_methods.keys()))))
+            elapsed_time += move_methods[move_name](replica_index, state_index, context, integrator)
 
-        # Attempt gaussian trial displacement with stddev 'self.displacement_sigma'.
-        # TODO: Can combine these displacements and/or use cached potential energies to speed up this phase.
-        # TODO: Break MC displacement and rotation into member functions and write separate unit tests.
-        if self.mc_displacement and (self.mc_atoms is not None):
-            initial_time = time.time()
-            # Store original positions and energy.
-            original_positions = self.replica_positions[replica_index]
-            u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
-            # Make symmetric Gaussian trial displacement of ligand.
-            perturbed_positions = self.propose_displacement(self.displacement_sigma, original_positions, self.mc_atoms)
-            u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
-            # Accept or reject with Metropolis criteria.
-            du = u_new - u_old
-            if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
-                self.displacement_trials_accepted += 1
-                self.replica_positions[replica_index] = perturbed_positions
-            #print("translation du = %f (%d)" % (du, self.displacement_trials_accepted))
-            # Print timing information.
-            final_time = time.time()
-            elapsed_time = final_time - initial_time
-            self.displacement_trial_time += elapsed_time
+        return elapsed_time
 
-        # Attempt random rotation of ligand.
-        if self.mc_rotation and (self.mc_atoms is not None):
-            initial_time = time.time()
-            # Store original positions and energy.
-            original_positions = self.replica_positions[replica_index]
-            u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
-            # Compute new potential.
-            perturbed_positions = self.propose_rotation(original_positions, self.mc_atoms)
-            u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
-            du = u_new - u_old
-            if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
-                self.rotation_trials_accepted += 1
-                self.replica_positions[replica_index] = perturbed_positions
-            #print("rotation du = %f (%d)" % (du, self.rotation_trials_accepted))
-            # Accumulate timing information.
-            final_time = time.time()
-            elapsed_time = final_time - initial_time
-            self.rotation_trial_time += elapsed_time
+    def _mc_displacement_move(self, replica_index, state_index, context, integrator):
+        """
+        Attempt a Monte Carlo displacement of mc_atoms with stddev displacement_sigma.
 
-        #
-        # Propagate with dynamics.
-        #
+        Parameters
+        ----------
+        replica_index : int
+           The index of the replica to propagate.
+        state_index : int
+           The index of the thermodynamic state of the replica.
+        context : simtk.openmm.Context
+           The Context set to the thermodynamic state.
+        integrator : simtk.openmm.Integrator
+           The integrator bound to context.
+
+        Returns
+        -------
+        elapsed_time : float
+           Time spent in the move (in seconds).
+
+        """
+        if not (self.mc_displacement and (self.mc_atoms is not None)):
+            return 0.0
+
+        initial_time = time.time()
+        state = self.states[state_index]
+        box_vectors = self.replica_box_vectors[replica_index]
+        # Store original positions and energy.
+        original_positions = self.replica_positions[replica_index]
+        u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
+        # Make symmetric Gaussian trial displacement of ligand.
+        perturbed_positions = self.propose_displacement(self.displacement_sigma, original_positions, self.mc_atoms)
+        u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
+        # Accept or reject with Metropolis criteria.
+        du = u_new - u_old
+        if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
+            self.displacement_trials_accepted += 1
+            self.replica_positions[replica_index] = perturbed_positions
+        # Accumulate timing information.
+        final_time = time.time()
+        elapsed_time = final_time - initial_time
+        self.displacement_trial_time += elapsed_time
+
+        return elapsed_time
+
+    def _mc_rotation_move(self, replica_index, state_index, context, integrator):
+        """
+        Attempt a random Monte Carlo rotation of mc_atoms around their center of geometry.
+
+        See _mc_displacement_move for the description of parameters and return value.
+
+        """
+        if not (self.mc_rotation and (self.mc_atoms is not None)):
+            return 0.0
+
+        initial_time = time.time()
+        state = self.states[state_index]
+        box_vectors = self.replica_box_vectors[replica_index]
+        # Store original positions and energy.
+        original_positions = self.replica_positions[replica_index]
+        u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
+        # Compute new potential.
+        perturbed_positions = self.propose_rotation(original_positions, self.mc_atoms)
+        u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
+        du = u_new - u_old
+        if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
+            self.rotation_trials_accepted += 1
+            self.replica_positions[replica_index] = perturbed_positions
+        # Accumulate timing information.
+        final_time = time.time()
+        elapsed_time = final_time - initial_time
+        self.rotation_trial_time += elapsed_time
+
+        return elapsed_time
+
+    def _dynamics_move(self, replica_index, state_index, context, integrator):
+        """
+        Propagate the replica with nsteps_per_iteration steps of dynamics.
+
+        See _mc_displacement_move for the description of parameters and return value.
+
+        """
+        state = self.states[state_index]
 
         start_time = time.time()
 
-        # Run dynamics, retrying if NaNs are encountered.
-        MAX_NAN_RETRIES = 6
-        nan_counter = 0
-        completed = False
-        while (not completed):
-            try:
-                # Set box vectors.
-                box_vectors = self.replica_box_vectors[replica_index]
-                context.setPeriodicBoxVectors(box_vectors[0,:], box_vectors[1,:], box_vectors[2,:])
-                # Check if initial positions are NaN.
-                positions = self.replica_positions[replica_index]
-                if np.any(np.isnan(positions / unit.angstroms)):
-                    raise Exception('Initial particle positions for replica %d before propagation are NaN' % replica_index)
-                # Set positions.
-                positions = self.replica_positions[replica_index]
-                context.setPositions(positions)
-                setpositions_end_time = time.time()
-                # Assign Maxwell-Boltzmann velocities.
-                context.setVelocitiesToTemperature(state.temperature, int(np.random.randint(0, MAX_SEED)))
-                setvelocities_end_time = time.time()
-                # Check if initial potential energy is NaN.
-                if np.isnan(context.getState(getEnergy=True).getPotentialEnergy() / state.kT):
-                    raise Exception('Potential for replica %d is NaN before dynamics' % replica_index)
-                # Run dynamics.
-                integrator.step(self.nsteps_per_iteration)
-                integrator_end_time = time.time()
-                # Get final positions
-                getstate_start_time = time.time()
-                openmm_state = context.getState(getPositions=True, enforcePeriodicBox=state.system.usesPeriodicBoundaryConditions())
-                getstate_end_time = time.time()
-                # Check if final positions are NaN.
-                positions = openmm_state.getPositions(asNumpy=True)
-                if np.any(np.isnan(positions / unit.angstroms)):
-                    raise Exception('Particle coordinate is nan')
-                # Get box vectors
-                box_vectors = openmm_state.getPeriodicBoxVectors(asNumpy=True)
-                # Check if final potential energy is NaN.
-                if np.isnan(context.getState(getEnergy=True).getPotentialEnergy() / state.kT):
-                    raise Exception('Potential for replica %d is NaN after dynamics' % replica_index)
-                # Signal completion
-                completed = True
-            except Exception as e:
-                if str(e) == 'Particle coordinate is nan':
-                    # If it's a NaN, increment the NaN counter and try again
-                    nan_counter += 1
-                    if nan_counter >= MAX_NAN_RETRIES:
-                        raise Exception('Maximum number of NAN retries (%d) exceeded.' % MAX_NAN_RETRIES)
-                    logger.info('NaN detected in replica %d. Retrying (%d / %d).' % (replica_index, nan_counter, MAX_NAN_RETRIES))
-                else:
-                    # It's not an exception we recognize, so re-raise it
-                    raise e
+        # Set box vectors.
+        box_vectors = self.replica_box_vectors[replica_index]
+        context.setPeriodicBoxVectors(box_vectors[0,:], box_vectors[1,:], box_vectors[2,:])
+        # Check if initial positions are NaN.
+        positions = self.replica_positions[replica_index]
+        if np.any(np.isnan(positions / unit.angstroms)):
+            raise Exception('Initial particle positions for replica %d before propagation are NaN' % replica_index)
+        # Set positions.
+        context.setPositions(positions)
+        setpositions_end_time = time.time()
+        # Assign persisted or Maxwell-Boltzmann velocities.
+        self._assign_replica_velocities(replica_index, context)
+        setvelocities_end_time = time.time()
+        # Check if initial potential energy is NaN.
+        if np.isnan(context.getState(getEnergy=True).getPotentialEnergy() / state.kT):
+            raise Exception('Potential for replica %d is NaN before dynamics' % replica_index)
+
+        # Run dynamics in blocks, rolling back to the last good block if NaNs are encountered.
+        self._run_dynamics_blocks(replica_index, state_index, context, integrator)
+        integrator_end_time = time.time()
+
+        # Get final positions
+        getstate_start_time = time.time()
+        openmm_state = context.getState(getPositions=True, getVelocities=self.persist_velocities,
+                                        enforcePeriodicBox=state.system.usesPeriodicBoundaryConditions())
+        getstate_end_time = time.time()
+        positions = openmm_state.getPositions(asNumpy=True)
+        # Get box vectors
+        box_vectors = openmm_state.getPeriodicBoxVectors(asNumpy=True)
 
         # Store box vectors.
         self.replica_box_vectors[replica_index] = box_vectors
         # Store final positions
         self.replica_positions[replica_index] = positions
+        # Store velocities.
+        self._store_replica_velocities(replica_index, openmm_state)
 
         # Compute timing.
         end_time = time.time()
@@ -798,6 +922,82 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
 
         return elapsed_time
 
+    def _run_dynamics_blocks(self, replica_index, state_index, context, integrator):
+        """
+        Integrate nsteps_per_iteration steps of dynamics in blocks of nan_checkpoint_steps steps.
+
+        After each block, positions, velocities and box vectors are checked for NaNs and kept as
+        an in-memory checkpoint. If a block produces NaNs, the Context is rolled back to the last
+        checkpoint and only the failed block is retried, optionally with a scaled timestep. Retries
+        and the time spent in failed blocks are accumulated in nan_retries and nan_recovery_time.
+
+        Parameters
+        ----------
+        replica_index : int
+           The index of the replica being propagated.
+        state_index : int
+           The index of the thermodynamic state the replica is currently assigned to.
+        context : simtk.openmm.Context
+           The Context with positions and velocities already set.
+        integrator : simtk.openmm.Integrator
+           The integrator bound to context.
+
+        """
+        # Determine the size of the blocks of dynamics.
+        if self.nan_checkpoint_steps > 0:
+            block_nsteps = [self.nan_checkpoint_steps] * (self.nsteps_per_iteration // self.nan_checkpoint_steps)
+            if self.nsteps_per_iteration % self.nan_checkpoint_steps != 0:
+                block_nsteps.append(self.nsteps_per_iteration % self.nan_checkpoint_steps)
+        else:
+            block_nsteps = [self.nsteps_per_iteration]
+
+        timestep = integrator.getStepSize()
+        kT = self.states[state_index].kT
+
+        # Take initial checkpoint.
+        checkpoint = context.getState(getPositions=True, getVelocities=True)
+
+        for block_index, nsteps in enumerate(block_nsteps):
+            nan_counter = 0
+            completed = False
+            while (not completed):
+                block_start_time = time.time()
+                try:
+                    integrator.step(nsteps)
+                    openmm_state = context.getState(getPositions=True, getVelocities=True, getEnergy=True)
+                    if np.any(np.isnan(openmm_state.getPositions(asNumpy=True) / unit.angstroms)):
+                        raise Exception('Particle coordinate is nan')
+                    if np.isnan(openmm_state.getPotentialEnergy() / kT):
+                        raise Exception('Potential energy is nan')
+                    # Signal completion and store new checkpoint.
+                    checkpoint = openmm_state
+                    completed = True
+                except Exception as e:
+                    if str(e) not in NAN_ERROR_MESSAGES:
+                        # It's not an exception we recognize, so re-raise it
+                        raise e
+
+                    # If it's a NaN, increment the NaN counter and roll back to the last checkpoint.
+                    nan_counter += 1
+                    self.nan_retries[state_index] += 1
+                    self.nan_recovery_time[state_index] += time.time() - block_start_time
+                    if nan_counter >= MAX_NAN_RETRIES:
+                        integrator.setStepSize(timestep)
+                        raise Exception('Maximum number of NAN retries (%d) exceeded.' % MAX_NAN_RETRIES)
+                    logger.info('NaN detected in replica %d state %d (block %d/%d). Retrying (%d / %d).' %
+                                (replica_index, state_index, block_index+1, len(block_nsteps), nan_counter, MAX_NAN_RETRIES))
+                    box_vectors = checkpoint.getPeriodicBoxVectors()
+                    context.setPeriodicBoxVectors(box_vectors[0], box_vectors[1], box_vectors[2])
+                    context.setPositions(checkpoint.getPositions())
+                    context.setVelocities(checkpoint.getVelocities())
+                    integrator.setStepSize(timestep * self.nan_retry_timestep_scale**nan_counter)
+
+            # Restore original timestep.
+            if nan_counter > 0:
+                integrator.setStepSize(timestep)
+
+        return
+
     def _propagate_replicas(self):
         # Reset statistics for MC trial times.
         self.displacement_trial_time = 0.0
@@ -805,6 +1005,10 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         self.displacement_trials_accepted = 0
         self.rotation_trials_accepted = 0
 
+        # Reset NaN recovery statistics.
+        self.nan_retries = np.zeros([self.nstates], np.int32)
+        self.nan_recovery_time = np.zeros([self.nstates], np.float64)
+
         # Propagate replicas.
         ReplicaExchange._propagate_replicas(self)
 
@@ -824,6 +1028,13 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                 self.rotation_trial_time = self.mpicomm.reduce(self.rotation_trial_time, op=MPI.SUM)
                 if self.mpicomm.rank == 0:
                     logger.debug("Rotation MC trial times consumed %.3f s aggregate (%d accepted)" % (self.rotation_trial_time, self.rotation_trials_accepted))
+
+            self.nan_retries = self.mpicomm.reduce(self.nan_retries, op=MPI.SUM)
+            self.nan_recovery_time = self.mpicomm.reduce(self.nan_recovery_time, op=MPI.SUM)
+            if self.mpicomm.rank != 0:
+                # Only the root node stores the statistics.
+                self.nan_retries = np.zeros([self.nstates], np.int32)
+                self.nan_recovery_time = np.zeros([self.nstates], np.float64)
         else:
             # SERIAL
             if self.mc_displacement and (self.mc_atoms is not None):
@@ -831,33 +1042,52 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
             if self.mc_rotation and (self.mc_atoms is not None):
                 logger.debug("Rotation MC trial times consumed %.3f s aggregate (%d accepted)" % (self.rotation_trial_time, self.rotation_trials_accepted))
 
+        # Report states that needed NaN recovery.
+        if self.nan_retries.sum() > 0:
+            unstable_states = np.where(self.nan_retries > 0)[0]
+            logger.info("NaN recovery required %d retries (%.3f s wasted) in states %s" %
+                        (self.nan_retries.sum(), self.nan_recovery_time.sum(), str(list(unstable_states))))
+
         return
 
     def _initialize_create(self):
         self.u_k_full = np.zeros([len(self.states)], np.float64)
         self.u_k_non = np.zeros([len(self.states)], np.float64)
+        self.nan_retries = np.zeros([len(self.states)], np.int32)
+        self.nan_recovery_time = np.zeros([len(self.states)], np.float64)
         super(ModifiedHamiltonianExchange, self)._initialize_create()
 
     def _initialize_netcdf(self):
         super(ModifiedHamiltonianExchange, self)._initialize_netcdf()
         if (self.fully_interacting_expanded_state is not None) and (self.noninteracting_expanded_state is not None):
-            ncvar_full_energies = self.ncfile.createVariable('fully_interacting_expanded_cutoff_energies', 'f8',
-                                                        ('iteration', 'replica'), zlib=False,
-                                                        chunksizes=(1, self.nreplicas))
+            ncvar_full_energies = self._create_netcdf_variable(self.ncfile, 'fully_interacting_expanded_cutoff_energies',
+                                                               'f8', ('iteration', 'replica'))
             setattr(ncvar_full_energies, 'units', 'kT')
             setattr(ncvar_full_energies, 'long_name', "energies[iteration][replica] is the reduced "
                                                       "(unitless) energy of replica 'replica' from "
                                                       "iteration 'iteration' evaluated at the "
                                                       "effctively fully interacting state at expanded cutoff")
-            ncvar_non_energies = self.ncfile.createVariable('noninteracting_expanded_cutoff_energies', 'f8',
-                                                        ('iteration', 'replica'), zlib=False,
-                                                        chunksizes=(1, self.nreplicas))
+            ncvar_non_energies = self._create_netcdf_variable(self.ncfile, 'noninteracting_expanded_cutoff_energies',
+                                                              'f8', ('iteration', 'replica'))
             setattr(ncvar_non_energies, 'units', 'kT')
             setattr(ncvar_non_energies, 'long_name', "energies[iteration][replica] is the reduced "
                                                      "(unitless) energy of replica 'replica' from "
                                                      "iteration 'iteration' evaluated at the "
                                                      "effctively non interacting state at expanded cutoff")
 
+        # NaN recovery statistics.
+        ncgrp_timings = self.ncfile.groups['timings']
+        # The statistics are indexed by thermodynamic state, not by replica.
+        ncgrp_timings.createDimension('state', self.nstates)
+        ncvar_nan_retries = self._create_netcdf_variable(ncgrp_timings, 'nan_retries', 'i4', ('iteration', 'state'))
+        ncvar_nan_recovery_time = self._create_netcdf_variable(ncgrp_timings, 'nan_recovery_time', 'f', ('iteration', 'state'))
+        setattr(ncvar_nan_retries, 'units', 'none')
+        setattr(ncvar_nan_retries, 'long_name', "nan_retries[iteration][state] is the number of blocks of dynamics "
+                                                "rolled back and retried after a NaN in state 'state' during iteration 'iteration'.")
+        setattr(ncvar_nan_recovery_time, 'units', 's')
+        setattr(ncvar_nan_recovery_time, 'long_name', "nan_recovery_time[iteration][state] is the time spent integrating "
+                                                      "blocks of dynamics that were rolled back in state 'state' during iteration 'iteration'.")
+
         self.ncfile.sync()
 
     def _write_iteration_netcdf(self):
@@ -867,17 +1097,27 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         if self.mpicomm is not None and self.mpicomm.rank != 0:
             return
 
-        if (self.fully_interacting_expanded_state is not None) and (self.noninteracting_expanded_state is not None):
+        # Iterations skipped by expanded_cutoff_stride are left as fill values.
+        if self._expanded_cutoff_energies_evaluated:
             self.ncfile.variables['fully_interacting_expanded_cutoff_energies'][self.iteration, :] = self.u_k_full[:]
             self.ncfile.variables['noninteracting_expanded_cutoff_energies'][self.iteration, :] = self.u_k_non[:]
-            self.ncfile.sync()
+
+        # Store NaN recovery statistics. Files created by previous versions don't have them.
+        ncgrp_timings = self.ncfile.groups['timings']
+        if 'nan_retries' in ncgrp_timings.variables:
+            ncgrp_timings.variables['nan_retries'][self.iteration, :] = self.nan_retries[:]
+            ncgrp_timings.variables['nan_recovery_time'][self.iteration, :] = self.nan_recovery_time[:]
 
     def _resume_from_netcdf(self, ncfile):
         super(ModifiedHamiltonianExchange, self)._resume_from_netcdf(ncfile)
         # Restore fully interacting energies
         if 'fully_interacting_expanded_cutoff_energies' in ncfile.variables:
-            self.u_k_full = ncfile.variables['fully_interacting_expanded_cutoff_energies'][self.iteration, :].copy()
-            self.u_k_non = ncfile.variables['noninteracting_expanded_cutoff_energies'][self.iteration, :].copy()
+            # Energies of iterations skipped by expanded_cutoff_stride are masked.
+            self.u_k_full = np.ma.filled(ncfile.variables['fully_interacting_expanded_cutoff_energies'][self.iteration, :], np.nan)
+            self.u_k_non = np.ma.filled(ncfile.variables['noninteracting_expanded_cutoff_energies'][self.iteration, :], np.nan)
+        # Reset NaN recovery statistics.
+        self.nan_retries = np.zeros([self.nstates], np.int32)
+        self.nan_recovery_time = np.zeros([self.nstates], np.float64)
 
     def _compute_energies(self):
         """
@@ -903,19 +1143,18 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         if self.mpicomm:
             # MPI version.
 
-            # Compute energies for this node's share of states.
-            for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
+            # Compute energies at all states for this node's replicas, whose configurations it holds.
+            replica_indices_per_rank = self._mpi_replica_indices_per_rank()
+            node_replica_indices = replica_indices_per_rank[self.mpicomm.rank]
+            for state_index in range(self.nstates):
                 # Set alchemical state.
                 AbsoluteAlchemicalFactory.perturbContext(context, self.states[state_index].alchemical_state)
-                for replica_index in range(self.nstates):
+                for replica_index in node_replica_indices:
                     self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
 
-            # Send final energies to all nodes.
-            energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
-            for state_index in range(self.nstates):
-                source = state_index % self.mpicomm.size # node with trajectory data
-                index = state_index // self.mpicomm.size # index within trajectory batch
-                self.u_kl[:,state_index] = energies_gather[source][:,index]
+            # Start sending final energies to all nodes while the expanded cutoff energies are computed.
+            pending_energies = mpi_allgather_rows(self.mpicomm, self.u_kl[node_replica_indices,:],
+                                                  replica_indices_per_rank, self.u_kl, nonblocking=True)
 
         else:
             # Serial version.
@@ -924,6 +1163,7 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                 AbsoluteAlchemicalFactory.perturbContext(context, self.states[state_index].alchemical_state)
                 for replica_index in range(self.nstates):
                     self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
+            pending_energies = None
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -931,31 +1171,43 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         logger.debug("Time to compute all energies {:.3f} s ({:.3f} per "
                      "energy calculation).".format(elapsed_time, time_per_energy))
 
-        #
-        # Compute energies for expanded cutoff state
-        #
+        try:
+            self._compute_expanded_cutoff_energies()
+        finally:
+            if pending_energies is not None:
+                self._communication_time += pending_energies.wait()
+
+    def _compute_expanded_cutoff_energies(self):
+        """
+        Compute the energies of all replicas in the expanded cutoff states.
+
+        """
+        self._expanded_cutoff_energies_evaluated = False
         if (self.fully_interacting_expanded_state is not None) and (self.noninteracting_expanded_state is not None):
+            if self.iteration % self.expanded_cutoff_stride != 0:
+                logger.debug("Skipping energies for expanded state at iteration %d (stride %d)." %
+                             (self.iteration, self.expanded_cutoff_stride))
+                return
+
             logger.debug("Computing energies for expanded state...")
             start_time = time.time()
-            fully_interacting_expanded_context = self._fully_interacting_expanded_context
-            noninteracting_expanded_context = self._noninteracting_expanded_context
+            fully_interacting_expanded_context, noninteracting_expanded_context = self._get_expanded_cutoff_contexts()
 
             if self.mpicomm:
                 # MPI version.
 
                 # Compute energies for this node's replicas.
-                for replica_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
+                replica_indices_per_rank = self._mpi_replica_indices_per_rank()
+                node_replica_indices = replica_indices_per_rank[self.mpicomm.rank]
+                for replica_index in node_replica_indices:
                     self.u_k_full[replica_index] = self.fully_interacting_expanded_state.reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=fully_interacting_expanded_context)
                     self.u_k_non[replica_index] = self.noninteracting_expanded_state.reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=noninteracting_expanded_context)
 
                 # Send final energies to all nodes.
-                energies_gather_full = self.mpicomm.allgather(self.u_k_full[self.mpicomm.rank:self.nstates:self.mpicomm.size])
-                energies_gather_non = self.mpicomm.allgather(self.u_k_non[self.mpicomm.rank:self.nstates:self.mpicomm.size])
-                for replica_index in range(self.nstates):
-                    source = replica_index % self.mpicomm.size # node with data
-                    index = replica_index // self.mpicomm.size # index within batch
-                    self.u_k_full[replica_index] = energies_gather_full[source][index]
-                    self.u_k_non[replica_index] = energies_gather_non[source][index]
+                communication_start_time = time.time()
+                mpi_allgather_rows(self.mpicomm, self.u_k_full[node_replica_indices], replica_indices_per_rank, self.u_k_full)
+                mpi_allgather_rows(self.mpicomm, self.u_k_non[node_replica_indices], replica_indices_per_rank, self.u_k_non)
+                self._communication_time += time.time() - communication_start_time
 
             else:
                 # Serial version.
@@ -963,6 +1215,9 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                     self.u_k_full[replica_index] = self.fully_interacting_expanded_state.reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=fully_interacting_expanded_context)
                     self.u_k_non[replica_index] = self.noninteracting_expanded_state.reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=noninteracting_expanded_context)
 
+            self._expanded_cutoff_energies_evaluated = True
+            self._free_expanded_cutoff_contexts()
+
             end_time = time.time()
             elapsed_time = end_time - start_time
             time_per_energy = elapsed_time / float(self.nstates)
@@ -0,0 +1,281 @@
+#!/usr/bin/python
+
+# =============================================================================================
+# MODULE DOCSTRING
+# =============================================================================================
+
+"""
+Test analyze module.
+
+"""
+
+# =============================================================================================
+# GLOBAL IMPORTS
+# =============================================================================================
+
+import os
+import csv
+import json
+import uuid
+
+import yaml
+import numpy as np
+import netCDF4 as netcdf
+from nose import tools
+from docopt import docopt
+from openmoltools import utils as omt_utils
+
+from yank import analyze
+from yank.commands import analyze as analyze_command
+
+# =============================================================================================
+# TEST HELPERS
+# =============================================================================================
+
+def create_energies_ncfile(filename, niterations=20, nstates=3, seed=0, diskless=True):
+    """
+    Create a store file with random energies and replica states.
+
+    Parameters
+    ----------
+    filename : str
+       Name of the file.
+    niterations : int, optional, default=20
+       Number of stored iterations.
+    nstates : int, optional, default=3
+       Number of replicas and thermodynamic states.
+    seed : int, optional, default=0
+       Seed of the random number generator.
+    diskless : bool, optional, default=True
+       If True, the file is kept in memory and deleted when it is closed.
+
+    Returns
+    -------
+    ncfile : netCDF4.Dataset
+       The open file.
+
+    """
+    random_state = np.random.RandomState(seed)
+    if diskless:
+        ncfile = netcdf.Dataset(filename, 'w', diskless=True, persist=False)
+    else:
+        ncfile = netcdf.Dataset(filename, 'w', version='NETCDF4')
+    setattr(ncfile, 'UUID', str(uuid.uuid4()))
+    ncfile.createDimension('iteration', 0)
+    ncfile.createDimension('replica', nstates)
+    ncfile.createDimension('state', nstates)
+    ncvar_energies = ncfile.createVariable('energies', 'f8', ('iteration', 'replica', 'state'))
+    ncvar_states = ncfile.createVariable('states', 'i4', ('iteration', 'replica'))
+    ncvar_energies[:] = random_state.normal(size=(niterations, nstates, nstates))
+    ncvar_states[:] = np.array([random_state.permutation(nstates) for _ in range(niterations)])
+    ncgrp_stateinfo = ncfile.createGroup('thermodynamic_states')
+    ncvar_temperatures = ncgrp_stateinfo.createVariable('temperatures', 'f8', ('state',))
+    ncvar_temperatures[:] = 300.0
+    return ncfile
+
+def create_experiment_directory(directory, phases, niterations=20):
+    """
+    Create an experiment directory with an analysis script and a store file for each phase.
+
+    Parameters
+    ----------
+    directory : str
+       The experiment directory to create.
+    phases : list of str
+       The phases of the experiment. The first one has sign +1 and the others -1.
+    niterations : int, optional, default=20
+       Number of iterations stored in each file.
+
+    """
+    os.makedirs(directory)
+    analysis = [[phase, 1 if phase_index == 0 else -1] for phase_index, phase in enumerate(phases)]
+    with open(os.path.join(directory, 'analysis.yaml'), 'w') as f:
+        yaml.dump(analysis, f)
+    for seed, phase in enumerate(phases):
+        create_energies_ncfile(os.path.join(directory, phase + '.nc'), niterations=niterations,
+                               seed=seed, diskless=False).close()
+
+# =============================================================================================
+# UNIT TESTS
+# =============================================================================================
+
+def test_extract_ncfile_energies_chunks():
+    """Test that reading energies in chunks gives the same result as reading them at once."""
+    ncfile = create_energies_ncfile('energies.nc')
+    try:
+        nstates = ncfile.variables['energies'].shape[1]
+        u_kln, N_k, u_n = analyze.extract_ncfile_energies(ncfile, ndiscard=2)
+        # Read at most 3 iterations at a time, so that chunks do not align with the uncorrelated samples.
+        iteration_bytes = nstates * nstates * np.dtype(np.float64).itemsize
+        for max_memory in [iteration_bytes, 3 * iteration_bytes]:
+            chunked_u_kln, chunked_N_k, chunked_u_n = analyze.extract_ncfile_energies(ncfile, ndiscard=2,
+                                                                                      max_memory=max_memory)
+            assert np.array_equal(u_n, chunked_u_n)
+            assert np.array_equal(N_k, chunked_N_k)
+            assert np.array_equal(u_kln, chunked_u_kln)
+    finally:
+        ncfile.close()
+
+def test_analyze_directories():
+    """Test that experiments are analyzed together and that a failing phase does not stop the others."""
+    with omt_utils.temporary_directory() as tmp_dir:
+        good_directory = os.path.join(tmp_dir, 'good')
+        bad_directory = os.path.join(tmp_dir, 'bad')
+        create_experiment_directory(good_directory, ['complex', 'solvent'])
+        create_experiment_directory(bad_directory, ['complex', 'solvent'])
+        os.remove(os.path.join(bad_directory, 'solvent.nc'))
+
+        summaries = analyze.analyze_directories([good_directory, bad_directory], jobs=2, use_cache=False)
+        assert [summary['directory'] for summary in summaries] == [good_directory, bad_directory]
+
+        # The free energy combines the phases with the signs of the analysis script.
+        good_summary = summaries[0]
+        assert 'error' not in good_summary
+        phases = good_summary['phases']
+        expected_DeltaF = -(phases['complex']['DeltaF'] + phases['complex']['DeltaF_restraints'])
+        expected_DeltaF += phases['solvent']['DeltaF'] + phases['solvent']['DeltaF_restraints']
+        assert np.isclose(good_summary['DeltaF'], expected_DeltaF)
+
+        # Only the failing phase is reported as an error.
+        bad_summary = summaries[1]
+        assert 'solvent' in bad_summary['error']
+        assert 'DeltaF' in bad_summary['phases']['complex']
+        assert 'error' in bad_summary['phases']['solvent']
+        assert 'DeltaF' not in bad_summary
+
+        # analyze() raises instead of returning a failed summary.
+        with tools.assert_raises(RuntimeError):
+            analyze.analyze(bad_directory, use_cache=False)
+
+def test_compute_analysis_jobs():
+    """Test that the number of analysis jobs is bounded by the number of phases."""
+    with omt_utils.temporary_directory() as tmp_dir:
+        ncfile_paths = [os.path.join(tmp_dir, name) for name in ['complex.nc', 'solvent.nc']]
+        for ncfile_path in ncfile_paths:
+            create_energies_ncfile(ncfile_path, diskless=False).close()
+        assert analyze.compute_analysis_jobs(ncfile_paths, 1) == 1
+        assert analyze.compute_analysis_jobs(ncfile_paths[:1], 8) == 1
+        assert 1 <= analyze.compute_analysis_jobs(ncfile_paths, 8) <= 2
+        assert analyze.estimate_phase_memory(ncfile_paths[0], max_memory=0) > 0
+
+def test_write_analysis_summary():
+    """Test writing the summaries of successful and failed experiments as JSON and CSV."""
+    summaries = [{'directory': 'good', 'phases': {'complex': {'DeltaF': 1.0}}, 'DeltaF': -1.0, 'dDeltaF': 0.1},
+                 {'directory': 'bad', 'phases': {'complex': {'error': 'IOError: missing'}}, 'error': 'complex: IOError: missing'}]
+    with omt_utils.temporary_directory() as tmp_dir:
+        json_path = os.path.join(tmp_dir, 'summary.json')
+        analyze.write_analysis_summary(summaries, json_path)
+        with open(json_path, 'r') as f:
+            assert json.load(f) == summaries
+
+        # The CSV file has one row per experiment and no phase results.
+        csv_path = os.path.join(tmp_dir, 'summary.csv')
+        analyze.write_analysis_summary(summaries, csv_path)
+        with open(csv_path, 'r') as f:
+            rows = list(csv.DictReader(f))
+        assert [row['directory'] for row in rows] == ['good', 'bad']
+        assert float(rows[0]['DeltaF']) == -1.0 and rows[0]['error'] == ''
+        assert rows[1]['DeltaF'] == '' and rows[1]['error'] == 'complex: IOError: missing'
+        assert 'phases' not in rows[0]
+
+        with tools.assert_raises(ValueError):
+            analyze.write_analysis_summary(summaries, os.path.join(tmp_dir, 'summary.txt'))
+
+def test_analyze_dispatch():
+    """Test that yank analyze fails if any experiment cannot be analyzed."""
+    with omt_utils.temporary_directory() as tmp_dir:
+        good_directory = os.path.join(tmp_dir, 'good')
+        bad_directory = os.path.join(tmp_dir, 'bad')
+        create_experiment_directory(good_directory, ['complex', 'solvent'])
+        create_experiment_directory(bad_directory, ['complex', 'solvent'])
+        os.remove(os.path.join(bad_directory, 'complex.nc'))
+        summary_path = os.path.join(tmp_dir, 'summary.json')
+
+        args = docopt(analyze_command.usage, argv=['analyze', '--store=' + good_directory, '--nocache'])
+        assert analyze_command.dispatch(args) is True
+
+        args = docopt(analyze_command.usage, argv=['analyze', '--store=' + good_directory, '--store=' + bad_directory,
+                                                   '--nocache', '--summary=' + summary_path])
+        assert analyze_command.dispatch(args) is False
+        # The summary is written for all experiments anyway.
+        with open(summary_path, 'r') as f:
+            assert len(json.load(f)) == 2
+
+def test_analysis_cache():
+    """Test that the analysis of a phase is cached until the store file changes."""
+    with omt_utils.temporary_directory() as tmp_dir:
+        ncfile_path = os.path.join(tmp_dir, 'complex.nc')
+        cache_path = analyze.get_analysis_cache_path(ncfile_path)
+        create_energies_ncfile(ncfile_path, diskless=False).close()
+
+        # The first analysis creates the cache.
+        entry = analyze.analyze_phase(ncfile_path)
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+        assert cache['niterations'] == 20
+        assert cache['entry'] == entry
+        assert len(cache['f_k']) == 3
+
+        # Cache hits return the cached entry without analyzing the file.
+        cache['entry']['DeltaF'] = 1000.0
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f)
+        assert analyze.analyze_phase(ncfile_path)['DeltaF'] == 1000.0
+
+        # The cache is neither read nor written with use_cache=False.
+        assert analyze.analyze_phase(ncfile_path, use_cache=False)['DeltaF'] == entry['DeltaF']
+        with open(cache_path, 'r') as f:
+            assert json.load(f)['entry']['DeltaF'] == 1000.0
+
+        # New iterations invalidate the cached entry.
+        ncfile = netcdf.Dataset(ncfile_path, 'a')
+        random_state = np.random.RandomState(1)
+        ncfile.variables['energies'][20:25] = random_state.normal(size=(5, 3, 3))
+        ncfile.variables['states'][20:25] = np.array([random_state.permutation(3) for _ in range(5)])
+        ncfile.close()
+        entry = analyze.analyze_phase(ncfile_path)
+        assert entry['DeltaF'] != 1000.0
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+        assert cache['niterations'] == 25
+        assert cache['entry'] == entry
+
+        # The cache of a different simulation in the same path is ignored.
+        cache['entry']['DeltaF'] = 1000.0
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f)
+        os.remove(ncfile_path)
+        create_energies_ncfile(ncfile_path, niterations=25, seed=1, diskless=False).close()
+        assert analyze.analyze_phase(ncfile_path)['DeltaF'] != 1000.0
+
+def test_initialize_MBAR_warm_start():
+    """Test that MBAR warm-started from previous free energies converges to the same solution."""
+    ncfile = create_energies_ncfile('energies.nc')
+    try:
+        u_kln, N_k, u_n = analyze.extract_ncfile_energies(ncfile)
+        mbar = analyze.initialize_MBAR(ncfile, u_kln=u_kln, N_k=N_k)
+        # Warm start from a perturbed guess.
+        initial_f_k = mbar.f_k + np.array([0.0, 0.5, -0.5])
+        warm_mbar = analyze.initialize_MBAR(ncfile, u_kln=u_kln, N_k=N_k, initial_f_k=initial_f_k)
+        assert np.allclose(mbar.f_k, warm_mbar.f_k, atol=1e-5)
+        # Free energies of a different number of states are ignored.
+        mbar = analyze.initialize_MBAR(ncfile, u_kln=u_kln, N_k=N_k, initial_f_k=[0.0, 1.0])
+        assert np.allclose(mbar.f_k, warm_mbar.f_k, atol=1e-5)
+    finally:
+        ncfile.close()
+
+def test_analyze_nocache():
+    """Test that yank analyze --nocache does not create analysis caches."""
+    with omt_utils.temporary_directory() as tmp_dir:
+        experiment_directory = os.path.join(tmp_dir, 'experiment')
+        create_experiment_directory(experiment_directory, ['complex', 'solvent'])
+        cache_paths = [analyze.get_analysis_cache_path(os.path.join(experiment_directory, phase + '.nc'))
+                       for phase in ['complex', 'solvent']]
+
+        args = docopt(analyze_command.usage, argv=['analyze', '--store=' + experiment_directory, '--nocache'])
+        assert analyze_command.dispatch(args) is True
+        assert not any(os.path.exists(cache_path) for cache_path in cache_paths)
+
+        args = docopt(analyze_command.usage, argv=['analyze', '--store=' + experiment_directory])
+        assert analyze_command.dispatch(args) is True
+        assert all(os.path.exists(cache_path) for cache_path in cache_paths)
@@ -63,6 +63,21 @@ def test_selftest():
         else:
             raise(e)
 
+def test_resumable_exit_status():
+    """Check that yank exits with the resumable status when a simulation is interrupted."""
+    from yank import cli, commands
+    from yank.repex import SimulationInterrupted, RESUMABLE_EXIT_CODE
+
+    def interrupted_dispatch(args):
+        raise SimulationInterrupted('Simulation stopped at iteration 1/2 (received signal 10).')
+
+    dispatch = commands.status.dispatch
+    commands.status.dispatch = interrupted_dispatch
+    try:
+        assert cli.main(['status', '--store=.']) == RESUMABLE_EXIT_CODE
+    finally:
+        commands.status.dispatch = dispatch
+
 def notest_prepare_binding():
     dirname = utils.get_data_filename("../examples/benzene-toluene-implicit/setup/")  # Could only figure out how to install things like yank.egg/examples/, rather than yank.egg/yank/examples/
     with omt.utils.temporary_directory() as store_dir:
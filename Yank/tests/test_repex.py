@@ -13,7 +13,9 @@ TODO
 # GLOBAL IMPORTS
 #=============================================================================================
 
+import os
 import sys
+import copy
 
 import math
 
@@ -24,11 +26,15 @@ import simtk.openmm as openmm
 import simtk.unit as units
 
 from nose import tools
+from mdtraj.utils import enter_temp_directory
 
 from openmmtools import testsystems
 
 from yank import utils
 from yank.repex import ThermodynamicState, ReplicaExchange, HamiltonianExchange, ParallelTempering
+from yank.repex import compute_netcdf_chunksizes, migrate_netcdf_layout, MAX_CHUNK_BYTES
+from yank.repex import compute_load_imbalance, balance_replica_assignment, SharedReplicaQuantities
+from yank.repex import load_serialized_system, get_trajectory_filename, RANK_TIMINGS, SimulationInterrupted
 
 #=============================================================================================
 # MODULE CONSTANTS
@@ -102,6 +108,41 @@ def computeHarmonicOscillatorExpectations(K, mass, temperature):
 
     return values
 
+def build_harmonic_oscillator_states(temperatures=(300.0, 350.0)):
+    """
+    Return thermodynamic states and seed positions of harmonic oscillators at the given temperatures (in kelvin).
+
+    """
+    states = list()
+    seed_positions = list()
+    for temperature in temperatures:
+        testsystem = testsystems.HarmonicOscillator()
+        states.append(ThermodynamicState(system=testsystem.system, temperature=temperature*units.kelvin))
+        seed_positions.append(testsystem.positions)
+    return states, seed_positions
+
+def create_simulation(store_filename, states, seed_positions, simulation_class=ReplicaExchange, **options):
+    """
+    Create a short simulation running on the Reference platform, overriding the default test options.
+
+    """
+    simulation_options = dict(minimize=False, nsteps_per_iteration=10, show_energies=False, show_mixing_statistics=False)
+    simulation_options.update(options)
+    simulation = simulation_class(store_filename, **simulation_options)
+    simulation.platform = openmm.Platform.getPlatformByName('Reference')
+    simulation.create(states, seed_positions)
+    return simulation
+
+def resume_simulation(store_filename, simulation_class=ReplicaExchange):
+    """
+    Resume the simulation stored in store_filename on the Reference platform.
+
+    """
+    simulation = simulation_class(store_filename)
+    simulation.resume()
+    simulation.platform = openmm.Platform.getPlatformByName('Reference')
+    return simulation
+
 def test_replica_exchange(mpicomm=None, verbose=True):
     """
     Test that free energies and average potential energies of a 3D harmonic oscillator are correctly computed by parallel tempering.
@@ -401,6 +442,572 @@ def test_unknown_parameters():
     """Test ReplicaExchange raises exception on wrong initialization."""
     ReplicaExchange(store_filename='test', wrong_parameter=False)
 
+def test_plan_minimization():
+    """Test that replicas sharing the same starting configuration are minimized once."""
+    repex = ReplicaExchange(store_filename='test')
+    positions = [units.Quantity(numpy.zeros([2, 3]), units.nanometers),
+                 units.Quantity(numpy.ones([2, 3]), units.nanometers)]
+    repex.nstates = 5
+    repex.replica_positions = [copy.deepcopy(positions[i % 2]) for i in range(repex.nstates)]
+    repex.replica_box_vectors = [units.Quantity(numpy.eye(3), units.nanometers) for _ in range(repex.nstates)]
+    assert repex._plan_minimization() == [[0, 2, 4], [1, 3]]
+
+    # Different box vectors prevent deduplication.
+    repex.replica_box_vectors[4] = units.Quantity(2 * numpy.eye(3), units.nanometers)
+    assert repex._plan_minimization() == [[0, 2], [1, 3], [4]]
+
+def test_assign_mts_force_groups():
+    """Test that MTS force groups are assigned only if the user did not assign them."""
+    from yank.mcmc import assign_mts_force_groups, get_mts_fast_force_groups
+    system = testsystems.LennardJonesFluid().system
+    assert assign_mts_force_groups(system)
+    force_groups = {force.__class__.__name__: force.getForceGroup() for force in system.getForces()}
+    assert force_groups['NonbondedForce'] == 1
+    assert 1 not in get_mts_fast_force_groups(system)
+
+    # Custom force groups are left unchanged and integrated as fast forces.
+    system = testsystems.LennardJonesFluid().system
+    for force in system.getForces():
+        force.setForceGroup(2)
+    assert not assign_mts_force_groups(system)
+    assert all(force.getForceGroup() == 2 for force in system.getForces())
+    assert get_mts_fast_force_groups(system) == [2]
+
+def test_mts_integrates_all_force_groups():
+    """Test that the MTS integrator applies forces outside groups 0 and 1."""
+    from yank.mcmc import create_integrator, get_mts_fast_force_groups
+
+    # A single particle at rest pushed along -x by a constant force in group 2.
+    system = openmm.System()
+    system.addParticle(1.0)
+    force = openmm.CustomExternalForce('x')
+    force.addParticle(0, [])
+    force.setForceGroup(2)
+    system.addForce(force)
+
+    # Without friction, the integrator is deterministic.
+    integrator = create_integrator('mts-langevin', 300.0*units.kelvin, 0.0/units.picoseconds,
+                                   1.0*units.femtoseconds, mts_substeps=2,
+                                   mts_fast_force_groups=get_mts_fast_force_groups(system))
+    context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName('Reference'))
+    context.setPositions(units.Quantity(numpy.zeros([1, 3]), units.nanometers))
+    context.setVelocities(units.Quantity(numpy.zeros([1, 3]), units.nanometers/units.picoseconds))
+    integrator.step(10)
+
+    positions = context.getState(getPositions=True).getPositions(asNumpy=True) / units.nanometers
+    expected_x = -0.5 * (10 * 0.001)**2  # x = -t^2/2 for a unit force on a unit mass.
+    assert numpy.allclose(positions[0], [expected_x, 0.0, 0.0])
+    del context, integrator
+
+def test_persist_velocities():
+    """Test that persisted velocities are checkpointed and restored on resume."""
+    import netCDF4 as netcdf
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        states, seed_positions = build_harmonic_oscillator_states()
+        simulation = create_simulation(store_filename, states, seed_positions, persist_velocities=True,
+                                       number_of_iterations=2)
+        simulation.run()
+        del simulation
+
+        # The checkpoint holds the velocities of the last iteration.
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        ncgrp_checkpoint = ncfile.groups['checkpoint']
+        assert int(ncgrp_checkpoint.variables['iteration'].getValue()) == 1
+        checkpoint_velocities = ncgrp_checkpoint.variables['velocities'][:,:,:]
+        ncfile.close()
+
+        # Velocities are restored when resuming.
+        simulation = resume_simulation(store_filename)
+        simulation.run()
+        assert simulation.persist_velocities is True
+        for replica_index, velocities in enumerate(simulation.replica_velocities):
+            assert numpy.allclose(velocities / (units.nanometers / units.picoseconds), checkpoint_velocities[replica_index])
+
+def test_shared_replica_quantities():
+    """Test that SharedReplicaQuantities stores the replica quantities in its array."""
+    array = numpy.zeros([2, 3, 3])
+    velocities = SharedReplicaQuantities(array, units.nanometers / units.picoseconds, allow_none=True)
+    assert len(velocities) == 2
+    velocities[0] = units.Quantity(numpy.ones([3, 3]), units.angstroms / units.picoseconds)
+    velocities[1] = None
+    assert numpy.allclose(array[0], 0.1)
+    assert velocities[1] is None
+    assert numpy.allclose(velocities[0] / (units.nanometers / units.picoseconds), 0.1)
+    velocities[0][0,0] = 1.0 * units.nanometers / units.picoseconds  # items are views of the array
+    assert array[0,0,0] == 1.0
+
+def test_replica_failure_recovery():
+    """Test that replicas whose propagation fails are rolled back, retried and excluded."""
+    import netCDF4 as netcdf
+
+    class FailingReplicaExchange(ReplicaExchange):
+        """Replica 0 always fails and replica 1 fails only at its first attempt."""
+
+        def __init__(self, *args, **kwargs):
+            ReplicaExchange.__init__(self, *args, **kwargs)
+            self.nattempts = [0, 0]
+
+        def _propagate_replica(self, replica_index):
+            if replica_index < 2:
+                self.nattempts[replica_index] += 1
+                if replica_index == 0 or self.nattempts[1] == 1:
+                    # Corrupt the configuration to verify the rollback.
+                    self.replica_positions[replica_index] = 2.0 * self.replica_positions[replica_index]
+                    raise Exception('Simulated failure')
+            return ReplicaExchange._propagate_replica(self, replica_index)
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        states, seed_positions = build_harmonic_oscillator_states([300.0, 350.0, 400.0])
+        simulation = create_simulation(store_filename, states, seed_positions, simulation_class=FailingReplicaExchange,
+                                       number_of_iterations=2, number_of_equilibration_iterations=0,
+                                       max_replica_failure_retries=2)
+        initial_positions = copy.deepcopy(simulation.replica_positions[0])
+        simulation.run()
+
+        # Replica 0 exhausted the retries and kept its configuration, replica 1 recovered.
+        assert simulation.nattempts == [3, 2]
+        assert numpy.allclose(simulation.replica_positions[0] / units.nanometers, initial_positions / units.nanometers)
+        del simulation
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        assert list(ncfile.variables['failures'][1,:]) == [1, 0, 0]
+        assert list(ncfile.variables['failures'][0,:]) == [0, 0, 0]
+        ncfile.close()
+
+def test_positions_write_interval():
+    """Test that positions are stored with a stride and resumed from the checkpoint."""
+    import netCDF4 as netcdf
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        states, seed_positions = build_harmonic_oscillator_states()
+        simulation = create_simulation(store_filename, states, seed_positions, positions_write_interval=2,
+                                       positions_atom_indices=[0], number_of_iterations=4)
+        simulation.run()
+        del simulation
+
+        # Only even iterations store positions, but energies are stored at every iteration.
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        assert ncfile.variables['energies'].shape[0] == 4
+        stored_iterations = ~numpy.ma.getmaskarray(ncfile.variables['positions'][:,0,0,0])
+        assert stored_iterations.tolist() == [True, False, True, False]
+        assert ncfile.variables['trajectory_atom_indices'][:].tolist() == [0]
+        assert int(ncfile.groups['checkpoint'].variables['iteration'].getValue()) == 3
+        checkpoint_positions = ncfile.groups['checkpoint'].variables['positions'][:,:,:]
+        ncfile.close()
+
+        # The simulation resumes from the checkpoint.
+        simulation = resume_simulation(store_filename)
+        simulation.run()
+        assert simulation.positions_atom_indices == [0]
+        for replica_index, positions in enumerate(simulation.replica_positions):
+            assert numpy.allclose(positions / units.nanometers, checkpoint_positions[replica_index])
+
+def test_resume_encoded_positions():
+    """Test that a simulation storing integer-encoded positions can be resumed and continued."""
+    import netCDF4 as netcdf
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        states, seed_positions = build_harmonic_oscillator_states()
+        simulation = create_simulation(store_filename, states, seed_positions, positions_encoding='int16',
+                                       positions_precision=0.001*units.nanometers, number_of_iterations=3)
+        simulation.run(niterations_to_run=1)
+        del simulation
+
+        # String options are restored as str.
+        simulation = resume_simulation(store_filename)
+        assert simulation.positions_encoding == 'int16'
+        assert isinstance(simulation.positions_encoding, str)
+        simulation.run()
+        del simulation
+
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        assert ncfile.variables['positions'].dtype == numpy.int16
+        assert ncfile.variables['energies'].shape[0] == 3
+        ncfile.close()
+
+def check_interrupted_run(simulation_class, niterations_stored, **options):
+    """
+    Check that a simulation stops cleanly with SimulationInterrupted and can be resumed and completed.
+
+    Parameters
+    ----------
+    simulation_class : type
+       The ReplicaExchange subclass to run.
+    niterations_stored : int
+       The number of iterations expected in the store file when the run stops.
+    **options
+       Options of the interrupted simulation.
+
+    """
+    import netCDF4 as netcdf
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        states, seed_positions = build_harmonic_oscillator_states()
+        simulation = create_simulation(store_filename, states, seed_positions, simulation_class=simulation_class,
+                                       number_of_iterations=4, **options)
+        with tools.assert_raises(SimulationInterrupted):
+            simulation.run()
+        del simulation
+
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        assert ncfile.variables['energies'].shape[0] == niterations_stored
+        ncfile.close()
+
+        # The stopped simulation resumes from the store file and completes.
+        simulation = resume_simulation(store_filename)
+        simulation.run()
+        del simulation
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        assert ncfile.variables['energies'].shape[0] == 4
+        ncfile.close()
+
+def test_walltime_limit():
+    """Test that the simulation stops before an iteration that would exceed the walltime limit."""
+    # The test process has already been running longer than the limit, so no iteration is run.
+    check_interrupted_run(ReplicaExchange, 1, walltime_limit=1.0e-3*units.seconds)
+
+def test_stop_signal():
+    """Test that the simulation stops at the end of the iteration during which a stop signal is received."""
+    import signal
+
+    class SignaledReplicaExchange(ReplicaExchange):
+        """Receive SIGUSR1 while propagating the first replica of the first iteration."""
+
+        def _propagate_replica(self, replica_index):
+            if self.iteration == 1 and replica_index == 0:
+                os.kill(os.getpid(), signal.SIGUSR1)
+            return ReplicaExchange._propagate_replica(self, replica_index)
+
+    check_interrupted_run(SignaledReplicaExchange, 2)
+
+def test_stop_signal_initialization():
+    """Test that a stop signal received while the simulation is initialized does not kill the process."""
+    import signal
+
+    class SignaledReplicaExchange(ReplicaExchange):
+        """Receive SIGUSR1 while resuming from the store file."""
+
+        def _initialize_resume(self):
+            os.kill(os.getpid(), signal.SIGUSR1)
+            return ReplicaExchange._initialize_resume(self)
+
+    check_interrupted_run(SignaledReplicaExchange, 1)
+
+def test_storage_sync_interval():
+    """Test that the store file is flushed according to the sync policy."""
+    import netCDF4 as netcdf
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        states, seed_positions = build_harmonic_oscillator_states()
+        simulation = create_simulation(store_filename, states, seed_positions, storage_sync_interval=2,
+                                       number_of_iterations=4)
+        simulation.run()
+        del simulation
+
+        # Iteration 0 is flushed when the file is created. Then every other iteration is
+        # synced, and the last iteration is flushed at the end of the run.
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        assert ncfile.variables['energies'].shape[0] == 4
+        synced_iterations = ~numpy.ma.getmaskarray(ncfile.groups['timings'].variables['sync'][:])
+        assert synced_iterations.tolist() == [False, False, True, True]
+        # Communication times are recorded only with MPI.
+        assert numpy.ma.getmaskarray(ncfile.groups['timings'].variables['communication_exposed'][:]).all()
+        ncfile.close()
+
+def test_rank_timings():
+    """Test that the time spent in each activity is stored and summarized in a performance report."""
+    import netCDF4 as netcdf
+    from yank.analyze import compute_performance_statistics
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        states, seed_positions = build_harmonic_oscillator_states([300.0, 350.0, 400.0])
+        simulation = create_simulation(store_filename, states, seed_positions, number_of_iterations=3)
+        simulation.run()
+        del simulation
+
+        # Without MPI, the timings of a single process are stored. Iteration 0 is written
+        # when the simulation is created, so only the iterations of run() have timings.
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        rank_timings = ncfile.groups['timings'].variables['rank_timings'][:]
+        assert rank_timings.shape == (3, 1, len(RANK_TIMINGS))
+        assert numpy.ma.getmaskarray(rank_timings).any(axis=(1, 2)).tolist() == [True, False, False]
+        assert numpy.all(rank_timings[1:] >= 0.0)
+        statistics = compute_performance_statistics(ncfile)
+        ncfile.close()
+        assert statistics['niterations'] == 2
+        assert statistics['slowest_rank'] == 0
+        assert 0.0 < statistics['parallel_efficiency'] <= 1.0
+        assert statistics['slowest_state'] in range(3)
+
+# Script run by each MPI process in test_replica_exchange_mpi(). It runs part of the
+# simulation, then resumes and completes it, covering minimization and replica transfers.
+MPI_SIMULATION_SCRIPT = """
+import sys
+import simtk.openmm as openmm
+from mpi4py import MPI
+from yank.repex import ReplicaExchange
+from yank.tests.test_repex import build_harmonic_oscillator_states, create_simulation
+
+store_filename, mpi_shared_memory = sys.argv[1], sys.argv[2] == 'True'
+states, seed_positions = build_harmonic_oscillator_states(%s)
+simulation = create_simulation(store_filename, states, seed_positions, mpicomm=MPI.COMM_WORLD, minimize=True,
+                               number_of_iterations=4, mpi_shared_memory=mpi_shared_memory)
+simulation.run(niterations_to_run=2)
+del simulation
+
+simulation = ReplicaExchange(store_filename, mpicomm=MPI.COMM_WORLD)
+simulation.resume()
+simulation.platform = openmm.Platform.getPlatformByName('Reference')
+simulation.run()
+del simulation
+"""
+
+def test_replica_exchange_mpi():
+    """Test that simulations on two MPI processes store energies consistent with the stored configurations."""
+    import subprocess
+    import netCDF4 as netcdf
+    from distutils.spawn import find_executable
+    from nose.plugins.skip import SkipTest
+
+    mpiexec = find_executable('mpiexec')
+    try:
+        import mpi4py
+    except ImportError:
+        mpiexec = None
+    if mpiexec is None:
+        raise SkipTest('mpi4py and mpiexec are required to run simulations on multiple MPI processes.')
+
+    # Replicas are split unevenly between the two processes.
+    temperatures = [300.0, 330.0, 360.0, 390.0, 420.0]
+    states, seed_positions = build_harmonic_oscillator_states(temperatures)
+    platform = openmm.Platform.getPlatformByName('Reference')
+    env = dict(os.environ, OMPI_ALLOW_RUN_AS_ROOT='1', OMPI_ALLOW_RUN_AS_ROOT_CONFIRM='1',
+               OMPI_MCA_rmaps_base_oversubscribe='1')
+
+    for mpi_shared_memory in [False, True]:
+        with enter_temp_directory():
+            store_filename = 'simulation.nc'
+            with open('run_simulation.py', 'w') as f:
+                f.write(MPI_SIMULATION_SCRIPT % str(temperatures))
+            subprocess.check_call([mpiexec, '-n', '2', sys.executable, 'run_simulation.py',
+                                   store_filename, str(mpi_shared_memory)], env=env)
+
+            # The energies computed by each process in each state must match the
+            # configurations gathered and stored by the root process.
+            ncfile = netcdf.Dataset(store_filename, 'r')
+            try:
+                assert ncfile.variables['energies'].shape[0] == 4
+                # Iteration 0 stores the initial configurations without energies.
+                for iteration in range(1, 4):
+                    replica_states = ncfile.variables['states'][iteration, :]
+                    assert sorted(replica_states.tolist()) == list(range(len(states)))
+                    for replica_index in range(len(states)):
+                        positions = ncfile.variables['positions'][iteration, replica_index, :, :].astype(numpy.float64)
+                        for state_index, state in enumerate(states):
+                            expected_energy = state.reduced_potential(positions * units.nanometers, platform=platform)
+                            stored_energy = ncfile.variables['energies'][iteration, replica_index, state_index]
+                            assert numpy.isclose(stored_energy, expected_energy, rtol=1e-4, atol=1e-4), \
+                                (iteration, replica_index, state_index, stored_energy, expected_energy)
+            finally:
+                ncfile.close()
+
+def test_deduplicated_systems():
+    """Test that identical systems are stored once and shared on resume."""
+    import netCDF4 as netcdf
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        states, seed_positions = build_harmonic_oscillator_states([300.0, 350.0, 400.0])
+        states[2].system.setParticleMass(0, 2.0 * units.amu)
+        simulation = create_simulation(store_filename, states, seed_positions, number_of_iterations=1)
+        del simulation
+
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        ncgrp_stateinfo = ncfile.groups['thermodynamic_states']
+        assert len(ncgrp_stateinfo.dimensions['system']) == 2
+        assert ncgrp_stateinfo.variables['system_indices'][:].tolist() == [0, 0, 1]
+        for system_index, state_index in [(0, 0), (1, 2)]:
+            serialized = load_serialized_system(ncgrp_stateinfo.variables['systems'], system_index)
+            assert serialized == states[state_index].system.__getstate__()
+        ncfile.close()
+
+        simulation = resume_simulation(store_filename)
+        assert simulation.states[0].system is simulation.states[1].system
+        assert simulation.states[0].system is not simulation.states[2].system
+        assert simulation.states[2].system.getParticleMass(0) == 2.0 * units.amu
+
+def test_resume_cache():
+    """Test that resuming the same file twice reuses copies of the lazily loaded states."""
+    import netCDF4 as netcdf
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        states, seed_positions = build_harmonic_oscillator_states()
+        simulation = create_simulation(store_filename, states, seed_positions, number_of_iterations=2)
+        simulation.run(niterations_to_run=1)
+        del simulation
+
+        # Systems are not deserialized until they are needed.
+        first_simulation = ReplicaExchange(store_filename)
+        first_simulation.resume()
+        assert 'thermodynamic states' in first_simulation._resume_timings
+        assert first_simulation.states[0]._system_loader is not None
+
+        # The second resume restores states and options from the cache.
+        simulation = resume_simulation(store_filename)
+        assert 'cached states and options' in simulation._resume_timings
+        assert simulation.number_of_iterations == 2
+
+        # Cached states are copied, and their Systems are still deserialized lazily.
+        assert simulation.states[0] is not first_simulation.states[0]
+        assert simulation.states[0]._system_loader is not None
+        assert simulation.states[0].system is not first_simulation.states[0].system
+        simulation.run()
+        assert simulation.states[0].system.getNumParticles() == states[0].system.getNumParticles()
+        del simulation, first_simulation
+
+        # Entries are not used after the stored states change.
+        ncfile = netcdf.Dataset(store_filename, 'r+')
+        ncfile.groups['thermodynamic_states'].variables['temperatures'][0] = 310.0
+        ncfile.close()
+        simulation = resume_simulation(store_filename)
+        assert 'thermodynamic states' in simulation._resume_timings
+        assert simulation.states[0].temperature == 310.0 * units.kelvin
+
+def test_trajectory_directory():
+    """Test that positions can be stored in a separate trajectory file."""
+    import netCDF4 as netcdf
+
+    with enter_temp_directory():
+        store_filename = 'phase.nc'
+        states, seed_positions = build_harmonic_oscillator_states()
+        simulation = create_simulation(store_filename, states, seed_positions, trajectory_directory='trajectories',
+                                       number_of_iterations=3)
+        simulation.run(niterations_to_run=1)
+        del simulation
+
+        # Energies and positions are stored in the two linked files.
+        trajectory_filename = os.path.join('trajectories', 'phase' + utils.TRAJECTORY_FILE_SUFFIX)
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        trajectory_ncfile = netcdf.Dataset(trajectory_filename, 'r')
+        try:
+            assert 'positions' not in ncfile.variables
+            assert ncfile.variables['energies'].shape[0] == 2
+            assert trajectory_ncfile.variables['positions'].shape[0] == 2
+            assert trajectory_ncfile.store_file_UUID == ncfile.UUID
+            assert os.path.samefile(get_trajectory_filename(ncfile, store_filename), trajectory_filename)
+        finally:
+            ncfile.close()
+            trajectory_ncfile.close()
+
+        # The simulation resumes from the pair of files.
+        simulation = resume_simulation(store_filename)
+        simulation.run()
+        del simulation
+        trajectory_ncfile = netcdf.Dataset(trajectory_filename, 'r')
+        assert trajectory_ncfile.variables['positions'].shape[0] == 3
+        trajectory_ncfile.close()
+
+        # Migrating the store file migrates and relinks its trajectory file.
+        os.makedirs('migrated')
+        migrated_filename = os.path.join('migrated', 'phase.nc')
+        migrate_netcdf_layout(store_filename, migrated_filename, chunk_iterations=2)
+        migrated_trajectory_filename = os.path.join('migrated', trajectory_filename)
+        ncfile = netcdf.Dataset(migrated_filename, 'r')
+        try:
+            assert os.path.samefile(get_trajectory_filename(ncfile, migrated_filename), migrated_trajectory_filename)
+        finally:
+            ncfile.close()
+        trajectory_ncfile = netcdf.Dataset(migrated_trajectory_filename, 'r')
+        assert trajectory_ncfile.variables['positions'].shape[0] == 3
+        assert trajectory_ncfile.store_file == os.path.join('..', 'phase.nc')
+        trajectory_ncfile.close()
+        # The migrated pair of files passes the checks made when resuming.
+        simulation = resume_simulation(migrated_filename)
+        simulation.run()
+        del simulation
+
+def test_compute_netcdf_chunksizes():
+    """Test the chunk shapes of the store file variables."""
+    assert compute_netcdf_chunksizes(('replica',), (10,), 4, 64) is None
+    assert compute_netcdf_chunksizes(('iteration', 'replica', 'atom', 'spatial'), (0, 10, 500, 3), 4, 64) == (1, 1, 500, 3)
+    assert compute_netcdf_chunksizes(('iteration', 'replica'), (0, 10), 4, 64) == (64, 10)
+    # Chunks are capped to MAX_CHUNK_BYTES.
+    chunksizes = compute_netcdf_chunksizes(('iteration', 'replica', 'replica'), (0, 200, 200), 8, 64)
+    assert chunksizes == (MAX_CHUNK_BYTES // (8 * 200 * 200), 200, 200)
+
+def test_balance_replica_assignment():
+    """Test that replicas are redistributed among nodes by cost, moving as few as possible."""
+    costs = numpy.array([4.0, 1.0, 1.0, 1.0, 1.0])
+    assignment = numpy.array([0, 0, 1, 1, 0])
+    assert numpy.isclose(compute_load_imbalance(costs, assignment, 2), 6.0 / 4.0 - 1.0)
+    new_assignment = balance_replica_assignment(costs, assignment, 2)
+    assert numpy.isclose(compute_load_imbalance(costs, new_assignment, 2), 0.0)
+    # The expensive replica stays on its node.
+    assert new_assignment[0] == 0
+    assert numpy.count_nonzero(new_assignment != assignment) == 2
+    # Balanced assignments are not modified.
+    assert numpy.all(balance_replica_assignment(costs, new_assignment, 2) == new_assignment)
+
+def test_migrate_netcdf_layout():
+    """Test that migrated store files keep the data with the new layout."""
+    import netCDF4 as netcdf
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        migrated_filename = 'migrated.nc'
+        states, seed_positions = build_harmonic_oscillator_states()
+        simulation = create_simulation(store_filename, states, seed_positions, storage_zlib=False,
+                                       number_of_iterations=3)
+        simulation.run()
+        # The store file must be closed before it is reopened for migration.
+        del simulation
+        migrate_netcdf_layout(store_filename, migrated_filename, chunk_iterations=2, zlib=True)
+
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        migrated_ncfile = netcdf.Dataset(migrated_filename, 'r')
+        try:
+            for variable_name in ['positions', 'states', 'energies', 'box_vectors']:
+                assert numpy.allclose(ncfile.variables[variable_name][:], migrated_ncfile.variables[variable_name][:])
+            assert migrated_ncfile.variables['energies'].chunking() == [2, 2, 2]
+            assert migrated_ncfile.variables['energies'].filters()['zlib'] is True
+            assert set(ncfile.groups.keys()) == set(migrated_ncfile.groups.keys())
+            migrated_ncgrp = migrated_ncfile.groups['thermodynamic_states']
+            assert load_serialized_system(migrated_ncgrp.variables['systems']) == states[0].system.__getstate__()
+        finally:
+            ncfile.close()
+            migrated_ncfile.close()
+
+def test_quantize_positions():
+    """Test the fixed-precision integer encoding of positions."""
+    import netCDF4 as netcdf
+
+    ncfile = netcdf.Dataset('quantize_positions.nc', 'w', diskless=True, persist=False)
+    ncfile.createDimension('atom', 2)
+    ncfile.createDimension('spatial', 3)
+    ncvar_positions = ncfile.createVariable('positions', 'i2', ('atom', 'spatial'))
+    setattr(ncvar_positions, 'scale_factor', 0.001)
+
+    repex = ReplicaExchange(store_filename='test', positions_encoding='int16',
+                            positions_precision=0.001*units.nanometers)
+    repex.iteration = 0
+    x = numpy.array([[0.0, 1.2344, -2.5], [10.0, 20.0, 30.0]])
+    ncvar_positions[:] = repex._quantize_positions(x, ncvar_positions)
+    ncvar_positions.set_auto_scale(True)
+    assert numpy.allclose(ncvar_positions[:], x, atol=0.0005)
+
+    # Positions out of the int16 range raise an exception.
+    with tools.assert_raises(ValueError):
+        repex._quantize_positions(x * 10, ncvar_positions)
+    ncfile.close()
+
 #=============================================================================================
 # MAIN AND TESTS
 #=============================================================================================
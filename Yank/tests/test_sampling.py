@@ -56,3 +56,144 @@ def test_resuming():
         simulation.resume()
         assert simulation.fully_interacting_expanded_state is not None
         assert simulation.noninteracting_expanded_state is not None
+
+
+def test_nan_checkpoint_blocks():
+    """Test that dynamics split in checkpointed blocks run and store NaN statistics."""
+    toluene_test = testsystems.TolueneImplicit()
+    ligand_atoms = range(15)
+    alchemical_factory = AbsoluteAlchemicalFactory(toluene_test.system,
+                                                   ligand_atoms=ligand_atoms)
+
+    base_state = ThermodynamicState(temperature=300.0*unit.kelvin)
+    base_state.system = alchemical_factory.alchemically_modified_system
+
+    alchemical_state1 = AlchemicalState(lambda_electrostatics=1.0, lambda_sterics=1.0)
+    alchemical_state0 = AlchemicalState(lambda_electrostatics=0.0, lambda_sterics=0.0)
+    alchemical_states = [alchemical_state1, alchemical_state0]
+
+    with enter_temp_directory():
+        store_file_name = 'simulation.nc'
+        options = {'number_of_iterations': 1, 'nsteps_per_iteration': 25, 'nan_checkpoint_steps': 10,
+                   'minimize': False, 'number_of_equilibration_iterations': 0}
+        simulation = ModifiedHamiltonianExchange(store_file_name)
+        simulation.create(base_state, alchemical_states, toluene_test.positions,
+                          mc_atoms=ligand_atoms, options=options)
+        del simulation
+
+        simulation = ModifiedHamiltonianExchange(store_file_name)
+        simulation.resume()
+        assert simulation.nan_checkpoint_steps == 10
+        simulation.run()
+        del simulation
+
+        ncfile = netcdf.Dataset(store_file_name, 'r')
+        try:
+            nan_retries = ncfile.groups['timings'].variables['nan_retries']
+            assert nan_retries.dimensions == ('iteration', 'state')
+            assert nan_retries.shape == (2, 2)
+            assert nan_retries[1, :].sum() == 0
+        finally:
+            ncfile.close()
+
+
+class NaNContext(object):
+    """Minimal Context stub holding positions and velocities in nanometers."""
+
+    class State(object):
+        def __init__(self, positions, velocities):
+            self._positions = unit.Quantity(np.array(positions), unit.nanometers)
+            self._velocities = unit.Quantity(np.array(velocities), unit.nanometers/unit.picoseconds)
+
+        def getPositions(self, asNumpy=False):
+            return self._positions
+
+        def getVelocities(self, asNumpy=False):
+            return self._velocities
+
+        def getPotentialEnergy(self):
+            return np.sum(self._positions / unit.nanometers) * unit.kilojoules_per_mole
+
+        def getPeriodicBoxVectors(self):
+            return [None, None, None]
+
+    def __init__(self, n_particles):
+        self.positions = np.zeros([n_particles, 3])
+        self.velocities = np.ones([n_particles, 3])
+
+    def getState(self, getPositions=False, getVelocities=False, getEnergy=False):
+        return self.State(self.positions, self.velocities)
+
+    def setPositions(self, positions):
+        self.positions = np.array(positions / unit.nanometers)
+
+    def setVelocities(self, velocities):
+        self.velocities = np.array(velocities / (unit.nanometers/unit.picoseconds))
+
+    def setPeriodicBoxVectors(self, a, b, c):
+        pass
+
+
+class NaNIntegrator(object):
+    """Integrator stub that moves particles by 0.1 nm per step and produces NaNs on given attempts."""
+
+    def __init__(self, context, nan_attempts):
+        self.context = context
+        self.nan_attempts = nan_attempts
+        self.step_size = 2.0 * unit.femtoseconds
+        self.step_sizes = []  # Step size used at each call to step().
+
+    def getStepSize(self):
+        return self.step_size
+
+    def setStepSize(self, step_size):
+        self.step_size = step_size
+
+    def step(self, nsteps):
+        self.step_sizes.append(self.step_size)
+        if len(self.step_sizes) in self.nan_attempts:
+            self.context.positions[:] = np.nan
+        else:
+            self.context.positions += 0.1 * nsteps
+
+
+def test_nan_rollback():
+    """Test that blocks producing NaNs are rolled back to the checkpoint and retried."""
+    with enter_temp_directory():
+        simulation = ModifiedHamiltonianExchange('simulation.nc', nsteps_per_iteration=25,
+                                                 nan_checkpoint_steps=10, nan_retry_timestep_scale=0.5)
+        simulation.states = [ThermodynamicState(temperature=300.0*unit.kelvin) for _ in range(2)]
+        simulation.nan_retries = np.zeros([2], np.int32)
+        simulation.nan_recovery_time = np.zeros([2], np.float64)
+
+        # Blocks are 10, 10 and 5 steps; the first two attempts of the second block produce NaNs.
+        context = NaNContext(n_particles=3)
+        integrator = NaNIntegrator(context, nan_attempts=[2, 3])
+        simulation._run_dynamics_blocks(0, 1, context, integrator)
+
+        # Failed blocks are restarted from the checkpoint so no NaN has propagated.
+        assert np.allclose(context.positions, 2.5)
+        assert np.allclose(context.velocities, 1.0)
+
+        # Retries are accounted to the state of the replica only.
+        assert simulation.nan_retries[1] == 2
+        assert simulation.nan_retries[0] == 0
+        assert simulation.nan_recovery_time[1] >= 0.0
+        assert simulation.nan_recovery_time[0] == 0.0
+
+        # Retries are run with a scaled timestep and the original one is restored afterwards.
+        step_sizes = [step_size / unit.femtoseconds for step_size in integrator.step_sizes]
+        assert np.allclose(step_sizes, [2.0, 2.0, 1.0, 0.5, 2.0])
+        assert integrator.getStepSize() == 2.0 * unit.femtoseconds
+
+        # When all retries fail, an exception is raised and the timestep is still restored.
+        context = NaNContext(n_particles=3)
+        integrator = NaNIntegrator(context, nan_attempts=range(1, MAX_NAN_RETRIES + 1))
+        try:
+            simulation._run_dynamics_blocks(0, 0, context, integrator)
+        except Exception as e:
+            assert 'Maximum number of NAN retries' in str(e)
+        else:
+            raise AssertionError('Exceeding MAX_NAN_RETRIES did not raise.')
+        assert simulation.nan_retries[0] == MAX_NAN_RETRIES
+        assert integrator.getStepSize() == 2.0 * unit.femtoseconds
@@ -239,6 +239,132 @@ def test_unknown_parameters():
     validate_parameters(wrong_pars, template_pars, check_unknown=True)
 
 
+def test_mpi_allgather_rows():
+    """Test that mpi_allgather_rows() places the rows of each node in the right indices."""
+    from mpi4py import MPI
+    out = np.zeros([4, 2, 3])
+    local_rows = np.array([np.full([2, 3], i) for i in [3, 1]])
+    mpi_allgather_rows(MPI.COMM_SELF, local_rows, [[3, 1]], out)
+    assert np.all(out[[0, 2]] == 0.0)
+    assert np.all(out[1] == 1.0) and np.all(out[3] == 3.0)
+
+    # Gather columns through the transpose.
+    u_kl = np.zeros([3, 3])
+    mpi_allgather_rows(MPI.COMM_SELF, np.ones([3, 1]).T, [[2]], u_kl.T)
+    assert np.all(u_kl[:, 2] == 1.0) and np.all(u_kl[:, :2] == 0.0)
+
+
+def test_mpi_gather_rows():
+    """Test that mpi_gather_rows() places the rows of each node in the right indices of the root."""
+    from mpi4py import MPI
+    out = np.zeros([3, 2])
+    mpi_gather_rows(MPI.COMM_SELF, np.array([[1.0, 2.0]]), [[1]], out)
+    assert np.all(out[1] == [1.0, 2.0])
+    assert np.all(out[[0, 2]] == 0.0)
+
+
+def test_allocate_shared_array():
+    """Test that allocate_shared_array() returns a writable array of the requested shape."""
+    from mpi4py import MPI
+    node_comm = get_node_communicator(MPI.COMM_SELF)
+    assert node_comm.size == 1
+    array, window = allocate_shared_array(node_comm, (2, 3), np.int64)
+    assert array.shape == (2, 3) and array.dtype == np.int64
+    array[:] = np.arange(6).reshape(2, 3)
+    assert array[1, 2] == 5
+    del array
+    window.Free()
+    node_comm.Free()
+
+
+def test_catch_stop_signals():
+    """Test that catch_stop_signals() records the stop signals and restores the handlers."""
+    import os
+    import signal
+    old_handler = signal.getsignal(signal.SIGUSR1)
+    with catch_stop_signals([signal.SIGUSR1]) as received_signals:
+        assert received_signals == []
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert received_signals == [signal.SIGUSR1]
+    assert signal.getsignal(signal.SIGUSR1) == old_handler
+
+
+def test_distribute_mpi_processes():
+    """Test that MPI processes are divided proportionally to the cost of the groups."""
+    assert distribute_mpi_processes(2, [40, 10]) == [1, 1]
+    assert distribute_mpi_processes(5, [40, 10]) == [4, 1]
+    assert distribute_mpi_processes(6, [20, 10]) == [4, 2]
+    assert distribute_mpi_processes(4, [1, 1, 1]) == [2, 1, 1]
+    tools.assert_raises(ValueError, distribute_mpi_processes, 1, [10, 10])
+
+
+def test_count_visible_gpus():
+    """Test that count_visible_gpus() counts the devices in CUDA_VISIBLE_DEVICES only for CUDA."""
+    old_visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES', None)
+    try:
+        for visible_devices, ngpus in [('0,1,3', 3), ('2', 1), ('', 0), ('-1', 0)]:
+            os.environ['CUDA_VISIBLE_DEVICES'] = visible_devices
+            assert count_visible_gpus() == ngpus
+            assert count_visible_gpus('CUDA') == ngpus
+        # OpenCL devices are not selected through CUDA_VISIBLE_DEVICES.
+        os.environ['CUDA_VISIBLE_DEVICES'] = '0,1,3'
+        opencl_ngpus = count_visible_gpus('OpenCL')
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        assert count_visible_gpus('OpenCL') == opencl_ngpus
+        tools.assert_raises(ValueError, count_visible_gpus, 'CPU')
+    finally:
+        if old_visible_devices is None:
+            del os.environ['CUDA_VISIBLE_DEVICES']
+        else:
+            os.environ['CUDA_VISIBLE_DEVICES'] = old_visible_devices
+
+
+class FakeMPIGroups(object):
+    """Communicator of the process of a group, faking the outcome of the processes of the other groups."""
+
+    def __init__(self, other_errors):
+        self.other_errors = other_errors
+        self.freed = False
+
+    def Free(self):
+        self.freed = True
+
+    def allgather(self, value):
+        return [value] + self.other_errors
+
+
+class ResumableError(Exception):
+    pass
+
+
+def test_synchronize_mpi_groups():
+    """Test that synchronize_mpi_groups() shares the failures of the groups with all the processes."""
+    # All the groups succeeded.
+    mpicomm = FakeMPIGroups([None])
+    with synchronize_mpi_groups(mpicomm, mpicomm, (ResumableError,)):
+        pass
+    assert mpicomm.freed
+
+    # The failure of this group is shared before being raised.
+    mpicomm = FakeMPIGroups([None])
+    with tools.assert_raises(ValueError):
+        with synchronize_mpi_groups(mpicomm, mpicomm, (ResumableError,)):
+            raise ValueError('failed')
+    assert mpicomm.freed
+
+    # The failures of the other groups are raised by this one.
+    for other_errors, expected_exception in [([(True, 'ResumableError: stop')], ResumableError),
+                                             ([(True, 'ResumableError: stop'), (False, 'ValueError: failed')], RuntimeError)]:
+        mpicomm = FakeMPIGroups(other_errors)
+        with tools.assert_raises(expected_exception):
+            with synchronize_mpi_groups(mpicomm, mpicomm, (ResumableError,)):
+                pass
+    mpicomm = FakeMPIGroups([(True, 'ResumableError: stop')])
+    with tools.assert_raises(RuntimeError):
+        with synchronize_mpi_groups(mpicomm, mpicomm):
+            pass
+
+
 def test_underscore_to_camelcase():
     """Test underscore_to_camelCase() conversion function."""
     cases = ['', '__', 'foo', 'foo_bar', '_foo_bar_', '__foo_bar__', '__foo__bar_']
@@ -26,6 +26,7 @@ from nose.plugins.attrib import attr
 from mdtraj.formats.mol2 import mol2_to_dataframes
 
 from yank.yamlbuild import *
+from yank.repex import load_serialized_system
 
 # ==============================================================================
 # Subroutines for testing
@@ -293,7 +294,10 @@ def test_yaml_parsing():
     """
 
     yaml_builder = YamlBuilder(textwrap.dedent(yaml_content))
-    assert len(yaml_builder.options) == 35
+    # Options are the defaults updated with those in the script and its metadata.
+    parsed_yaml = yaml.load(textwrap.dedent(yaml_content))
+    expected_options = set(yaml_builder.DEFAULT_OPTIONS) | set(parsed_yaml['options']) | set(parsed_yaml['metadata'])
+    assert len(yaml_builder.options) == len(expected_options)
     assert len(yaml_builder.yank_options) == 23
 
     # Check correct types
@@ -320,6 +324,29 @@ def test_validation_wrong_options():
         yield assert_raises, YamlParseError, YamlBuilder._validate_options, option
 
 
+def test_dynamics_preset():
+    """Dynamics presets overwrite only default options and check their safety."""
+    options = YamlBuilder.DEFAULT_OPTIONS.copy()
+    options.update(YamlBuilder._validate_options({'dynamics_preset': 'hmr-4fs',
+                                                  'timestep': '3.0 * femtoseconds'}))
+    YamlBuilder._apply_dynamics_preset(options)
+    assert options['hydrogen_mass'] == 4 * unit.amu
+    assert options['timestep'] == 3.0 * unit.femtoseconds
+    assert options['integrator_type'] == 'baoab'
+
+    # Unsafe and unknown presets raise an exception.
+    wrong_options = [
+        {'dynamics_preset': 'hmr-4fs', 'constraints': None},
+        {'dynamics_preset': 'hmr-4fs', 'hydrogen_mass': '2 * amu'},
+        {'dynamics_preset': 'hmr-4fs', 'timestep': '5.0 * femtoseconds'},
+        {'dynamics_preset': 'unknown'}
+    ]
+    for wrong_option in wrong_options:
+        options = YamlBuilder.DEFAULT_OPTIONS.copy()
+        options.update(YamlBuilder._validate_options(wrong_option))
+        yield assert_raises, YamlParseError, YamlBuilder._apply_dynamics_preset, options
+
+
 def test_validation_correct_molecules():
     """Correct molecules YAML validation."""
     paths = examples_paths()
@@ -1945,7 +1972,7 @@ def test_run_solvation_experiment():
         ncfile = Dataset(os.path.join(output_dir, 'solvent1.nc'), 'r')
         ncgrp_stateinfo = ncfile.groups['thermodynamic_states']
         system = openmm.System()
-        system.__setstate__(str(ncgrp_stateinfo.variables['base_system'][0]))
+        system.__setstate__(load_serialized_system(ncgrp_stateinfo.variables['base_system']))
         has_barostat = False
         for force in system.getForces():
             if force.__class__.__name__ == 'MonteCarloBarostat':
@@ -6,6 +6,7 @@ import glob
 import json
 import shutil
 import signal
+import time
 import pandas
 import inspect
 import logging
@@ -24,6 +25,8 @@ from schema import Optional, Use
 
 from openmoltools.utils import wraps_py2, unwrap_py2  # Shortcuts for other modules
 
+logger = logging.getLogger(__name__)
+
 #========================================================================================
 # Logging functions
 #========================================================================================
@@ -194,6 +197,467 @@ def initialize_mpi():
 
     return mpicomm
 
+
+def get_node_communicator(mpicomm):
+    """Return the communicator of the MPI processes that can share memory with this process.
+
+    This is a collective operation that must be called by all processes of the communicator.
+
+    Parameters
+    ----------
+    mpicomm : mpi4py communicator
+        The communicator to split.
+
+    Returns
+    -------
+    node_comm : mpi4py communicator or None
+        The communicator of the processes running on the same node, ordered by their
+        rank in mpicomm, or None if the MPI library does not support MPI-3 shared memory.
+        The caller must call its Free() method collectively when it is not needed anymore.
+
+    """
+    from mpi4py import MPI
+    try:
+        return mpicomm.Split_type(MPI.COMM_TYPE_SHARED, key=mpicomm.rank)
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+def allocate_shared_array(node_comm, shape, dtype=np.float64):
+    """Allocate an array in memory shared by all the MPI processes of a node.
+
+    The memory is allocated by the first process of the node with MPI.Win.Allocate_shared
+    and mapped by the others, so that all of them read and write the same data. Processes
+    must synchronize (e.g. with node_comm.Barrier()) before reading data written by others.
+
+    This is a collective operation that must be called by all processes of the communicator.
+
+    Parameters
+    ----------
+    node_comm : mpi4py communicator
+        The communicator of the processes of the node (see get_node_communicator()).
+    shape : tuple of int
+        The shape of the array.
+    dtype : numpy.dtype, optional, default=numpy.float64
+        The type of the elements of the array.
+
+    Returns
+    -------
+    array : numpy.ndarray
+        The shared array. Its content is undefined.
+    window : mpi4py.MPI.Win
+        The window owning the memory. This must be freed collectively with its Free()
+        method after all references to the array have been dropped.
+
+    """
+    from mpi4py import MPI
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize if node_comm.rank == 0 else 0
+    window = MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm=node_comm)
+    buffer, itemsize = window.Shared_query(0)
+    array = np.ndarray(buffer=buffer, dtype=dtype, shape=shape)
+    return array, window
+
+
+def get_node_local_rank(mpicomm):
+    """Return the rank of this process among the MPI processes running on the same node.
+
+    This is a collective operation that must be called by all processes of the communicator.
+
+    Parameters
+    ----------
+    mpicomm : mpi4py communicator
+        The communicator.
+
+    Returns
+    -------
+    local_rank : int
+        The rank of this process among the processes of its node.
+    local_size : int
+        The number of processes of the communicator running on this node.
+
+    """
+    from mpi4py import MPI
+    local_comm = get_node_communicator(mpicomm)
+    if local_comm is None:
+        # MPI libraries without MPI-3 support: group processes by host name.
+        hosts = mpicomm.allgather(MPI.Get_processor_name())
+        node_ranks = [rank for rank, host in enumerate(hosts) if host == hosts[mpicomm.rank]]
+        return node_ranks.index(mpicomm.rank), len(node_ranks)
+    local_rank, local_size = local_comm.rank, local_comm.size
+    local_comm.Free()
+    return local_rank, local_size
+
+
+def count_visible_gpus(platform_name='CUDA'):
+    """Return the number of GPUs visible to this process through an OpenMM platform.
+
+    For the CUDA platform, the devices listed in CUDA_VISIBLE_DEVICES are counted if
+    the variable is set, otherwise those reported by nvidia-smi. OpenCL implementations
+    other than NVIDIA's ignore CUDA_VISIBLE_DEVICES, so for the OpenCL platform the GPUs
+    of the OpenCL platform with most GPUs are counted through pyopencl, if installed.
+
+    Parameters
+    ----------
+    platform_name : str, optional, default='CUDA'
+        The name of the OpenMM platform, either 'CUDA' or 'OpenCL'.
+
+    Returns
+    -------
+    ngpus : int or None
+        The number of visible GPUs, or None if it cannot be determined.
+
+    """
+    if platform_name == 'OpenCL':
+        try:
+            import pyopencl
+            return max(len(opencl_platform.get_devices(device_type=pyopencl.device_type.GPU))
+                       for opencl_platform in pyopencl.get_platforms())
+        except Exception:
+            # pyopencl is not installed or no OpenCL platform is available.
+            return None
+    elif platform_name != 'CUDA':
+        raise ValueError('Cannot count the GPUs of the {} platform.'.format(platform_name))
+
+    visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES', None)
+    if visible_devices is not None:
+        return len([device for device in visible_devices.split(',')
+                    if device.strip() != '' and not device.strip().startswith('-')])
+    try:
+        output = subprocess.check_output(['nvidia-smi', '-L'], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return len([line for line in output.decode('utf-8').splitlines() if line.startswith('GPU')])
+
+
+def bind_platform_device(platform, mpicomm, node_placement=None):
+    """Spread the MPI processes running on each node across its GPUs.
+
+    The processes of a node are assigned to the visible devices in contiguous blocks,
+    so when there are more processes than devices each device is shared by at most
+    ceil(processes / devices) of them. The device is set through the DeviceIndex
+    property of the CUDA and OpenCL platforms, unless it has already been set.
+
+    This is a collective operation that must be called by all processes of the communicator,
+    unless node_placement is given.
+
+    Parameters
+    ----------
+    platform : simtk.openmm.Platform
+        The platform to configure.
+    mpicomm : mpi4py communicator
+        The communicator.
+    node_placement : tuple of int, optional
+        The pair (local_rank, local_size) returned by get_node_local_rank(). Pass it when
+        only a group of the processes configures the platform, computing it before the
+        communicator is split, so that groups sharing a node use different devices.
+
+    Returns
+    -------
+    device_index : int or None
+        The index of the device assigned to this process, or None if the platform
+        was not modified.
+
+    """
+    if node_placement is None:
+        node_placement = get_node_local_rank(mpicomm)
+    local_rank, local_size = node_placement
+    platform_name = platform.getName()
+    if platform_name not in ['CUDA', 'OpenCL']:
+        return None
+
+    # Property names are prefixed by the platform name in OpenMM < 7.1.
+    property_names = ['DeviceIndex', platform_name.replace('CUDA', 'Cuda') + 'DeviceIndex']
+    for property_name in property_names:
+        try:
+            current_device = platform.getPropertyDefaultValue(property_name)
+            break
+        except Exception:
+            continue
+    else:
+        logger.debug('Cannot find the device index property of the {} platform.'.format(platform_name))
+        return None
+    if current_device != '':
+        logger.debug('Keeping device {} selected for the {} platform.'.format(current_device, platform_name))
+        return None
+
+    ndevices = count_visible_gpus(platform_name)
+    if not ndevices:
+        logger.debug('Cannot determine the number of GPUs; device selection is left to OpenMM.')
+        return None
+    device_index = local_rank * ndevices // local_size
+    platform.setPropertyDefaultValue(property_name, str(device_index))
+    logger.debug('Node {}/{}: local process {}/{} bound to {} device {}.'.format(
+        mpicomm.rank, mpicomm.size, local_rank, local_size, platform_name, device_index))
+    return device_index
+
+
+def distribute_mpi_processes(nprocesses, weights):
+    """Divide a number of MPI processes among groups of work with different costs.
+
+    Every group receives at least one process. The remaining processes are assigned
+    one at a time to the group with the highest weight per process, which minimizes
+    the largest weight handled by a single process.
+
+    Parameters
+    ----------
+    nprocesses : int
+        The number of processes to divide.
+    weights : list of float
+        weights[i] is the cost of group i (e.g. its number of replicas).
+
+    Returns
+    -------
+    group_sizes : list of int
+        group_sizes[i] is the number of processes assigned to group i.
+
+    Raises
+    ------
+    ValueError
+        If there are fewer processes than groups.
+
+    Examples
+    --------
+    >>> distribute_mpi_processes(6, [20, 10])
+    [4, 2]
+
+    """
+    if nprocesses < len(weights):
+        raise ValueError('Cannot divide {} processes among {} groups.'.format(nprocesses, len(weights)))
+    group_sizes = [1 for _ in weights]
+    for _ in range(nprocesses - len(weights)):
+        group_index = max(range(len(weights)), key=lambda i: float(weights[i]) / group_sizes[i])
+        group_sizes[group_index] += 1
+    return group_sizes
+
+
+def split_mpi_communicator(mpicomm, weights):
+    """Split the communicator into groups of processes sized by the cost of their work.
+
+    The processes are divided with distribute_mpi_processes() and each group is formed
+    by consecutive ranks. This is a collective operation that must be called by all
+    processes of the communicator.
+
+    Parameters
+    ----------
+    mpicomm : mpi4py communicator
+        The communicator to split.
+    weights : list of float
+        weights[i] is the cost of the work of group i.
+
+    Returns
+    -------
+    group_index : int
+        The index of the group of this process.
+    group_comm : mpi4py communicator
+        The communicator of the group. The caller must call its Free() method
+        collectively when it is not needed anymore.
+
+    """
+    group_sizes = distribute_mpi_processes(mpicomm.size, weights)
+    group_index = 0
+    first_rank = 0
+    while mpicomm.rank >= first_rank + group_sizes[group_index]:
+        first_rank += group_sizes[group_index]
+        group_index += 1
+    group_comm = mpicomm.Split(color=group_index, key=mpicomm.rank)
+    logger.debug('Node {}/{}: assigned to group {} with {} processes.'.format(
+        mpicomm.rank, mpicomm.size, group_index, group_comm.size))
+    return group_index, group_comm
+
+
+@contextmanager
+def synchronize_mpi_groups(mpicomm, group_comm, resumable_exceptions=()):
+    """Context manager waiting for all the groups of processes created by split_mpi_communicator().
+
+    When the block exits, the group communicator is freed and the processes of mpicomm
+    share whether their work failed. This happens also if the block raises, so the other
+    groups are not left waiting for this one. If this process succeeded but a process
+    of another group failed, an exception is raised here too, so that all processes
+    report the failure: the first of resumable_exceptions if all the failed processes
+    raised one of those (e.g. the simulations were interrupted and can be resumed),
+    or a RuntimeError otherwise.
+
+    This is a collective operation that must be entered by all processes of mpicomm.
+
+    Parameters
+    ----------
+    mpicomm : mpi4py communicator
+        The communicator that was split.
+    group_comm : mpi4py communicator
+        The communicator of the group of this process.
+    resumable_exceptions : tuple of type, optional
+        The exceptions signaling that the work of a group can be resumed.
+
+    """
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = (isinstance(e, resumable_exceptions), '{}: {}'.format(type(e).__name__, e))
+        raise
+    finally:
+        group_comm.Free()
+        errors = mpicomm.allgather(error)
+
+    errors = [(rank, error) for rank, error in enumerate(errors) if error is not None]
+    if len(errors) > 0:
+        message = 'MPI processes of other groups failed: ' + '; '.join(
+            'process {}: {}'.format(rank, error_message) for rank, (_, error_message) in errors)
+        if len(resumable_exceptions) > 0 and all(resumable for _, (resumable, _) in errors):
+            raise resumable_exceptions[0](message)
+        raise RuntimeError(message)
+
+
+class MPIPendingRows(object):
+    """A gather of array rows started by mpi_allgather_rows() or mpi_gather_rows().
+
+    The rows are placed in the output array only after wait() is called.
+
+    """
+
+    def __init__(self, request, send_buffer, receive_buffer, row_indices, out):
+        self._request = request
+        self._send_buffer = send_buffer  # must be kept alive until the communication completes
+        self._receive_buffer = receive_buffer
+        self._row_indices = row_indices
+        self._out = out
+
+    def wait(self):
+        """Wait for the communication to complete and place the received rows.
+
+        Returns
+        -------
+        wait_time : float
+            The seconds spent waiting for the communication to complete.
+
+        """
+        start_time = time.time()
+        if self._request is not None:
+            self._request.Wait()
+            self._request = None
+            self._send_buffer = None
+        wait_time = time.time() - start_time
+        if self._receive_buffer is not None:
+            self._out[self._row_indices] = self._receive_buffer
+            self._receive_buffer = None
+        return wait_time
+
+
+def mpi_allgather_rows(mpicomm, local_rows, indices_per_rank, out, nonblocking=False):
+    """Gather into all nodes the rows of an array computed by different nodes.
+
+    The rows are communicated as contiguous buffers with Allgatherv, which avoids
+    pickling the data and is much faster for large arrays (e.g. positions).
+
+    Parameters
+    ----------
+    mpicomm : mpi4py communicator
+        The communicator.
+    local_rows : numpy.ndarray
+        The rows computed by this node, in the order of indices_per_rank[mpicomm.rank].
+        The shape of each row must match out.shape[1:].
+    indices_per_rank : list of list of int
+        indices_per_rank[rank] are the indices of the rows of out computed by
+        node rank. This must be the same on all nodes.
+    out : numpy.ndarray
+        The array updated in place with the rows of all nodes. This can be a view
+        (e.g. a transpose to gather columns).
+    nonblocking : bool, optional, default=False
+        If True, the communication is started with Iallgatherv and the function
+        returns immediately. Falls back to Allgatherv if the MPI library does not
+        support non-blocking collectives.
+
+    Returns
+    -------
+    pending : MPIPendingRows
+        The communication, whose wait() method must be called before using out.
+        Blocking communications are already completed.
+
+    """
+    counts, displacements, row_indices = _mpi_rows_layout(indices_per_rank, out.shape[1:])
+    send_buffer = np.ascontiguousarray(local_rows, dtype=out.dtype).reshape(-1)
+    receive_buffer = np.empty((len(row_indices),) + out.shape[1:], dtype=out.dtype)
+    receive_spec = [receive_buffer, (counts, displacements)]
+    request = None
+    if nonblocking:
+        request = _start_nonblocking(mpicomm, 'Iallgatherv', send_buffer, receive_spec)
+    if request is None:
+        mpicomm.Allgatherv(send_buffer, receive_spec)
+    pending = MPIPendingRows(request, send_buffer, receive_buffer, row_indices, out)
+    if request is None:
+        pending.wait()
+    return pending
+
+
+def mpi_gather_rows(mpicomm, local_rows, indices_per_rank, out, root=0, nonblocking=False):
+    """Gather into the root node the rows of an array computed by different nodes.
+
+    This is the equivalent of mpi_allgather_rows() for data that only the root
+    node needs (e.g. to write it to disk).
+
+    Parameters
+    ----------
+    mpicomm : mpi4py communicator
+        The communicator.
+    local_rows : numpy.ndarray
+        The rows computed by this node, in the order of indices_per_rank[mpicomm.rank].
+    indices_per_rank : list of list of int
+        indices_per_rank[rank] are the indices of the rows of out computed by
+        node rank. This must be the same on all nodes.
+    out : numpy.ndarray
+        The array updated in place with the rows of all nodes on the root node.
+        The shape and dtype must be the same on all nodes, but only the root
+        node modifies it.
+    root : int, optional, default=0
+        The rank of the node receiving the data.
+    nonblocking : bool, optional, default=False
+        If True, the communication is started with Igatherv and the function
+        returns immediately (see mpi_allgather_rows()).
+
+    Returns
+    -------
+    pending : MPIPendingRows
+        The communication, whose wait() method must be called on all nodes.
+
+    """
+    counts, displacements, row_indices = _mpi_rows_layout(indices_per_rank, out.shape[1:])
+    send_buffer = np.ascontiguousarray(local_rows, dtype=out.dtype).reshape(-1)
+    if mpicomm.rank == root:
+        receive_buffer = np.empty((len(row_indices),) + out.shape[1:], dtype=out.dtype)
+        receive_spec = [receive_buffer, (counts, displacements)]
+    else:
+        receive_buffer = None
+        receive_spec = None
+    request = None
+    if nonblocking:
+        request = _start_nonblocking(mpicomm, 'Igatherv', send_buffer, receive_spec, root=root)
+    if request is None:
+        mpicomm.Gatherv(send_buffer, receive_spec, root=root)
+    pending = MPIPendingRows(request, send_buffer, receive_buffer, row_indices, out)
+    if request is None:
+        pending.wait()
+    return pending
+
+
+def _start_nonblocking(mpicomm, method_name, *args, **kwargs):
+    """Start a non-blocking collective, returning None if it is not supported."""
+    try:
+        return getattr(mpicomm, method_name)(*args, **kwargs)
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+def _mpi_rows_layout(indices_per_rank, row_shape):
+    """Return the counts and displacements of the rows sent by each node and the gathered row indices."""
+    row_size = int(np.prod(row_shape))
+    counts = np.array([len(indices) * row_size for indices in indices_per_rank], dtype=int)
+    displacements = np.zeros(len(counts), dtype=int)
+    displacements[1:] = np.cumsum(counts)[:-1]
+    row_indices = list(itertools.chain.from_iterable(indices_per_rank))
+    return counts, displacements, row_indices
+
+
 @contextmanager
 def delay_termination():
     """Context manager to delay handling of termination signals."""
@@ -217,7 +681,99 @@ def delay_termination():
     # Fire delayed signals
     for signum, s in listitems(signals_received):
         if s is not None:
-            old_handlers[signum](*s)
+            _call_signal_handler(old_handlers[signum], *s)
+
+
+def _call_signal_handler(handler, signum, frame):
+    """Call a signal handler as returned by signal.getsignal(), including SIG_DFL and SIG_IGN."""
+    if handler == signal.SIG_IGN:
+        return
+    if handler == signal.SIG_DFL or handler is None:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+    else:
+        handler(signum, frame)
+
+
+@contextmanager
+def handle_termination(callback):
+    """Context manager calling callback when a termination signal is received.
+
+    The handlers that were set before entering the context are called after
+    callback, and they are restored on exit. Signal handlers can be set only
+    in the main thread; in other threads, this does nothing.
+
+    Parameters
+    ----------
+    callback : callable
+        A function without arguments called when SIGINT or SIGTERM is received.
+
+    """
+    signals_to_catch = [signal.SIGINT, signal.SIGTERM]
+    old_handlers = {signum: signal.getsignal(signum) for signum in signals_to_catch}
+
+    def termination_handler(signum, frame):
+        callback()
+        _call_signal_handler(old_handlers[signum], signum, frame)
+
+    try:
+        for signum in signals_to_catch:
+            signal.signal(signum, termination_handler)
+    except ValueError:  # not in the main thread
+        old_handlers = {}
+
+    try:
+        yield
+    finally:
+        for signum, handler in listitems(old_handlers):
+            signal.signal(signum, handler)
+
+
+# Signals sent by batch schedulers some time before killing a job.
+STOP_SIGNALS = [signal.SIGTERM] + [getattr(signal, name) for name in ['SIGUSR1', 'SIGUSR2']
+                                   if hasattr(signal, name)]
+
+
+@contextmanager
+def catch_stop_signals(signals=None):
+    """Context manager recording the stop signals received instead of terminating.
+
+    This allows the program to check the recorded signals and stop at a point
+    where its data is consistent. The handlers that were set before entering the
+    context are restored on exit. Signal handlers can be set only in the main
+    thread; in other threads, no signal is recorded.
+
+    Parameters
+    ----------
+    signals : list of int, optional
+        The signals to catch (default is STOP_SIGNALS).
+
+    Yields
+    ------
+    received_signals : list of int
+        The list to which the numbers of the received signals are appended.
+
+    """
+    if signals is None:
+        signals = STOP_SIGNALS
+    received_signals = []
+    old_handlers = {signum: signal.getsignal(signum) for signum in signals}
+
+    def stop_handler(signum, frame):
+        logger.warning('Received signal {}; stopping at the end of the current iteration.'.format(signum))
+        received_signals.append(signum)
+
+    try:
+        for signum in signals:
+            signal.signal(signum, stop_handler)
+    except ValueError:  # not in the main thread
+        old_handlers = {}
+
+    try:
+        yield received_signals
+    finally:
+        for signum, handler in listitems(old_handlers):
+            signal.signal(signum, handler)
 
 
 def delayed_termination(func):
@@ -655,6 +1211,10 @@ def get_data_filename(relative_path):
     return fn
 
 
+# Suffix of the files storing the positions separately from the store files (see ReplicaExchange.trajectory_directory).
+TRAJECTORY_FILE_SUFFIX = '_trajectory.nc'
+
+
 def find_phases_in_store_directory(store_directory):
     """Build a list of phases in the store directory.
 
@@ -667,10 +1227,11 @@ def find_phases_in_store_directory(store_directory):
     -------
     phases : dict of str
        A dictionary phase_name -> file_path that maps phase names to its NetCDF
-       file path.
+       file path. Trajectory files linked to the store files are ignored.
 
     """
-    full_paths = glob.glob(os.path.join(store_directory, '*.nc'))
+    full_paths = [full_path for full_path in glob.glob(os.path.join(store_directory, '*.nc'))
+                  if not full_path.endswith(TRAJECTORY_FILE_SUFFIX)]
 
     phases = {}
     for full_path in full_paths:
@@ -30,7 +30,7 @@ from schema import Schema, And, Or, Use, Optional, SchemaError
 from . import utils
 from . import pipeline
 from .yank import Yank
-from .repex import ReplicaExchange, ThermodynamicState
+from .repex import ThermodynamicState, SimulationInterrupted
 from .sampling import ModifiedHamiltonianExchange
 
 logger = logging.getLogger(__name__)
@@ -41,6 +41,17 @@ logger = logging.getLogger(__name__)
 
 HIGHEST_VERSION = '1.0'  # highest version of YAML syntax
 
+# Dynamics presets. Each preset overwrites the options that the user left to their default.
+DYNAMICS_PRESETS = {
+    # Hydrogen mass repartitioning with 4 fs timestep.
+    'hmr-4fs': {
+        'hydrogen_mass': 4 * unit.amu,
+        'constraints': openmm.app.HBonds,
+        'timestep': 4.0 * unit.femtoseconds,
+        'integrator_type': 'baoab'
+    }
+}
+
 
 # =============================================================================================
 # UTILITY FUNCTIONS
@@ -1173,10 +1184,13 @@ class YamlBuilder:
         'experiments_dir': 'experiments',
         'platform': 'fastest',
         'precision': 'auto',
+        'mpi_bind_devices': True,
+        'mpi_parallel_experiments': False,
         'temperature': 298 * unit.kelvin,
         'pressure': 1 * unit.atmosphere,
         'constraints': openmm.app.HBonds,
         'hydrogen_mass': 1 * unit.amu,
+        'dynamics_preset': None,
     }
 
     @property
@@ -1199,6 +1213,7 @@ class YamlBuilder:
         self._script_dir = os.getcwd()  # basic dir for relative paths
         self._db = None  # Database containing molecules created in parse()
         self._mpicomm = None  # MPI communicator
+        self._node_placement = None  # rank and number of the MPI processes on this node, if split in groups
         self._raw_yaml = {}  # Unconverted input YAML script
         self._protocols = {}  # Alchemical protocols description
         self._experiments = {}  # Experiments description
@@ -1294,8 +1309,11 @@ class YamlBuilder:
         with omt.utils.temporary_cd(self._script_dir):
             self._check_resume()
             self._setup_experiments()
-            for output_dir, combination in self._expand_experiments():
-                self._run_experiment(combination, output_dir)
+            if self._mpicomm is not None and self.options['mpi_parallel_experiments']:
+                self._run_experiments_in_parallel(list(self._expand_experiments()))
+            else:
+                for output_dir, combination in self._expand_experiments():
+                    self._run_experiment(combination, output_dir)
 
     def setup_experiments(self):
         """Set up all Yank experiments without running them."""
@@ -1336,8 +1354,50 @@ class YamlBuilder:
         """
         exp_options = self.options.copy()
         exp_options.update(self._validate_options(experiment.get('options', {})))
+        if exp_options['dynamics_preset'] is not None:
+            self._apply_dynamics_preset(exp_options)
         return exp_options
 
+    @classmethod
+    def _apply_dynamics_preset(cls, options):
+        """Overwrite the options left to their default with the values of dynamics_preset.
+
+        Parameters
+        ----------
+        options : dict
+            The experiment options. This is modified in place.
+
+        Raises
+        ------
+        YamlParseError
+            If the preset is unknown or the user-specified options are unsafe for it.
+
+        """
+        preset_name = options['dynamics_preset']
+        try:
+            preset = DYNAMICS_PRESETS[preset_name]
+        except KeyError:
+            raise YamlParseError('Unknown dynamics_preset {}. Valid presets are {}'.format(
+                preset_name, ', '.join(sorted(DYNAMICS_PRESETS))))
+
+        template_options = cls.DEFAULT_OPTIONS.copy()
+        template_options.update(ModifiedHamiltonianExchange.default_parameters)
+        for option_name, preset_value in utils.listitems(preset):
+            if option_name not in options or options[option_name] == template_options[option_name]:
+                options[option_name] = preset_value
+
+        # Large timesteps are stable only with constrained and repartitioned hydrogens.
+        if options['timestep'] > 2.0 * unit.femtoseconds:
+            if options['constraints'] is None:
+                raise YamlParseError('dynamics_preset {}: timestep {} requires constraints'.format(
+                    preset_name, options['timestep']))
+            if options['hydrogen_mass'] < 3.0 * unit.amu:
+                raise YamlParseError('dynamics_preset {}: timestep {} requires hydrogen_mass '
+                                     '>= 3 amu'.format(preset_name, options['timestep']))
+        if options['timestep'] > 4.0 * unit.femtoseconds:
+            raise YamlParseError('dynamics_preset {}: timestep {} is too large'.format(
+                preset_name, options['timestep']))
+
     # --------------------------------------------------------------------------
     # Combinatorial expansion
     # --------------------------------------------------------------------------
@@ -1491,13 +1551,14 @@ class YamlBuilder:
         """
         template_options = cls.DEFAULT_OPTIONS.copy()
         template_options.update(Yank.default_parameters)
-        template_options.update(ReplicaExchange.default_parameters)
+        template_options.update(ModifiedHamiltonianExchange.default_parameters)
         template_options.update(utils.get_keyword_args(AbsoluteAlchemicalFactory.__init__))
-        openmm_app_type = {'constraints': to_openmm_app}
+        special_conversions = {'constraints': to_openmm_app,
+                               'walltime_limit': utils.to_unit_validator(unit.seconds)}
         try:
             validated_options = utils.validate_parameters(options, template_options, check_unknown=True,
                                                           process_units_str=True, float_to_int=True,
-                                                          special_conversions=openmm_app_type)
+                                                          special_conversions=special_conversions)
         except (TypeError, ValueError) as e:
             raise YamlParseError(str(e))
         return validated_options
@@ -2128,7 +2189,7 @@ class YamlBuilder:
         platform = openmm.Platform.getPlatform(fastest_platform_id)
         return platform
 
-    def _configure_platform(self, platform_name, platform_precision):
+    def _configure_platform(self, platform_name, platform_precision, bind_devices=False, mpicomm=None):
         """
         Configure the platform to be used for simulation for the given precision.
 
@@ -2144,6 +2205,12 @@ class YamlBuilder:
             only single precision. If None, the precision mode won't be
             set, so OpenMM default value will be used which is always
             'single' for CUDA and OpenCL.
+        bind_devices : bool, optional
+            If True and MPI is active, the MPI processes running on the same
+            node are spread across the visible GPUs (see utils.bind_platform_device()).
+        mpicomm : mpi4py communicator, optional
+            The processes configuring the platform. If None, all the MPI
+            processes (default is None).
 
         Returns
         -------
@@ -2208,6 +2275,12 @@ class YamlBuilder:
             else:  # This is an unkown platform
                 raise RuntimeError("Found unknown platform '{}'.".format(platform_name))
 
+        # Assign a GPU to each MPI process of the node
+        if mpicomm is None:
+            mpicomm = self._mpicomm
+        if bind_devices and mpicomm is not None:
+            utils.bind_platform_device(platform, mpicomm, self._node_placement)
+
         return platform
 
     def _generate_yaml(self, experiment, file_path):
@@ -2332,7 +2405,41 @@ class YamlBuilder:
                                                ) for state_values in values]
         return alchemical_protocol
 
-    def _run_experiment(self, experiment, experiment_dir):
+    def _get_experiment_nreplicas(self, experiment):
+        """Return the total number of replicas of the phases of the experiment."""
+        protocol = self._protocols[experiment['protocol']]
+        return sum(len(utils.listvalues(phase['alchemical_path'])[0])
+                   for phase in utils.listvalues(protocol))
+
+    def _run_experiments_in_parallel(self, experiments):
+        """Run the experiments simultaneously on groups of MPI processes.
+
+        The experiments are run in batches of at most one experiment per MPI process.
+        The processes are divided among the experiments of each batch proportionally
+        to their number of replicas.
+
+        Parameters
+        ----------
+        experiments : list of tuple
+            The pairs (experiment_dir, experiment) returned by _expand_experiments().
+
+        """
+        nprocesses = self._mpicomm.size
+        # GPUs are assigned among all the processes of a node, whatever their group.
+        self._node_placement = utils.get_node_local_rank(self._mpicomm)
+        for batch_start in range(0, len(experiments), nprocesses):
+            batch = experiments[batch_start:batch_start + nprocesses]
+            nreplicas = [self._get_experiment_nreplicas(experiment) for _, experiment in batch]
+            group_index, group_comm = utils.split_mpi_communicator(self._mpicomm, nreplicas)
+            experiment_dir, experiment = batch[group_index]
+            logger.debug('Node {}/{}: running experiment {} on {} MPI processes.'.format(
+                self._mpicomm.rank, self._mpicomm.size, batch_start + group_index, group_comm.size))
+            # Wait for all the experiments of the batch before starting the next one,
+            # even if this experiment fails or is interrupted.
+            with utils.synchronize_mpi_groups(self._mpicomm, group_comm, (SimulationInterrupted,)):
+                self._run_experiment(experiment, experiment_dir, mpicomm=group_comm)
+
+    def _run_experiment(self, experiment, experiment_dir, mpicomm=None):
         """Prepare and run a single experiment.
 
         Parameters
@@ -2342,8 +2449,13 @@ class YamlBuilder:
         experiment_dir : str
             The directory where to store the output files relative to the main
             output directory as specified by the user in the YAML script
+        mpicomm : mpi4py communicator, optional
+            The processes that run the experiment. If None, the experiment is run
+            by all the MPI processes (default is None).
 
         """
+        if mpicomm is None:
+            mpicomm = self._mpicomm
         protocol_id = experiment['protocol']
         exp_name = 'experiments' if experiment_dir == '' else os.path.basename(experiment_dir)
 
@@ -2357,28 +2469,29 @@ class YamlBuilder:
         # Create directory and determine if we need to resume the simulation
         results_dir = self._get_experiment_dir(exp_opts, experiment_dir)
         resume = os.path.isdir(results_dir)
-        if self._mpicomm is None or self._mpicomm.rank == 0:
+        if mpicomm is None or mpicomm.rank == 0:
             if not resume:
                 os.makedirs(results_dir)
             else:
                 resume = self._check_resume_experiment(results_dir, protocol_id)
-        if self._mpicomm:  # process 0 send result to other processes
-            resume = self._mpicomm.bcast(resume, root=0)
+        if mpicomm:  # process 0 send result to other processes
+            resume = mpicomm.bcast(resume, root=0)
 
         # Configure logger for this experiment
         utils.config_root_logger(exp_opts['verbose'], os.path.join(results_dir, exp_name + '.log'),
-                                 self._mpicomm)
+                                 mpicomm)
 
         # Configure platform and precision
-        platform = self._configure_platform(exp_opts['platform'], exp_opts['precision'])
+        platform = self._configure_platform(exp_opts['platform'], exp_opts['precision'],
+                                            exp_opts['mpi_bind_devices'], mpicomm)
 
         # Initialize simulation
-        yank = Yank(results_dir, mpicomm=self._mpicomm, platform=platform, **yank_opts)
+        yank = Yank(results_dir, mpicomm=mpicomm, platform=platform, **yank_opts)
 
         if resume:
             yank.resume()
         else:
-            if self._mpicomm is None or self._mpicomm.rank == 0:
+            if mpicomm is None or mpicomm.rank == 0:
                 system_id = experiment['system']
 
                 # Export YAML file for reproducibility
@@ -2462,11 +2575,11 @@ class YamlBuilder:
                 yank.create(thermodynamic_state, *phases, restraint_type=restraint_type)
 
             # Run the simulation
-            if self._mpicomm:  # wait for the simulation to be prepared
-                debug_msg = 'Node {}/{}: MPI barrier'.format(self._mpicomm.rank, self._mpicomm.size)
+            if mpicomm:  # wait for the simulation to be prepared
+                debug_msg = 'Node {}/{}: MPI barrier'.format(mpicomm.rank, mpicomm.size)
                 logger.debug(debug_msg + ' - waiting for the simulation to be created.')
-                self._mpicomm.barrier()
-                if self._mpicomm.rank != 0:
+                mpicomm.barrier()
+                if mpicomm.rank != 0:
                     yank.resume()  # resume from netcdf file created by root node
         yank.run()
 
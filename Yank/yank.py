@@ -27,6 +27,7 @@ import simtk.unit as unit
 import simtk.openmm as openmm
 
 from alchemy import AbsoluteAlchemicalFactory
+from .repex import SimulationInterrupted
 from .sampling import ModifiedHamiltonianExchange
 from .restraints import create_restraints, V0
 
@@ -128,7 +129,9 @@ class Yank(object):
         'randomize_ligand_sigma_multiplier': 2.0,
         'randomize_ligand_close_cutoff': 1.5 * unit.angstrom,
         'mc_displacement_sigma': 10.0 * unit.angstroms,
-        'anisotropic_dispersion_correction': True
+        'anisotropic_dispersion_correction': True,
+        'store_solvent_positions': True,
+        'mpi_parallel_phases': False
     }
 
     def __init__(self, store_directory, mpicomm=None, platform=None, **kwargs):
@@ -158,6 +161,14 @@ class Yank(object):
            Correct for anisotropic dispersion effects by generating 2 additional
            states with expanded long-range cutoff distances to estimate energies
            at. These states are not simulated. (default: True)
+        store_solvent_positions : bool, optional
+           If False, the positions of the solvent atoms (except the ligand
+           counterions) are not stored in the trajectory, but only in the restart
+           checkpoint. This is ignored if positions_atom_indices is given (default: True).
+        mpi_parallel_phases : bool, optional
+           If True and there are at least as many MPI processes as phases, the phases
+           are run simultaneously on groups of processes sized proportionally to their
+           number of replicas instead of one after the other (default: False).
 
         Other Parameters
         ----------------
@@ -515,6 +526,13 @@ class Yank(object):
         if self._randomize_ligand and is_complex_explicit:
             logger.warning("Ligand randomization requested, but will not be performed for explicit solvent simulations.")
 
+        # Store only the positions of solute atoms if requested.
+        solvent_atoms = set(atom_indices.get('solvent', [])) - set(atom_indices.get('ligand_counterions', []))
+        if (not self._store_solvent_positions and len(solvent_atoms) > 0 and
+                repex_parameters.get('positions_atom_indices', None) is None):
+            repex_parameters['positions_atom_indices'] = [atom_index for atom_index in range(reference_system.getNumParticles())
+                                                          if atom_index not in solvent_atoms]
+
         # Identify whether any atoms will be displaced via MC, unless option is turned off.
         mc_atoms = None
         if self._mc_displacement_sigma:
@@ -572,12 +590,50 @@ class Yank(object):
             seed = np.random.randint(4294967295 - self._mpicomm.size) + self._mpicomm.rank
             np.random.seed(seed)
 
-        # Run all phases sequentially.
-        # TODO: Divide up MPI resources among the phases so they can run simultaneously?
-        for phase in self._phases:
+        # Divide up MPI resources among the phases so they can run simultaneously.
+        phases = self._phases
+        mpicomm = self._mpicomm
+        group_comm = None
+        if self._mpi_parallel_phases and mpicomm is not None and 1 < len(phases) <= mpicomm.size:
+            if mpicomm.rank == 0:
+                nreplicas = [ModifiedHamiltonianExchange.status_from_store(self._store_filenames[phase])['nstates']
+                             for phase in phases]
+            else:
+                nreplicas = None
+            nreplicas = mpicomm.bcast(nreplicas, root=0)
+            group_index, group_comm = utils.split_mpi_communicator(mpicomm, nreplicas)
+            phases = [phases[group_index]]
+            mpicomm = group_comm
+            logger.debug("Running phase {} on {} MPI processes.".format(phases[0], group_comm.size))
+
+        # Run the phases assigned to this process, then wait for the other phases to complete
+        # even if this one fails or is interrupted.
+        if group_comm is None:
+            self._run_phases(phases, mpicomm, niterations_to_run)
+        else:
+            with utils.synchronize_mpi_groups(self._mpicomm, group_comm, (SimulationInterrupted,)):
+                self._run_phases(phases, mpicomm, niterations_to_run)
+
+        return
+
+    def _run_phases(self, phases, mpicomm, niterations_to_run=None):
+        """
+        Run the given phases sequentially.
+
+        Parameters
+        ----------
+        phases : list of str
+           The phases to run.
+        mpicomm : mpi4py communicator
+           The processes running the phases, or None if MPI is not used.
+        niterations_to_run : int, optional, default=None
+           If specified, only this many iterations will be run for each phase.
+
+        """
+        for phase in phases:
             store_filename = self._store_filenames[phase]
             # Resume simulation from store file.
-            simulation = ModifiedHamiltonianExchange(store_filename=store_filename, mpicomm=self._mpicomm,
+            simulation = ModifiedHamiltonianExchange(store_filename=store_filename, mpicomm=mpicomm,
                                                      platform=self._platform)
             simulation.resume(options=self._repex_parameters)
             # TODO: We may need to manually update run options here if options=options above does not behave as expected.
@@ -585,8 +641,6 @@ class Yank(object):
             # Clean up to ensure we close files, contexts, etc.
             del simulation
 
-        return
-
     def status(self):
         """
         Determine status of all phases of Yank calculation.